@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""agenda.py
+
+Precomputed conference agendas. A conference's AgendaForm is stored as an
+Agenda entity, child of the Conference, holding the zlib compressed protobuf
+encoding; memcache keeps a copy of the same bytes, so serving an agenda is
+one memcache get and a decode. Session writes drop the snapshot in their
+transaction and queue a /tasks/rebuild_agenda task.
+
+"""
+
+import zlib
+
+from protorpc import protobuf
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import Agenda
+from models import AgendaForm
+
+MEMCACHE_AGENDA_PREFIX = 'AGENDA:'
+AGENDA_CACHE_TTL = 3600
+# seconds a dropped snapshot can't be put back in memcache, so a reader
+# that loaded it before the write does not restore it
+AGENDA_LOCK_SECONDS = 2
+
+
+def _agendaKey(conf_key):
+    return ndb.Key(Agenda, 1, parent=conf_key)
+
+
+def sessionOrder(session):
+    """Sort key putting sessions in agenda order, undated and untimed ones
+    last."""
+    return (session.date is None, session.date,
+            session.startTime is None, session.startTime, session.name)
+
+
+def getAgenda(conf_key):
+    """Return the stored AgendaForm of conf_key, or None when it has to be
+    built."""
+    wsck = conf_key.urlsafe()
+    data = memcache.get(MEMCACHE_AGENDA_PREFIX + wsck)
+    if data is None:
+        agenda = _agendaKey(conf_key).get()
+        if agenda is None:
+            return None
+        data = agenda.data
+        _cache(wsck, data)
+    return protobuf.decode_message(AgendaForm, zlib.decompress(data))
+
+
+def storeAgenda(conf_key, form):
+    """Store form as the agenda of conf_key. Call it in the transaction that
+    read the sessions; memcache is only populated once it commits."""
+    data = zlib.compress(protobuf.encode_message(form))
+    Agenda(key=_agendaKey(conf_key), data=data).put()
+    wsck = conf_key.urlsafe()
+    ndb.get_context().call_on_commit(lambda: _cache(wsck, data))
+
+
+def _cache(wsck, data):
+    # add() so a locked (just dropped) snapshot stays out
+    if len(data) <= memcache.MAX_VALUE_SIZE:
+        memcache.add(MEMCACHE_AGENDA_PREFIX + wsck, data,
+                     time=AGENDA_CACHE_TTL)
+
+
+def agendaChanged(conf_key):
+    """Drop the agenda of conf_key and queue its rebuild. Inside a
+    transaction on the conference's entity group both only happen if it
+    commits."""
+    wsck = conf_key.urlsafe()
+    _agendaKey(conf_key).delete()
+    ndb.get_context().call_on_commit(lambda: memcache.delete(
+        MEMCACHE_AGENDA_PREFIX + wsck, seconds=AGENDA_LOCK_SECONDS))
+    taskqueue.add(params={'websafeConferenceKey': wsck},
+                  url='/tasks/rebuild_agenda',
+                  transactional=ndb.in_transaction())
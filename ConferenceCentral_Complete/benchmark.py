@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+
+"""benchmark.py
+
+Endpoint benchmark for ConferenceApi on the App Engine testbed stubs.
+
+Seeds a synthetic dataset into a local datastore stub and drives every
+ConferenceApi method against it, recording per-method latency percentiles,
+RPC counts and memory growth. The report is written as JSON and can be
+compared against a stored baseline:
+
+    python benchmark.py --sdk ~/google-cloud-sdk/platform/google_appengine \\
+        --output bench.json --baseline baseline.json
+
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import timeit
+from collections import defaultdict
+from datetime import date, time, timedelta
+
+
+def _setupSdk(sdk):
+    """Put the App Engine SDK and its bundled libraries on sys.path."""
+    if sdk:
+        sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+CITIES = ['London', 'Paris', 'Tokyo', 'San Francisco', 'Chicago', 'Berlin']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition', 'moles']
+HIGHLIGHTS = ['moles', 'beer', 'networking', 'hands-on', 'panel', 'demo']
+SEARCHES = ['moles', 'programming languages', 'beer demo', 'web', 'session 1']
+PREFIXES = ['l', 'lo', 'Par', 'web t', 'mo', 'conf']
+
+QUERY_FILTERS = [
+    [],
+    [('CITY', 'EQ', 'London')],
+    [('TOPIC', 'EQ', 'Web Technologies')],
+    [('MONTH', 'GT', '6')],
+    [('CITY', 'EQ', 'Paris'), ('MAX_ATTENDEES', 'GT', '100')],
+]
+
+
+class Benchmark(object):
+    """Benchmark -- seeded testbed plus one scenario per ConferenceApi
+    method"""
+
+    def __init__(self, args):
+        from google.appengine.datastore import datastore_stub_util
+        from google.appengine.ext import testbed
+
+        self.args = args
+        self.rand = random.Random(args.seed)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # endpoints.api_server() wants a major.minor version id
+        self.testbed.setup_env(app_id='conference-bench',
+                               current_version_id='1.1', overwrite=True)
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.testbed.init_urlfetch_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_mail_stub()
+        self.testbed.init_app_identity_stub()
+        self.rpcs = defaultdict(int)
+        self._installRpcHook()
+
+    def _installRpcHook(self):
+        from google.appengine.api import apiproxy_stub_map
+
+        def countRpc(service, call, request, response):
+            self.rpcs['%s.%s' % (service, call)] += 1
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'benchmark', countRpc)
+
+    def close(self):
+        self.testbed.deactivate()
+
+    # - - - seeding - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def seed(self):
+        """Write the synthetic dataset straight through the models."""
+        from google.appengine.ext import ndb
+        from models import Conference, Profile, Registration, Session, TypeOfSession
+        from models import WishlistEntry
+        import search
+        import seats
+        import typeahead
+
+        args, rand = self.args, self.rand
+        self.emails = ['user%d@example.com' % i for i in range(args.profiles)]
+        profiles = [Profile(key=ndb.Key(Profile, email), mainEmail=email,
+                            displayName='User %d' % i)
+                    for i, email in enumerate(self.emails)]
+
+        conferences = []
+        for i in range(args.conferences):
+            organizer = rand.choice(self.emails)
+            start = date(2026, 1, 1) + timedelta(days=rand.randrange(365))
+            maxAttendees = rand.choice([10, 50, 200, 1500])
+            conferences.append(Conference(
+                parent=ndb.Key(Profile, organizer),
+                name='Conference %d' % i,
+                description='Synthetic conference number %d' % i,
+                organizerUserId=organizer,
+                organizerDisplayName='User %d' % self.emails.index(organizer),
+                topics=rand.sample(TOPICS, 2),
+                city=rand.choice(CITIES),
+                startDate=start, month=start.month,
+                endDate=start + timedelta(days=2),
+                maxAttendees=maxAttendees, seatsAvailable=maxAttendees))
+        self.conferenceKeys = ndb.put_multi(conferences)
+        for conf in conferences:
+            seats.createSeatShards(conf.key, conf.seatsAvailable)
+
+        sessions = []
+        for conf in conferences:
+            for j in range(args.sessions):
+                sessions.append(Session(
+                    parent=conf.key,
+                    name='Session %d' % j,
+                    highlights=rand.sample(HIGHLIGHTS, 2),
+                    speakerUserId=rand.choice(self.emails),
+                    duration=rand.choice([30, 45, 60, 90]),
+                    typeOfSession=rand.choice(list(TypeOfSession)),
+                    date=conf.startDate,
+                    startTime=time(rand.randrange(8, 23), 0),
+                    conferenceId=conf.key.urlsafe()))
+        self.sessionKeys = ndb.put_multi(sessions)
+
+        registrations, wishlist = [], []
+        for prof in profiles:
+            registrations.extend(
+                Registration(key=ndb.Key(Registration, k.urlsafe(),
+                                         parent=prof.key), conference=k)
+                for k in rand.sample(self.conferenceKeys,
+                                     min(args.registrations, len(conferences))))
+            wishlist.extend(
+                WishlistEntry(key=ndb.Key(WishlistEntry, k.urlsafe(),
+                                          parent=prof.key),
+                              session=k, conference=k.parent())
+                for k in rand.sample(self.sessionKeys,
+                                     min(args.wishlist, len(sessions))))
+        ndb.put_multi(profiles)
+        ndb.put_multi(registrations)
+        ndb.put_multi(wishlist)
+        # what the /tasks/index_document tasks would have built
+        search.indexEntities(conferences)
+        search.indexEntities(sessions)
+        typeahead.updateTypeahead([conf.key for conf in conferences])
+        self.organizers = sorted(set(c.organizerUserId for c in conferences))
+
+    # - - - scenarios - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def scenarios(self):
+        """Return (method name, callable(api)) pairs; each callable builds
+        its own request from the seeded data."""
+        from protorpc import message_types
+        import conference
+        from models import (ConferenceQueryForm, ConferenceQueryForms,
+                            ProfileMiniForm, SessionForm,
+                            SessionQueryForm, SessionQueryForms, WishlistForm)
+
+        rand = self.rand
+        void = message_types.VoidMessage()
+
+        def confRequest():
+            return conference.CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=rand.choice(self.conferenceKeys).urlsafe())
+
+        def queryConferences(api):
+            filters = [ConferenceQueryForm(field=f, operator=o, value=v)
+                       for f, o, v in rand.choice(QUERY_FILTERS)]
+            return api.queryConferences(ConferenceQueryForms(filters=filters))
+
+        def searchDocuments(api):
+            return api.search(conference.SEARCH_REQUEST.combined_message_class(
+                q=rand.choice(SEARCHES)))
+
+        def suggest(api):
+            return api.suggest(conference.SUGGEST_REQUEST.combined_message_class(
+                prefix=rand.choice(PREFIXES)))
+
+        def getConferenceSessionsByType(api):
+            request = conference.CONF_TYPE_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=rand.choice(self.conferenceKeys).urlsafe(),
+                sessionType=rand.choice(['LECTURE', 'KEYNOTE', 'WORKSHOP']))
+            return api.getConferenceSessionsByType(request)
+
+        def getSessionsBySpeaker(api):
+            return api.getSessionsBySpeaker(
+                conference.SESSION_GET_REQUEST.combined_message_class(
+                    websafeKey=rand.choice(self.emails)))
+
+        def addSessionToWishlist(api):
+            return api.addSessionToWishlist(
+                conference.SESSION_GET_REQUEST.combined_message_class(
+                    websafeKey=rand.choice(self.sessionKeys).urlsafe()))
+
+        def addSessionsToWishlist(api):
+            keys = rand.sample(self.sessionKeys, min(5, len(self.sessionKeys)))
+            return api.addSessionsToWishlist(WishlistForm(
+                websafeSessionKeys=[k.urlsafe() for k in keys]))
+
+        def removeSessionsFromWishlist(api):
+            keys = rand.sample(self.sessionKeys, min(5, len(self.sessionKeys)))
+            return api.removeSessionsFromWishlist(WishlistForm(
+                websafeSessionKeys=[k.urlsafe() for k in keys]))
+
+        def saveProfile(api):
+            return api.saveProfile(ProfileMiniForm(
+                displayName='Renamed %d' % rand.randrange(1000)))
+
+        def registration(api):
+            # unregister first so the registration itself always succeeds
+            request = confRequest()
+            api.unregisterFromConference(request)
+            return api.registerForConference(request)
+
+        def createSession(api):
+            self._login(rand.choice(self.organizers))
+            conf = rand.choice([k for k in self.conferenceKeys
+                                if k.parent().id() == self.user])
+            return api.createSession(SessionForm(
+                name='Bench session', conferenceId=conf.urlsafe(),
+                speakerUserId=rand.choice(self.emails),
+                date=str(date(2026, 6, 1)), startTime='20:00', duration=45))
+
+        def querySessions(api):
+            filters = [SessionQueryForm(field='START_TIME', operator='GT',
+                                        value='19:00'),
+                       SessionQueryForm(field='DURATION', operator='LTEQ',
+                                        value='60'),
+                       SessionQueryForm(field='TYPE', operator='NE',
+                                        value='WORKSHOP')]
+            return api.querySessions(SessionQueryForms(filters=filters))
+
+        def queryConferencesBySessions(api):
+            filters = [SessionQueryForm(field='HIGHLIGHTS', operator='EQ',
+                                        value=rand.choice(HIGHLIGHTS)),
+                       SessionQueryForm(field='DURATION', operator='LT',
+                                        value='60')]
+            return api.queryConferencesBySessions(
+                SessionQueryForms(filters=filters))
+
+        def getConferenceAttendees(api):
+            self._login(rand.choice(self.organizers))
+            conf = rand.choice([k for k in self.conferenceKeys
+                                if k.parent().id() == self.user])
+            return api.getConferenceAttendees(
+                conference.CONF_PAGE_REQUEST.combined_message_class(
+                    websafeConferenceKey=conf.urlsafe()))
+
+        def getTopSpeakers(api):
+            return api.getTopSpeakers(
+                conference.CONF_TOP_SPEAKERS_REQUEST.combined_message_class(
+                    websafeConferenceKey=rand.choice(
+                        self.conferenceKeys).urlsafe(), n=5))
+
+        return [
+            ('getConference', lambda api: api.getConference(confRequest())),
+            ('queryConferences', queryConferences),
+            ('getConferencesCreated',
+                lambda api: api.getConferencesCreated(void)),
+            ('getConferencesToAttend', lambda api: api.getConferencesToAttend(
+                conference.PAGE_REQUEST.combined_message_class())),
+            ('getConferenceAttendees', getConferenceAttendees),
+            ('getProfile', lambda api: api.getProfile(void)),
+            ('saveProfile', saveProfile),
+            ('getConferenceSessions',
+                lambda api: api.getConferenceSessions(confRequest())),
+            ('search', searchDocuments),
+            ('suggest', suggest),
+            ('getConferenceAgenda',
+                lambda api: api.getConferenceAgenda(confRequest())),
+            ('getConferenceSessionsByType', getConferenceSessionsByType),
+            ('getSessionsBySpeaker', getSessionsBySpeaker),
+            ('getTopSpeakers', getTopSpeakers),
+            ('getSessionsInWishlist',
+                lambda api: api.getSessionsInWishlist(confRequest())),
+            ('addSessionToWishlist', addSessionToWishlist),
+            ('addSessionsToWishlist', addSessionsToWishlist),
+            ('removeSessionsFromWishlist', removeSessionsFromWishlist),
+            ('sessionsAfter7pm', lambda api: api.sessionsAfter7pm(void)),
+            ('querySessions', querySessions),
+            ('moleConferences', lambda api: api.moleConferences(
+                conference.PAGE_REQUEST.combined_message_class())),
+            ('queryConferencesBySessions', queryConferencesBySessions),
+            ('londonAttendees', lambda api: api.londonAttendees(void)),
+            ('registerForConference', registration),
+            ('createSession', createSession),
+        ]
+
+    def _login(self, email):
+        """Make endpoints.get_current_user() return email's user."""
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = email
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'example.com'
+        self.user = email
+
+    # - - - measuring - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def run(self, only=None):
+        import endpoints
+        from google.appengine.ext import ndb
+        from conference import ConferenceApi
+
+        results = {}
+        for name, scenario in self.scenarios():
+            if only and name not in only:
+                continue
+            latencies, rpcs, errors = [], defaultdict(int), 0
+            rssBefore = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            for i in range(self.args.iterations):
+                self._login(self.rand.choice(self.emails))
+                # every call is a fresh request: new api object, empty
+                # ndb context cache
+                ndb.get_context().clear_cache()
+                api = ConferenceApi()
+                self.rpcs.clear()
+                start = timeit.default_timer()
+                try:
+                    scenario(api)
+                except endpoints.ServiceException:
+                    errors += 1
+                latencies.append((timeit.default_timer() - start) * 1000)
+                for rpc, n in self.rpcs.items():
+                    rpcs[rpc] += n
+            rssAfter = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            calls = len(latencies)
+            results[name] = {
+                'calls': calls,
+                'errors': errors,
+                'p50Ms': round(_percentile(latencies, 50), 3),
+                'p95Ms': round(_percentile(latencies, 95), 3),
+                'meanMs': round(sum(latencies) / calls, 3),
+                'rpcsPerCall': dict((rpc, round(float(n) / calls, 2))
+                                    for rpc, n in sorted(rpcs.items())),
+                'datastoreRpcsPerCall': round(float(sum(
+                    n for rpc, n in rpcs.items()
+                    if rpc.startswith('datastore_v3.'))) / calls, 2),
+                'peakRssGrowthKb': rssAfter - rssBefore,
+            }
+        return results
+
+
+def _percentile(values, pct):
+    """Nearest-rank percentile of values."""
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def compare(report, baseline, tolerance):
+    """Print per-method changes against baseline and return the names of
+    methods whose p95 or datastore RPCs grew by more than tolerance."""
+    regressions = []
+    for name, current in sorted(report['methods'].items()):
+        previous = baseline.get('methods', {}).get(name)
+        if not previous:
+            print('%-28s new' % name)
+            continue
+        p95 = current['p95Ms'] / max(previous['p95Ms'], 0.001)
+        rpcs = current['datastoreRpcsPerCall'] - previous['datastoreRpcsPerCall']
+        print('%-28s p95 %8.2fms -> %8.2fms (x%.2f)  datastore rpcs %+.2f' % (
+            name, previous['p95Ms'], current['p95Ms'], p95, rpcs))
+        if p95 > 1 + tolerance or rpcs > previous['datastoreRpcsPerCall'] * tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the google_appengine SDK directory')
+    parser.add_argument('--profiles', type=int, default=50)
+    parser.add_argument('--conferences', type=int, default=200)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per conference')
+    parser.add_argument('--registrations', type=int, default=3,
+                        help='conferences each profile attends')
+    parser.add_argument('--wishlist', type=int, default=5,
+                        help='sessions in each profile wishlist')
+    parser.add_argument('--iterations', type=int, default=50,
+                        help='calls per method')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--method', action='append',
+                        help='only run this method (repeatable)')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--baseline',
+                        help='report to compare against; exits 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative growth of p95 and RPC counts')
+    args = parser.parse_args(argv)
+
+    _setupSdk(args.sdk)
+    bench = Benchmark(args)
+    try:
+        bench.seed()
+        methods = bench.run(args.method)
+    finally:
+        bench.close()
+
+    report = {
+        'config': dict((k, getattr(args, k)) for k in (
+            'profiles', 'conferences', 'sessions', 'registrations',
+            'wishlist', 'iterations', 'seed')),
+        'methods': methods,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('wrote %s' % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print('regressions: %s' % ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
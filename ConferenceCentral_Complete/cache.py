@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Two tier (in-process LRU in front of memcache) caches for ProtoRPC
+response messages
+
+"""
+
+import collections
+import threading
+import time
+
+from protorpc import protobuf
+
+from google.appengine.api import memcache
+
+
+class LRUCache(object):
+    """LRUCache -- thread-safe, bounded, in-process cache whose entries
+    expire after ttl seconds
+    """
+    def __init__(self, capacity, ttl):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # re-insert so the key becomes the most recently used one
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def delete_multi(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class MessageCache(object):
+    """MessageCache -- read-through cache of ProtoRPC messages.
+
+    Messages are stored protobuf encoded, so every reader gets its own copy.
+    The local tier only lives for local_ttl seconds because invalidations
+    cannot reach the LRU of other instances; memcache is the shared tier.
+    Invalidated keys are locked for lock_seconds so a reader that loaded
+    the entity before the write cannot put the stale message back.
+    """
+    def __init__(self, name, message_type, capacity=1000, local_ttl=5,
+                 memcache_ttl=3600, lock_seconds=2):
+        self.name = name
+        self.message_type = message_type
+        self.memcache_ttl = memcache_ttl
+        self.lock_seconds = lock_seconds
+        self._prefix = '%s:' % name
+        self._local = LRUCache(capacity, local_ttl)
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ('localHits', 'memcacheHits', 'misses', 'invalidations'), 0)
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def get(self, key):
+        """Return the cached message for key, or None on a miss."""
+        encoded = self._local.get(key)
+        if encoded is not None:
+            self._count('localHits')
+        else:
+            encoded = memcache.get(self._prefix + key)
+            if encoded is None:
+                self._count('misses')
+                return None
+            self._count('memcacheHits')
+            self._local.set(key, encoded)
+        return protobuf.decode_message(self.message_type, encoded)
+
+    def set(self, key, message):
+        """Populate both tiers, unless key has just been invalidated."""
+        encoded = protobuf.encode_message(message)
+        if memcache.add(self._prefix + key, encoded, time=self.memcache_ttl):
+            self._local.set(key, encoded)
+
+    def delete_multi(self, keys):
+        """Invalidate keys in both tiers."""
+        keys = list(keys)
+        if not keys:
+            return
+        self._local.delete_multi(keys)
+        memcache.delete_multi(keys, seconds=self.lock_seconds,
+                              key_prefix=self._prefix)
+        self._count('invalidations', len(keys))
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def stats(self):
+        """Return this instance's hit/miss counters and LRU occupancy."""
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update(name=self.name, size=len(self._local),
+                     capacity=self._local.capacity)
+        return stats
+
+
+class GenerationalCache(object):
+    """GenerationalCache -- read-through cache of ProtoRPC messages computed
+    from data that is invalidated as a whole, like query results.
+
+    Entries are stamped with the generation they were computed at; writers
+    bump a shared generation counter instead of finding and deleting the
+    entries they affect. get(stale=True) may return an entry of an older
+    generation while another request, holding a lock for lock_seconds,
+    computes the current one. Entries also expire after memcache_ttl
+    seconds, which bounds how long an eventually consistent query result
+    can be served.
+    """
+    def __init__(self, name, message_type, capacity=1000, local_ttl=5,
+                 memcache_ttl=300, lock_seconds=10):
+        self.name = name
+        self.message_type = message_type
+        self.memcache_ttl = memcache_ttl
+        self.lock_seconds = lock_seconds
+        self._prefix = '%s:' % name
+        self._generationKey = '%s:GENERATION' % name
+        self._local = LRUCache(capacity, local_ttl)
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ('localHits', 'memcacheHits', 'staleHits', 'misses',
+             'invalidations'), 0)
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def _seed(self):
+        # an evicted counter restarts from the clock in microseconds, which
+        # writes can't outrun, ahead by memcache_ttl so it starts above the
+        # stamps of entries cached by instances with a faster clock too
+        return int((time.time() + self.memcache_ttl) * 1000000)
+
+    def generation(self):
+        """Return the current generation."""
+        generation = memcache.get(self._generationKey)
+        if generation is None:
+            memcache.add(self._generationKey, self._seed())
+            generation = memcache.get(self._generationKey)
+        return generation
+
+    def bump(self):
+        """Invalidate every entry at once."""
+        memcache.incr(self._generationKey, initial_value=self._seed())
+        self._count('invalidations')
+
+    def get(self, key, generation, stale=False):
+        """Return the message cached for key at generation, or None on a
+        miss. With stale set an older entry counts as a hit too, unless this
+        request is the one that should compute the current one."""
+        entry = self._local.get(key)
+        counter = 'localHits'
+        if entry is None or entry[0] != generation:
+            # another instance may have cached the current generation
+            cached = memcache.get(self._prefix + key)
+            if cached is not None:
+                entry = cached
+                counter = 'memcacheHits'
+                self._local.set(key, entry)
+            elif entry is None:
+                self._count('misses')
+                return None
+        entryGeneration, encoded = entry
+        if entryGeneration != generation:
+            if not stale or memcache.add('%sLOCK:%s' % (self._prefix, key), 1,
+                                         time=self.lock_seconds):
+                self._count('misses')
+                return None
+            counter = 'staleHits'
+        self._count(counter)
+        return protobuf.decode_message(self.message_type, encoded)
+
+    def set(self, key, generation, message):
+        """Populate both tiers with message, computed at generation."""
+        entry = (generation, protobuf.encode_message(message))
+        memcache.set(self._prefix + key, entry, time=self.memcache_ttl)
+        self._local.set(key, entry)
+
+    def stats(self):
+        """Return this instance's hit/miss counters and LRU occupancy."""
+        with self._lock:
+            stats = dict(self._counters)
+        stats.update(name=self.name, size=len(self._local),
+                     capacity=self._local.capacity)
+        return stats
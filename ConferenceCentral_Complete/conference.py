@@ -13,6 +13,12 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
 from datetime import datetime, time
 
 import endpoints
@@ -20,53 +26,109 @@ from protorpc import messages
 from protorpc import message_types
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 
 from models import ConflictException
+from models import CONFERENCE_DEFAULTS
+from models import SESSION_DEFAULTS
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import Registration
+from models import WishlistEntry
+from models import WishlistForm
+from models import AttendeeForms
 from models import StringMessage
 from models import BooleanMessage
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForms
+from models import SessionQueryForms
 from models import TeeShirtSize
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import AgendaDayForm
+from models import AgendaForm
 from models import TypeOfSession
+from models import SpeakerCounts
+from models import NearlySoldOut
+from models import SpeakerForm
+from models import SpeakerForms
+from models import CacheStatsForm
+from models import CacheStatsForms
+from models import CounterForm
+from models import LatencyBucketForm
+from models import MethodStatsForm
+from models import MethodStatsForms
+from models import RpcStatsForm
+from models import MigrationForm
+from models import SearchResultForm
+from models import SearchResultForms
+from models import SuggestionForm
+from models import SuggestionForms
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
+from settings import ADMIN_EMAILS
+from settings import STALE_WHILE_REVALIDATE
 
 from utils import getUserId
 
+from cache import GenerationalCache
+from indexadvisor import loadIndexes
+from indexadvisor import recordQuery
+from cache import MessageCache
+from forms import CopyPlan
+from idpool import IdPool
+from planner import FETCH_BATCH_SIZE
+from planner import QueryPlanner
+import agenda
+import identity
+import instrumentation
+import migrations
+import search
+import typeahead
+from identity import scopeService
+from instrumentation import instrumentService
+
+import seats
+
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+# conferences with at most this many seats left are nearly sold out
+NEARLY_SOLD_OUT_SEATS = 5
+# conferences renamed per organizer name update task
+ORGANIZER_NAME_BATCH_SIZE = 100
+# fully built ConferenceForm per websafe conference key, see getConference()
+CONFERENCE_CACHE = MessageCache('CONFERENCE_FORM', ConferenceForm)
+# ConferenceForms pages per canonical query, see queryConferences(); any
+# conference write bumps its generation
+QUERY_CACHE = GenerationalCache('CONFERENCE_QUERY', ConferenceForms)
+
+# ids handed out from memory, allocated in batches per parent
+CONFERENCE_IDS = IdPool(Conference)
+SESSION_IDS = IdPool(Session)
+
+# entity to form copy plans, compiled once at import time
+CONFERENCE_PLAN = CopyPlan(Conference, ConferenceForm)
+SESSION_PLAN = CopyPlan(Session, SessionForm)
+PROFILE_PLAN = CopyPlan(Profile, ProfileForm, converters={
+    # convert t-shirt string to Enum
+    'teeShirtSize': lambda size: getattr(TeeShirtSize, size),
+})
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-CONFERENCE_DEFAULTS = {
-    "city": "Default City",
-    "maxAttendees": 0,
-    "seatsAvailable": 0,
-    "topics": [ "Default", "Topic" ],
-}
-
-SESSION_DEFAULTS = {
-    "highlights": [ "Free", "Beer"],
-    "duration": 0,
-    "typeOfSession": TypeOfSession.NOT_SPECIFIED,
-}
-
 OPERATORS = {
             'EQ':   '=',
             'GT':   '>',
@@ -76,6 +138,10 @@ OPERATORS = {
             'NE':   '!='
             }
 
+# page size for queries that do not supply a limit, and upper bound for all
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
 FIELDS =    {
             'CITY': 'city',
             'TOPIC': 'topics',
@@ -83,6 +149,53 @@ FIELDS =    {
             'MAX_ATTENDEES': 'maxAttendees',
             }
 
+SESSION_FIELDS = {
+            'NAME': 'name',
+            'TYPE': 'typeOfSession',
+            'SPEAKER': 'speakerUserId',
+            'HIGHLIGHTS': 'highlights',
+            'DURATION': 'duration',
+            'DATE': 'date',
+            'START_TIME': 'startTime',
+            }
+
+# convert filter values from strings to the property type
+CONFERENCE_FILTER_TYPES = {
+            'month': int,
+            'maxAttendees': int,
+            }
+
+SESSION_FILTER_TYPES = {
+            'typeOfSession': TypeOfSession,
+            'duration': int,
+            'date': lambda value: datetime.strptime(value[:10], "%Y-%m-%d").date(),
+            'startTime': lambda value: datetime.strptime(value[:5], "%H:%M").time(),
+            }
+
+
+def _secondsOfDay(t):
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+# the composite indexes deployed with the app; the planners only push down
+# the filters these serve
+INDEXES = loadIndexes(os.path.join(os.path.dirname(__file__), 'index.yaml'))
+# value ranges that let the planners pick the most selective inequality;
+# month is 0 for conferences without a start date
+CONFERENCE_PLANNER = QueryPlanner(Conference, domains={
+    'month': (0, 12),
+}, bounds={
+    # checked where conferences are written, see _checkBounds()
+    'month': (0, 12),
+    'maxAttendees': (0, None),
+}, order=Conference.name, indexes=INDEXES)
+SESSION_PLANNER = QueryPlanner(Session, domains={
+    'startTime': (time(0, 0), time(23, 59, 59), _secondsOfDay),
+    'duration': (0, 24 * 60),
+}, bounds={
+    # the range of TimeProperty values
+    'startTime': (time.min, time.max),
+}, indexes=INDEXES)
+
 
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
@@ -90,6 +203,36 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
 )
 
 
+CONF_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    limit=messages.IntegerField(2),
+    pageToken=messages.StringField(3),
+)
+
+
+PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    limit=messages.IntegerField(1),
+    pageToken=messages.StringField(2),
+)
+
+SEARCH_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    q=messages.StringField(1),
+    kind=messages.StringField(2),
+    limit=messages.IntegerField(3),
+    pageToken=messages.StringField(4),
+)
+
+SUGGEST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    prefix=messages.StringField(1),
+    field=messages.StringField(2),
+    limit=messages.IntegerField(3),
+)
+
+
 CONF_TYPE_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
@@ -103,6 +246,20 @@ CONF_POST_REQUEST = endpoints.ResourceContainer(
 )
 
 
+CONF_TOP_SPEAKERS_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    n=messages.IntegerField(2),
+)
+
+
+MIGRATION_POST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    name=messages.StringField(1),
+    cursor=messages.StringField(2),
+)
+
+
 SESSION_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeKey=messages.StringField(1),
@@ -113,50 +270,53 @@ SESSION_GET_REQUEST = endpoints.ResourceContainer(
 @endpoints.api(name='conference', version='v1', audiences=[ANDROID_AUDIENCE],
     allowed_client_ids=[WEB_CLIENT_ID, API_EXPLORER_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID],
     scopes=[EMAIL_SCOPE])
+@instrumentService
+@scopeService
 class ConferenceApi(remote.Service):
-    def _copyEventToForm(self, event, eventForm):
-        """
-        Generic method to copy events (so far conferences and sessions) into
-        their equivalent form
-        """
-        for field in eventForm.all_fields():
-            if hasattr(event, field.name):
-                # convert Date to date string; just copy others
-                if field.name.lower().endswith('date') or \
-                        field.name.lower().endswith('time'):
-                    setattr(eventForm, field.name,
-                            str(getattr(event, field.name)))
-                else:
-                    setattr(eventForm, field.name, getattr(event, field.name))
-            elif field.name == "websafeKey":
-                setattr(eventForm, field.name, event.key.urlsafe())
-        return eventForm
-
     def _get_user(self):
-        user = endpoints.get_current_user()
+        # token checks run once per request, see identity.py
+        user = identity.cached('user', endpoints.get_current_user)
         if not user:
             raise endpoints.UnauthorizedException('Authorization required')
         return user
 
-    def _copyConferenceToForm(self, conf, displayName):
+    def _getUserId(self):
+        return identity.cached('userId', lambda: getUserId(self._get_user()))
+
+    def _get_admin(self):
+        user = self._get_user()
+        if user.email() not in ADMIN_EMAILS:
+            raise endpoints.ForbiddenException('Admin access required')
+        return user
+
+    def _copyConferenceToForm(self, conf):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = self._copyEventToForm(conf, ConferenceForm())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+        return CONFERENCE_PLAN.copy(conf)
 
     def _copySessionToForm(self, session):
         """Copy relevant fields from Session to SessionForm."""
-        sf = self._copyEventToForm(session, SessionForm())
-        sf.check_initialized()
-        return sf
+        return SESSION_PLAN.copy(session)
+
+    def _copySessionsToForms(self, sessions):
+        """Copy a batch of Sessions into a SessionForms message."""
+        return SessionForms(items=SESSION_PLAN.copyAll(sessions))
+
+    @staticmethod
+    def _checkBounds(data):
+        """Reject conference values outside the bounds CONFERENCE_PLANNER
+        relies on to rule filters out."""
+        for field in CONFERENCE_PLANNER.bounds:
+            value = data.get(field)
+            if value is not None and \
+                    not CONFERENCE_PLANNER.inBounds(field, value):
+                raise endpoints.BadRequestException(
+                    "Conference '%s' is out of range" % field)
 
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
         user = self._get_user()
-        user_id = getUserId(user)
+        user_id = self._getUserId()
 
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
@@ -165,7 +325,6 @@ class ConferenceApi(remote.Service):
         data = {field.name: getattr(request, field.name)
                             for field in request.all_fields()}
         del data['websafeKey']
-        del data['organizerDisplayName']
         # add default values for those missing (both data model & outbound Message)
         for df in CONFERENCE_DEFAULTS:
             if data[df] in (None, []):
@@ -180,6 +339,7 @@ class ConferenceApi(remote.Service):
             data['month'] = 0
         if data['endDate']:
             data['endDate'] = datetime.strptime(data['endDate'][:10], "%Y-%m-%d").date()
+        self._checkBounds(data)
 
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
@@ -187,14 +347,23 @@ class ConferenceApi(remote.Service):
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
-        c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
-        c_key = ndb.Key(Conference, c_id, parent=p_key)
-        data['key'] = c_key
+        # an allocation, if the pool needs one, overlaps the profile read
+        c_key_future = CONFERENCE_IDS.reserve(p_key)
         data['organizerUserId'] = request.organizerUserId = user_id
+        # denormalized, kept up to date by saveProfile()
+        data['organizerDisplayName'] = request.organizerDisplayName = \
+            getattr(identity.get(p_key), 'displayName', None)
+        c_key = data['key'] = c_key_future.get_result()
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
+        conf = Conference(**data)
+        # the conference and its seat shards in one put_multi
+        identity.save(conf, *seats.newSeatShards(c_key, data['seatsAvailable']))
+        QUERY_CACHE.bump()
+        search.documentChanged(c_key)
+        typeahead.typeaheadChanged(c_key)
+        self._updateNearlySoldOut(conf, data['seatsAvailable'])
         taskqueue.add(params={'email': user.email(),
             'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email'
@@ -229,36 +398,88 @@ class ConferenceApi(remote.Service):
 
         # ID based on Conference key get Session key from ID
         c_key = ndb.Key(urlsafe=request.conferenceId)
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        s_key = ndb.Key(Session, s_id, parent=c_key)
-        data['key'] = s_key
+        # an allocation, if the pool needs one, overlaps the owner check
+        s_key_future = SESSION_IDS.reserve(c_key)
 
-        conference = ndb.Key(urlsafe=request.conferenceId).get()
+        conference = self._getConferenceAsync(request.conferenceId)
         user_profile = self._getProfileFromUser()
+        conference = conference.get_result()
         if user_profile.mainEmail != conference.organizerUserId:
             raise endpoints.InternalServerErrorException(
                 "Only conference creator can add sessions")
-
-        taskqueue.add(params={
-            'speaker_email': request.speakerUserId,
-            'conference_id': request.conferenceId
-            },
-            url='/tasks/update_featured_speaker'
-        )
+        data['key'] = s_key_future.get_result()
 
         self._do_create_session(data, request.conferenceId)
         return request
 
     @ndb.transactional()
     def _do_create_session(self, session_data, conferenceId):
-        # change from review: fetch the conference object INSIDE the transaction
-        conference = ndb.Key(urlsafe=conferenceId).get()
-        conference.put()
-        Session(**session_data).put()
+        # the session's parent key puts it in the conference's entity group,
+        # the conference itself is neither read nor rewritten
+        session = Session(**session_data)
+        agenda.agendaChanged(session.key.parent())
+        search.documentChanged(session.key)
+        speaker = session.speakerUserId
+        if not speaker:
+            identity.save(session)
+            return
+        # count the session for its speaker in the same transaction
+        speakers = self._getSpeakerCounts(session.key.parent())
+        speakers.counts[speaker] = speakers.counts.get(speaker, 0) + 1
+        identity.save(session, speakers)
+        if speakers.counts[speaker] >= 2:
+            # only runs if the transaction commits
+            taskqueue.add(params={
+                'speaker_email': speaker,
+                'conference_id': conferenceId
+                },
+                url='/tasks/update_featured_speaker',
+                transactional=True
+            )
 
     @ndb.transactional()
+    def _do_delete_session(self, session_key):
+        # one batch get for the session and the speaker counts, which
+        # _getSpeakerCounts() then finds in the context cache
+        session, _ = ndb.get_multi([
+            session_key, ndb.Key(SpeakerCounts, 1, parent=session_key.parent())])
+        if not session:
+            return False
+        speaker = session.speakerUserId
+        if speaker:
+            speakers = self._getSpeakerCounts(session_key.parent())
+            if speakers.counts.get(speaker, 0) > 1:
+                speakers.counts[speaker] -= 1
+            else:
+                speakers.counts.pop(speaker, None)
+            identity.save(speakers)
+        session_key.delete()
+        agenda.agendaChanged(session_key.parent())
+        search.documentChanged(session_key)
+        return True
+
+    @staticmethod
+    def _deleteWishlistEntries(session_key):
+        """Remove a deleted session from every wishlist."""
+        entries = WishlistEntry.query(
+            WishlistEntry.session == session_key).fetch(keys_only=True)
+        ndb.delete_multi(entries)
+
     def _updateConferenceObject(self, request):
-        user_id = getUserId(self._get_user())
+        cf = self._do_update_conference(request)
+        # invalidate once the transaction has been committed
+        CONFERENCE_CACHE.delete(cf.websafeKey)
+        QUERY_CACHE.bump()
+        if request.seatsAvailable is not None:
+            conf_key = ndb.Key(urlsafe=cf.websafeKey)
+            seats.seatsChanged(conf_key)
+            self._updateNearlySoldOut(conf_key.get(), cf.seatsAvailable)
+        return cf
+
+    # cross-group: a seatsAvailable update rewrites the seat shards
+    @ndb.transactional(xg=True)
+    def _do_update_conference(self, request):
+        user_id = self._getUserId()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
@@ -273,8 +494,20 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        shards = []
         for field in request.all_fields():
             data = getattr(request, field.name)
+            # the organizer name is owned by the organizer's profile
+            if field.name == 'organizerDisplayName':
+                continue
+            # seats are owned by the seat shards, see seats.py
+            if field.name == 'seatsAvailable':
+                if data is not None:
+                    if data < 0:
+                        raise endpoints.BadRequestException(
+                            'seatsAvailable can not be negative.')
+                    shards = seats.resetSeats(conf, data)
+                continue
             # only copy fields where we get data
             if data not in (None, []):
                 # special handling for dates (convert string to Date)
@@ -284,9 +517,14 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
-        conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        self._checkBounds(conf.to_dict())
+        changed = conf.isDirty()
+        # the conference and the shards it got new seats from, one put_multi
+        identity.save(conf, *shards)
+        if changed:
+            search.documentChanged(conf.key)
+            typeahead.typeaheadChanged(conf.key)
+        return self._copyConferenceToForm(conf)
 
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
@@ -309,11 +547,83 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
-        # get Conference object from request; bail if not found
-        conf = self._getConference(request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        wsck = ndb.Key(urlsafe=request.websafeConferenceKey).urlsafe()
+        cf = CONFERENCE_CACHE.get(wsck)
+        if cf is None:
+            # get Conference object from request; bail if not found
+            cf, available = self._getConferenceFormAsync(wsck).get_result()
+            CONFERENCE_CACHE.set(wsck, cf)
+        else:
+            # seatsAvailable comes from the (separately cached) seat shards
+            available = seats.getSeatsAvailable({wsck: cf.seatsAvailable})
+        cf.seatsAvailable = available[wsck]
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return cf
+
+
+    @ndb.tasklet
+    def _getConferenceFormAsync(self, wsck):
+        """Return (ConferenceForm, seats available) for wsck; the seat count
+        lookup runs while the conference is read, and only waits for it when
+        the counts are not cached."""
+        conf_future = self._getConferenceAsync(wsck)
+
+        @ndb.tasklet
+        def stored():
+            conf = yield conf_future
+            raise ndb.Return(conf.seatsAvailable)
+
+        conf, available = yield (conf_future,
+                                 seats.getSeatsAvailableAsync({wsck: stored()}))
+        raise ndb.Return(self._copyConferenceToForm(conf), available)
+
+
+    @endpoints.method(message_types.VoidMessage, CacheStatsForms,
+            path='cache/stats',
+            http_method='GET', name='getCacheStats')
+    def getCacheStats(self, request):
+        """Return hit/miss counters of this instance's caches (admin
+        only)."""
+        self._get_admin()
+        return CacheStatsForms(items=[CacheStatsForm(**cache.stats())
+                                      for cache in (CONFERENCE_CACHE, QUERY_CACHE)])
+
+
+    @endpoints.method(message_types.VoidMessage, MethodStatsForms,
+            path='admin/methodStats',
+            http_method='GET', name='getMethodStats')
+    def getMethodStats(self, request):
+        """Return this instance's rolling per-method latency histograms and
+        RPC counts (admin only)."""
+        self._get_admin()
+        return MethodStatsForms(items=[MethodStatsForm(
+            method=stats['method'],
+            requests=stats['requests'],
+            meanMs=stats['meanMs'],
+            p95Ms=stats['p95Ms'],
+            buckets=[LatencyBucketForm(upperMs=upper, count=n)
+                     for upper, n in stats['buckets']],
+            rpcs=[RpcStatsForm(name=rpc, count=n, totalMs=ms)
+                  for rpc, (n, ms) in sorted(stats['rpcs'].items())],
+            counters=[CounterForm(name=counter, value=n)
+                      for counter, n in sorted(stats['counters'].items())],
+            nPlusOne=stats['nPlusOne'],
+        ) for stats in instrumentation.getMethodStats()])
+
+
+    @endpoints.method(MIGRATION_POST_REQUEST, MigrationForm,
+            path='admin/migrations/{name}',
+            http_method='POST', name='startMigration')
+    def startMigration(self, request):
+        """Start (or resume from cursor) a datastore migration (admin only)."""
+        self._get_admin()
+        try:
+            migrations.startMigration(request.name, request.cursor)
+        except KeyError:
+            raise endpoints.NotFoundException(
+                'No migration named %s, available: %s' % (
+                    request.name, ', '.join(migrations.migrationNames())))
+        return MigrationForm(name=request.name, cursor=request.cursor)
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
@@ -322,21 +632,19 @@ class ConferenceApi(remote.Service):
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user_id = getUserId(self._get_user())
+        user_id = self._getUserId()
 
         # create ancestor query for all key matches for this user
         confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
+            items=[self._copyConferenceToForm(conf) for conf in confs]
         )
 
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
+    def _getQuery(self, filters, inequality_filter=None):
+        """Return query from the formatted filters."""
         q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
 
         # If exists, sort on inequality filter first
         if not inequality_filter:
@@ -344,41 +652,71 @@ class ConferenceApi(remote.Service):
         else:
             q = q.order(ndb.GenericProperty(inequality_filter))
             q = q.order(Conference.name)
+        recordQuery('Conference', filters,
+                    [o for o in (inequality_filter, 'name') if o])
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
         return q
 
 
-    def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
+    def _formatFilters(self, filters, fields=FIELDS,
+                       types=CONFERENCE_FILTER_TYPES,
+                       planner=CONFERENCE_PLANNER):
+        """Parse, check validity and format user supplied filters, in the
+        canonical form of planner.normalize(), which takes any number of
+        inequalities. The filters are None when they contradict each other
+        and no entity can match."""
         formatted_filters = []
-        inequality_field = None
 
         for f in filters:
             filtr = {field.name: getattr(f, field.name) for field in f.all_fields()}
 
             try:
-                filtr["field"] = FIELDS[filtr["field"]]
+                filtr["field"] = fields[filtr["field"]]
                 filtr["operator"] = OPERATORS[filtr["operator"]]
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException("Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
-
+            if filtr["field"] in types:
+                try:
+                    filtr["value"] = types[filtr["field"]](filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Invalid value for filter on %s." % filtr["field"])
             formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+
+        return planner.normalize(formatted_filters)
+
+
+    def _pageLimit(self, limit):
+        """Unpaged requests get DEFAULT_PAGE_SIZE results, no page exceeds
+        MAX_PAGE_SIZE."""
+        limit = min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        if limit < 0:
+            raise endpoints.BadRequestException("Invalid limit.")
+        return limit
+
+
+    def _fetchPage(self, query, limit, pageToken, keys_only=False):
+        """Run query once for a single page, returning (results, nextPageToken)."""
+        limit = self._pageLimit(limit)
+        try:
+            cursor = Cursor(urlsafe=pageToken) if pageToken else None
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        results, cursor, more = query.fetch_page(limit, start_cursor=cursor,
+                                                 keys_only=keys_only)
+        return results, (cursor.urlsafe() if more and cursor else None)
+
+
+    def _fetchPlanPage(self, plan, limit, pageToken):
+        """Run a query plan for a single page, returning (results, nextPageToken)."""
+        try:
+            return plan.fetchPage(self._pageLimit(limit), pageToken)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
 
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
@@ -387,51 +725,87 @@ class ConferenceApi(remote.Service):
             name='queryConferences')
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        filters = self._formatFilters(request.filters)
+        if filters is None:
+            # contradictory filters, nothing to ask Datastore for
+            return ConferenceForms(items=[])
+        key = self._queryCacheKey(filters, self._pageLimit(request.limit),
+                                  request.pageToken)
+        generation = QUERY_CACHE.generation()
+        # anonymous callers may get the previous result while it is rebuilt
+        stale = STALE_WHILE_REVALIDATE and \
+            identity.cached('user', endpoints.get_current_user) is None
+        forms = QUERY_CACHE.get(key, generation, stale=stale)
+        if forms is None:
+            forms = self._queryConferences(request, filters)
+            QUERY_CACHE.set(key, generation, forms)
+
+        # seats are not part of the cached page, registrations don't need
+        # to invalidate it
+        available = seats.getSeatsAvailable(
+            dict((cf.websafeKey, cf.seatsAvailable) for cf in forms.items))
+        for cf in forms.items:
+            cf.seatsAvailable = available[cf.websafeKey]
+        return forms
+
+
+    def _queryConferences(self, request, filters):
+        inequality_fields = set(f["field"] for f in filters if f["operator"] != "=")
+        if not CONFERENCE_PLANNER.pushesDown(filters):
+            # Datastore takes one inequality property, ndb runs != as two
+            # merged queries that can't be paged with cursors, and filters
+            # need indexes: the planner applies the rest in memory
+            conferences, nextPageToken = self._fetchPlanPage(
+                CONFERENCE_PLANNER.plan(filters), request.limit, request.pageToken)
+        else:
+            conferences, nextPageToken = self._fetchPage(
+                self._getQuery(filters, next(iter(inequality_fields), None)),
+                request.limit, request.pageToken)
 
         # return individual ConferenceForm object per Conference
         return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+            items=[self._copyConferenceToForm(conf) for conf in conferences],
+            nextPageToken=nextPageToken
         )
 
 
+    @staticmethod
+    def _queryCacheKey(filters, limit, pageToken):
+        """Cache key of a queryConferences page, from filters in canonical
+        form."""
+        canonical = json.dumps([
+            [(f["field"], f["operator"], f["value"]) for f in filters],
+            limit, pageToken], default=str)
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
-    def _copyProfileToForm(self, prof):
+    def _copyProfileToForm(self, prof, reg_keys, wish_keys):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
+        pf = PROFILE_PLAN.copy(prof)
+        # registrations and wishlist entries are child entities, their ids
+        # are the websafe keys
+        pf.conferenceKeysToAttend = [reg.id() for reg in reg_keys]
+        pf.sessionWishlist = [entry.id() for entry in wish_keys]
         return pf
 
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
+        return self._getProfileFromUserAsync().get_result()
+
+
+    @ndb.tasklet
+    def _getProfileFromUserAsync(self):
         # make sure user is authed
         user = self._get_user()
 
         # get Profile from datastore
-        p_key = ndb.Key(Profile, getUserId(user))
-        profile = p_key.get()
-        # create new Profile if not there
+        p_key = ndb.Key(Profile, self._getUserId())
+        profile = yield identity.getAsync(p_key)
+        # create new Profile if not there; it is written by the caller's
+        # identity.save(), along with its other changes
         if not profile:
             profile = Profile(
                 key=p_key,
@@ -441,18 +815,22 @@ class ConferenceApi(remote.Service):
                 sessionWishlist=[]
 
             )
-            profile.put()
 
-        return profile      # return Profile
+        raise ndb.Return(profile)      # return Profile
 
 
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
+        # the registrations and wishlist are listed while the profile is read
+        p_key = ndb.Key(Profile, self._getUserId())
+        reg_keys = Registration.query(ancestor=p_key).fetch_async(keys_only=True)
+        wish_keys = WishlistEntry.query(ancestor=p_key).fetch_async(keys_only=True)
         # get user Profile
         prof = self._getProfileFromUser()
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            displayName = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -462,10 +840,15 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         #else:
                         #    setattr(prof, field, val)
-                        prof.put()
+            # conferences carry a copy of the organizer displayName
+            if prof.displayName != displayName:
+                self._enqueueOrganizerNameUpdate(prof.key.id())
+        # one write, and none if nothing changed and the profile existed
+        identity.save(prof)
 
         # return ProfileForm
-        return self._copyProfileToForm(prof)
+        return self._copyProfileToForm(prof, reg_keys.get_result(),
+                                       wish_keys.get_result())
 
 
     @endpoints.method(message_types.VoidMessage, ProfileForm,
@@ -482,32 +865,138 @@ class ConferenceApi(remote.Service):
         return self._doProfile(request)
 
 
+    @staticmethod
+    def _enqueueOrganizerNameUpdate(user_id, cursor=None):
+        """Queue the task copying the organizer's displayName onto their
+        conferences, from cursor on."""
+        taskqueue.add(params={'userId': user_id, 'cursor': cursor or ''},
+            url='/tasks/update_organizer_name'
+        )
+
+
+    @staticmethod
+    def _updateOrganizerName(user_id, cursor=None):
+        """Copy the organizer's current displayName onto one batch of their
+        conferences and chain the task for the next batch.
+
+        The name is read when the task runs, so the last of several renames
+        wins whatever order the tasks run in.
+        """
+        p_key = ndb.Key(Profile, user_id)
+        prof = p_key.get()
+        if not prof:
+            return
+        start = Cursor(urlsafe=cursor) if cursor else None
+        conf_keys, next_cursor, more = Conference.query(ancestor=p_key).fetch_page(
+            ORGANIZER_NAME_BATCH_SIZE, keys_only=True, start_cursor=start)
+        changed = ConferenceApi._do_set_organizer_name(conf_keys, prof.displayName)
+        CONFERENCE_CACHE.delete_multi(key.urlsafe() for key in changed)
+        if changed:
+            QUERY_CACHE.bump()
+        if more and next_cursor:
+            ConferenceApi._enqueueOrganizerNameUpdate(user_id, next_cursor.urlsafe())
+
+
+    @staticmethod
+    @ndb.transactional()
+    def _do_set_organizer_name(conf_keys, displayName):
+        """Set organizerDisplayName on conf_keys, returning the keys of the
+        conferences that changed. The conferences of one organizer share its
+        entity group, so this doesn't race with updateConference()."""
+        confs = [conf for conf in ndb.get_multi(conf_keys)
+                 if conf and conf.organizerDisplayName != displayName]
+        for conf in confs:
+            conf.organizerDisplayName = displayName
+        ndb.put_multi(confs)
+        return [conf.key for conf in confs]
+
+
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Rebuild the nearly sold out set & announcement from scratch;
+        used by the repair cron job. Registrations keep both up to date
+        in between, see _updateNearlySoldOut().
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
+        key = ndb.Key(NearlySoldOut, 1)
+        record = key.get()
+        previous = record.conferences if record else {}
+
+        # Conference.seatsAvailable lags the seat shards by up to
+        # RECONCILE_DELAY, so check the candidates, and the current members,
+        # against the shards
+        q = Conference.query(ndb.AND(
+            Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
+            Conference.seatsAvailable > 0))
+        candidates, cursor, more = {}, None, True
+        while more:
+            confs, cursor, more = q.fetch_page(
+                MAX_PAGE_SIZE, start_cursor=cursor,
+                projection=[Conference.name, Conference.seatsAvailable])
+            for conf in confs:
+                candidates[conf.key.urlsafe()] = conf
+        for conf in ndb.get_multi([ndb.Key(urlsafe=wsck) for wsck in previous
+                                   if wsck not in candidates]):
+            if conf:
+                candidates[conf.key.urlsafe()] = conf
+
+        available = seats.getSeatsAvailable(
+            dict((wsck, conf.seatsAvailable) for wsck, conf in candidates.items()))
+        conferences = dict(
+            (wsck, conf.name) for wsck, conf in candidates.items()
+            if 0 < available[wsck] <= NEARLY_SOLD_OUT_SEATS)
+        if conferences != previous:
+            NearlySoldOut(key=key, conferences=conferences).put()
+        return ConferenceApi._setAnnouncement(conferences)
 
-        if confs:
+    @staticmethod
+    def _setAnnouncement(conferences):
+        """Format the announcement for the nearly sold out conferences
+        (websafe key -> name) & assign it to memcache."""
+        if conferences:
             # If there are almost sold out conferences,
             # format announcement and set it in memcache
             announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
+                ', '.join(sorted(conferences.values())))
             memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
         else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
+            # If there are no sold out conferences, cache the empty
+            # announcement so getAnnouncement() does not rebuild it
             announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
 
         return announcement
 
+    @staticmethod
+    def _updateNearlySoldOut(conf, available):
+        """Add conf to, or remove it from, the nearly sold out set when its
+        available seats crossed NEARLY_SOLD_OUT_SEATS."""
+        wsck = conf.key.urlsafe()
+        nearly = 0 < available <= NEARLY_SOLD_OUT_SEATS
+        # cheap check first, ndb serves the record from memcache
+        record = ndb.Key(NearlySoldOut, 1).get()
+        if record and (wsck in record.conferences) == nearly:
+            return
+        conferences = ConferenceApi._do_update_nearly_sold_out(
+            wsck, conf.name, nearly)
+        if conferences is not None:
+            ConferenceApi._setAnnouncement(conferences)
+
+    @staticmethod
+    @ndb.transactional()
+    def _do_update_nearly_sold_out(wsck, name, nearly):
+        key = ndb.Key(NearlySoldOut, 1)
+        record = key.get() or NearlySoldOut(key=key, conferences={})
+        if (wsck in record.conferences) == nearly:
+            return None
+        if nearly:
+            record.conferences[wsck] = name
+        else:
+            del record.conferences[wsck]
+        record.put()
+        return record.conferences
+
     @staticmethod
     def _featuredSpeakerAnnouncement(email):
         key = 'FEATURED SPEAKER'
@@ -527,100 +1016,173 @@ class ConferenceApi(remote.Service):
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if announcement is None:
+            # evicted, rebuild it from the nearly sold out set
+            record = ndb.Key(NearlySoldOut, 1).get()
+            announcement = self._setAnnouncement(
+                record.conferences if record else {})
+        return StringMessage(data=announcement)
 
     @staticmethod
     def _isNewFeaturedSpeaker(userEmail, conferenceId):
-        # this method is supposed to be called during a session creation, just
-        # before persisting the data.
-        # 1- get sessions from a particular profile in that conference
-        # 2- If it has at least one, set as new featured speaker (added to the
-        # session which is about to be created it will have at least two)
-        if len(ConferenceApi._sessionsAsSpeaker(conferenceId, userEmail)) >= 1:
-            return True
-        return False
+        # this method is called by a task enqueued once a session has been
+        # created; a speaker with at least two sessions in that conference
+        # is the new featured speaker
+        speakers = ConferenceApi._getSpeakerCounts(
+            ndb.Key(urlsafe=conferenceId))
+        return speakers.counts.get(userEmail, 0) >= 2
 
     @staticmethod
-    def _sessionsAsSpeaker(websafeConferenceKey, userEmail):
-        # returns in which sessions the user has been a speaker for that conf
-        # changed after code review
-        q = Session.query()
-        q = q.filter(Session.conferenceId == websafeConferenceKey)
-        q = q.filter(Session.speakerUserId == userEmail)
-        return [s for s in q]
+    def _countSpeakers(conf_key):
+        """Return speaker -> number of sessions of conf_key, counted from
+        its sessions."""
+        counts = {}
+        for session in Session.query(ancestor=conf_key):
+            if session.speakerUserId:
+                counts[session.speakerUserId] = \
+                    counts.get(session.speakerUserId, 0) + 1
+        return counts
+
+    @staticmethod
+    @ndb.transactional()
+    def _getSpeakerCounts(conf_key):
+        # returns the conference's speaker -> number of sessions counts,
+        # building them for conferences that had sessions before counts were
+        # kept (joins the caller's transaction if there is one); only the
+        # session writes and the featured speaker task call it
+        key = ndb.Key(SpeakerCounts, 1, parent=conf_key)
+        speakers = key.get()
+        if speakers is None:
+            speakers = SpeakerCounts(
+                key=key, counts=ConferenceApi._countSpeakers(conf_key))
+            speakers.put()
+        return speakers
+
+    @endpoints.method(CONF_TOP_SPEAKERS_REQUEST, SpeakerForms,
+            path='conference/{websafeConferenceKey}/topSpeakers',
+            http_method='GET', name='getTopSpeakers')
+    def getTopSpeakers(self, request):
+        """ Returns the n speakers with most sessions in a conference """
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        n = min(request.n or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        conf, speakers = None, None
+        if conf_key.kind() == 'Conference':
+            conf, speakers = ndb.get_multi(
+                [conf_key, ndb.Key(SpeakerCounts, 1, parent=conf_key)])
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s'
+                % request.websafeConferenceKey)
+        # a read never writes: counts missing for conferences older than
+        # them are built by the next session write
+        counts = speakers.counts if speakers else \
+            self._countSpeakers(conf_key)
+        top = heapq.nlargest(n, counts.items(), key=lambda item: item[1])
+        return SpeakerForms(items=[SpeakerForm(speakerUserId=speaker,
+                                               sessions=sessions)
+                                   for speaker, sessions in top])
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser() # get user Profile
-
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
-        wsck = request.websafeConferenceKey
-        conf = self._getConference(wsck)
+        conf = self._getConference(request.websafeConferenceKey)
+
+        # seats live in shards, try them one at a time until one has a seat
+        for shard_key in seats.candidateShardKeys(conf, reg):
+            retval = self._do_registration(conf, reg, shard_key)
+            if retval is not None:
+                break
+        else:
+            raise ConflictException(
+                "There are no seats available.")
+
+        # seatsAvailable changed, once committed
+        if retval.data:
+            seats.seatsChanged(conf.key)
+            wsck = conf.key.urlsafe()
+            self._updateNearlySoldOut(conf, seats.getSeatsAvailable(
+                {wsck: conf.seatsAvailable})[wsck])
+        return retval
+
+    @ndb.transactional(xg=True)
+    def _do_registration(self, conf, reg, shard_key):
+        p_key = ndb.Key(Profile, self._getUserId())
+        reg_key = ndb.Key(Registration, conf.key.urlsafe(), parent=p_key)
+        # the profile, registration and shard reads go out together
+        prof = self._getProfileFromUserAsync() # get user Profile
+        registration, shard = ndb.get_multi([reg_key, shard_key])
+        prof = prof.get_result()
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registration:
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
+            # check if seats avail; None lets the caller try another shard
+            if shard.seatsAvailable <= 0:
+                return None
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
+            shard.seatsAvailable -= 1
+            # a new profile is written along
+            identity.save(prof, Registration(key=reg_key, conference=conf.key),
+                          shard)
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if not registration:
+                return BooleanMessage(data=False)
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
+            # unregister user, add back one seat
+            shard.seatsAvailable += 1
+            identity.save(shard)
+            reg_key.delete()
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+        return BooleanMessage(data=True)
 
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    @endpoints.method(PAGE_REQUEST, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
-        prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        p_key = ndb.Key(Profile, self._getUserId())
+        reg_keys, nextPageToken = self._fetchPage(
+            Registration.query(ancestor=p_key), request.limit,
+            request.pageToken, keys_only=True)
+        conferences = ndb.get_multi([ndb.Key(urlsafe=reg.id()) for reg in reg_keys])
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
+        return ConferenceForms(items=[self._copyConferenceToForm(conf)
+         for conf in conferences if conf], nextPageToken=nextPageToken
         )
 
 
+    @endpoints.method(CONF_PAGE_REQUEST, AttendeeForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """Return a page of the user ids registered for a conference; only
+        its organizer may list them."""
+        user_id = self._getUserId()
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        if conf_key.parent() is None or conf_key.parent().id() != user_id:
+            raise endpoints.ForbiddenException(
+                'Only the owner can list the attendees.')
+        reg_keys, nextPageToken = self._fetchPage(
+            Registration.query(Registration.conference == conf_key),
+            request.limit, request.pageToken, keys_only=True)
+        return AttendeeForms(attendees=[reg.parent().id() for reg in reg_keys],
+                             nextPageToken=nextPageToken)
+
+
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
             path='conference/{websafeConferenceKey}',
             http_method='POST', name='registerForConference')
@@ -653,7 +1215,7 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.month==6)
 
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=[self._copyConferenceToForm(conf) for conf in q]
         )
 
     ########################################################################
@@ -661,19 +1223,53 @@ class ConferenceApi(remote.Service):
     ########################################################################
 
     def _getConference(self, urlsafeKey):
-        conference = ndb.Key(urlsafe=urlsafeKey).get()
+        return self._getConferenceAsync(urlsafeKey).get_result()
+
+    @ndb.tasklet
+    def _getConferenceAsync(self, urlsafeKey):
+        conference = yield identity.getAsync(ndb.Key(urlsafe=urlsafeKey))
         if not conference:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % urlsafeKey)
+        raise ndb.Return(conference)
 
     @endpoints.method(CONF_GET_REQUEST, SessionForms,
             path='conference/{websafeConferenceKey}/sessions',
             http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
         """ Given a conference, return all its sessions """
-        q = Session.query()
-        q = q.filter(Session.conferenceId == request.websafeConferenceKey)
-        return SessionForms(items=[self._copySessionToForm(s) for s in q])
+        q = Session.query(ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+        return self._copySessionsToForms(q)
+
+    @endpoints.method(CONF_GET_REQUEST, AgendaForm,
+            path='conference/{websafeConferenceKey}/agenda',
+            http_method='GET', name='getConferenceAgenda')
+    def getConferenceAgenda(self, request):
+        """ Given a conference, return its sessions grouped by date and
+        ordered by startTime """
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        form = agenda.getAgenda(conf_key)
+        if form is None:
+            # no snapshot yet, or a rebuild is pending
+            self._getConference(request.websafeConferenceKey)
+            form = self._buildAgenda(conf_key)
+        return form
+
+    @staticmethod
+    @ndb.transactional()
+    def _buildAgenda(conf_key):
+        """Build and store the agenda of a conference. The sessions are
+        queried in the transaction, so a concurrent session write makes one
+        of the two retry instead of leaving a stale snapshot."""
+        sessions = Session.query(ancestor=conf_key).fetch()
+        sessions.sort(key=agenda.sessionOrder)
+        form = AgendaForm(days=[
+            AgendaDayForm(date=str(day) if day else None,
+                          items=SESSION_PLAN.copyAll(group))
+            for day, group in itertools.groupby(sessions,
+                                                key=lambda s: s.date)])
+        agenda.storeAgenda(conf_key, form)
+        return form
 
     @endpoints.method(CONF_TYPE_GET_REQUEST, SessionForms,
             path='conference/{websafeConferenceKey}/sessionsByType/{sessionType}',
@@ -684,10 +1280,11 @@ class ConferenceApi(remote.Service):
 
         conference, session_type = request.websafeConferenceKey,\
                                    request.sessionType
-        q = Session.query()
-        q = q.filter(Session.conferenceId == conference)
+        q = Session.query(ancestor=ndb.Key(urlsafe=conference))
         q = q.filter(Session.typeOfSession == TypeOfSession(session_type))
-        return SessionForms(items=[self._copySessionToForm(s) for s in q])
+        recordQuery('Session', [{"field": "typeOfSession", "operator": "="}],
+                    ancestor=True)
+        return self._copySessionsToForms(q)
 
     @endpoints.method(SESSION_GET_REQUEST, SessionForms,
             path='session/speaker/{websafeKey}',
@@ -698,91 +1295,231 @@ class ConferenceApi(remote.Service):
         # changed after code review
         q = Session.query()
         q = q.filter(Session.speakerUserId == request.websafeKey)
-        return SessionForms(items=[self._copySessionToForm(s) for s in q])
+        recordQuery('Session', [{"field": "speakerUserId", "operator": "="}])
+        return self._copySessionsToForms(q)
 
     @endpoints.method(SessionForm, SessionForm, path='session',
             http_method='POST', name='createSession')
     def createSession(self, sessionForm):
         return self._createSessionObject(sessionForm)
 
+    @endpoints.method(SESSION_GET_REQUEST, BooleanMessage,
+            path='session/{websafeKey}',
+            http_method='DELETE', name='deleteSession')
+    def deleteSession(self, request):
+        """ Deletes a session, only the conference owner can do it """
+        user_id = self._getUserId()
+        session_key = ndb.Key(urlsafe=request.websafeKey)
+        conf = self._getConference(session_key.parent().urlsafe())
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete sessions.')
+        deleted = self._do_delete_session(session_key)
+        if deleted:
+            self._deleteWishlistEntries(session_key)
+        return BooleanMessage(data=deleted)
+
+    def _wishlistKeys(self, websafeKeys):
+        """Return (session keys, wishlist entry keys) for websafe session
+        keys, without duplicates."""
+        if len(websafeKeys) > MAX_PAGE_SIZE:
+            raise endpoints.BadRequestException(
+                'At most %d sessions per request.' % MAX_PAGE_SIZE)
+        p_key = ndb.Key(Profile, self._getUserId())
+        session_keys = [ndb.Key(urlsafe=k) for k in sorted(set(websafeKeys))]
+        if any(k.kind() != 'Session' for k in session_keys):
+            raise endpoints.BadRequestException('Invalid session key.')
+        return session_keys, [ndb.Key(WishlistEntry, k.urlsafe(), parent=p_key)
+                              for k in session_keys]
+
+    def _addToWishlist(self, websafeKeys):
+        """Add sessions to the user wishlist. The sessions and the entries
+        are read with one batch get and the missing entries written with one
+        put_multi; entry keys are derived from the session keys, so adding
+        a session twice is a no-op. Returns the sessions found."""
+        session_keys, entry_keys = self._wishlistKeys(websafeKeys)
+        entities = ndb.get_multi(session_keys + entry_keys)
+        sessions, entries = entities[:len(session_keys)], entities[len(session_keys):]
+        new = [WishlistEntry(key=entry_key, session=session.key,
+                             conference=session.key.parent())
+               for session, entry_key, entry in zip(sessions, entry_keys, entries)
+               if session and not entry]
+        if new:
+            ndb.put_multi(new)
+        return [session for session in sessions if session]
+
     @endpoints.method(SESSION_GET_REQUEST, SessionForm,
             path='profile/wishlist/{websafeKey}',
             http_method='POST', name='addSessionToWishlist')
-    @ndb.transactional()
     def addSessionToWishlist(self, request):
         """ Adds a session to the user wishlist """
-        key = request.websafeKey
-        profile = self._getProfileFromUser()
-        if not getattr(profile, 'sessionWishList', None):
-            profile.sessionWishlist = [key]
-        else:
-            # Changed after code review: check if it is a duplicate
-            if key in profile.sessionWishlist:
-                # no need to return an error, just return the existing one
-                return self._copySessionToForm(ndb.Key(urlsafe=key).get())
-            profile.sessionWishlist.append(key)
-        profile.put()
-        return self._copySessionToForm(ndb.Key(urlsafe=key).get())
+        sessions = self._addToWishlist([request.websafeKey])
+        if not sessions:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % request.websafeKey)
+        return self._copySessionToForm(sessions[0])
+
+    @endpoints.method(WishlistForm, WishlistForm,
+            path='wishlist/add',
+            http_method='POST', name='addSessionsToWishlist')
+    def addSessionsToWishlist(self, request):
+        """ Adds several sessions to the user wishlist, returns the keys of
+        the sessions that exist """
+        sessions = self._addToWishlist(request.websafeSessionKeys)
+        return WishlistForm(
+            websafeSessionKeys=[session.key.urlsafe() for session in sessions])
+
+    @endpoints.method(WishlistForm, WishlistForm,
+            path='wishlist/remove',
+            http_method='POST', name='removeSessionsFromWishlist')
+    def removeSessionsFromWishlist(self, request):
+        """ Removes several sessions from the user wishlist, returns the keys
+        of the sessions that were on it """
+        session_keys, entry_keys = self._wishlistKeys(request.websafeSessionKeys)
+        entries = [entry for entry in ndb.get_multi(entry_keys) if entry]
+        if entries:
+            ndb.delete_multi([entry.key for entry in entries])
+        return WishlistForm(
+            websafeSessionKeys=[entry.key.id() for entry in entries])
 
     @endpoints.method(CONF_GET_REQUEST, SessionForms,
             path='profile/wishlist/{websafeConferenceKey}',
             http_method='GET', name='getSessionsInWishlist')
     def getSessionsInWishlist(self, request):
         """ Returns the user wishlist for a specific conference """
-        conferenceId = request.websafeConferenceKey
-        profile = self._getProfileFromUser()
-        # changed after code review
-        sessions = ndb.get_multi([ndb.Key(urlsafe=s) for s in profile.sessionWishlist])
-        return SessionForms(items=[self._copySessionToForm(s) for s in sessions
-                                   if s.conferenceId == conferenceId])
+        conf_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        # wishlist entries are children of the profile: one ancestor query
+        # (built-in indexes) lists this conference's entries only
+        entries = WishlistEntry.query(
+            WishlistEntry.conference == conf_key,
+            ancestor=ndb.Key(Profile, self._getUserId())).fetch(keys_only=True)
+        sessions = ndb.get_multi([ndb.Key(urlsafe=entry.id())
+                                  for entry in entries])
+        return self._copySessionsToForms(s for s in sessions if s)
+
+    @endpoints.method(SEARCH_REQUEST, SearchResultForms,
+            path='search', http_method='GET', name='search')
+    def search(self, request):
+        """ Full-text search of conference names, descriptions and topics
+        and session names and highlights, best matches first. kind limits
+        the results to Conference or Session. """
+        if request.kind not in (None, 'Conference', 'Session'):
+            raise endpoints.BadRequestException("Invalid kind.")
+        limit = self._pageLimit(request.limit)
+        try:
+            offset = int(request.pageToken or 0)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        hits, total = search.search(request.q, request.kind, limit, offset)
+        # documents deleted since they were indexed are left out
+        entities = ndb.get_multi([ndb.Key(urlsafe=wsk) for wsk, _ in hits])
+        return SearchResultForms(
+            items=[SearchResultForm(websafeKey=wsk, kind=entity.key.kind(),
+                                    name=entity.name, score=score)
+                   for (wsk, score), entity in zip(hits, entities) if entity],
+            nextPageToken=str(offset + limit) if offset + limit < total else None)
+
+    @endpoints.method(SUGGEST_REQUEST, SuggestionForms,
+            path='suggest', http_method='GET', name='suggest')
+    def suggest(self, request):
+        """ Autocomplete conference names, cities and topics: the values
+        starting with prefix, limit per field (name, city or topics, all
+        three if not given). Served from memory, no datastore query. """
+        if request.field not in (None,) + typeahead.FIELDS:
+            raise endpoints.BadRequestException("Invalid field.")
+        return SuggestionForms(items=[
+            SuggestionForm(field=field, value=value)
+            for field, value in typeahead.suggest(
+                request.prefix, request.field, self._pageLimit(request.limit))])
 
     @endpoints.method(message_types.VoidMessage, SessionForms,
             path='filterPlayground/after7',
             http_method='GET', name='sessionsAfter7pm')
     def sessionsAfter7pm(self, request):
-        """ Returns all non-workshop sessions that take place after 7pm.
+        """ Returns the first MAX_PAGE_SIZE non-workshop sessions that take
+        place after 7pm (querySessions pages through all of them).
         Datastore will not allow two inequality filters in two different
-        properties, so the way to fix it is to do two simple queries
-        (all sessions after 7 and all workshops after 7) and substract one to
-        the other.
+        properties, so the query planner runs the startTime filter and
+        applies the typeOfSession one in memory.
         """
-        # workshops after 7pm
-        q1 = Session.query()
-        q1 = q1.filter(Session.startTime > time(19, 0, 0))
-        q1 = q1.filter(Session.typeOfSession == TypeOfSession.WORKSHOP)
-        # all sessions after 7pm
-        q2 = Session.query()
-        q2 = q2.filter(Session.startTime > time(19, 0, 0))
-        s1, s2 = [s for s in q1], [s for s in q2]
-        # the statement below won't work because app engine does not implement
-        # the __hash__ method, so sets cannot be created.
-        #result = set([s for s in q2]).difference(set([s for s in q1]))
-        result = [s for s in s2 if s not in s1]
-        return SessionForms(items=[self._copySessionToForm(s) for s in result])
-
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+        plan = SESSION_PLANNER.plan([
+            {"field": "startTime", "operator": ">", "value": time(19, 0, 0)},
+            {"field": "typeOfSession", "operator": "!=",
+             "value": TypeOfSession.WORKSHOP},
+        ])
+        sessions, _ = plan.fetchPage(MAX_PAGE_SIZE)
+        return self._copySessionsToForms(sessions)
+
+    @endpoints.method(SessionQueryForms, SessionForms,
+            path='querySessions',
+            http_method='POST', name='querySessions')
+    def querySessions(self, request):
+        """ Query for sessions, optionally within one conference. Any number
+        of inequality filters is accepted: the most selective property is
+        queried in Datastore, the others are applied in memory """
+        filters = self._formatFilters(
+            request.filters, fields=SESSION_FIELDS,
+            types=SESSION_FILTER_TYPES, planner=SESSION_PLANNER)
+        if filters is None:
+            return SessionForms(items=[])
+        ancestor = None
+        if request.websafeConferenceKey:
+            ancestor = ndb.Key(urlsafe=request.websafeConferenceKey)
+        sessions, nextPageToken = self._fetchPlanPage(
+            SESSION_PLANNER.plan(filters, ancestor=ancestor),
+            request.limit, request.pageToken)
+        forms = self._copySessionsToForms(sessions)
+        forms.nextPageToken = nextPageToken
+        return forms
+
+    @endpoints.method(PAGE_REQUEST, ConferenceForms,
             path='filterPlayground/moleConferences',
             http_method='GET', name='moleConferences')
     def moleConferences(self, request):
-        """ Returns conferences with sessions not longer than 60 minutes
-        that contain moles in the highlights """
-        q = Session.query()
-        q = q.filter(Session.highlights == 'moles')
-        q = q.filter(Session.duration < 60)
-
-        conferences = ndb.get_multi([ndb.Key(urlsafe=s.conferenceId) for s in q])
-        # I wish I didn't have to do this,but datastore is returning duplicates
-        # and google won't tell me why. Also, __hash__ raises an exception,
-        # so it is not possible to convert the list into a set to remove
-        # duplicates more efficiently
-        non_repeated = []
-        for c in conferences:
-            if c not in non_repeated:
-                non_repeated.append(c)
+        """ Returns a page of the conferences with sessions not longer than
+        60 minutes that contain moles in the highlights """
+        # one conference per matching session used to come back; sessions
+        # are deduped by parent key now
+        return self._conferencesWithSessions([
+            {"field": "highlights", "operator": "=", "value": "moles"},
+            {"field": "duration", "operator": "<", "value": 60},
+        ], request.limit, request.pageToken)
+
+    def _conferencesWithSessions(self, filters, limit=None, pageToken=None):
+        """Return a ConferenceForms page of the conferences having sessions
+        that match filters. Only session keys are read when Datastore can
+        apply every filter; conference keys are derived from them and
+        deduped before the conferences are fetched. The sessions are
+        scanned in key order, which keeps those of a conference together,
+        so no conference shows up on two pages."""
+        plan = SESSION_PLANNER.plan(filters, keyOrder=True)
+        try:
+            conf_keys, nextPageToken = plan.fetchParentKeysPage(
+                self._pageLimit(limit), pageToken)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid pageToken.")
+        # fetch the conferences in parallel batches
+        futures = [ndb.get_multi_async(conf_keys[i:i + FETCH_BATCH_SIZE])
+                   for i in range(0, len(conf_keys), FETCH_BATCH_SIZE)]
+        conferences = [f.get_result() for batch in futures for f in batch]
         return ConferenceForms(
-            items=[self._copyConferenceToForm(c, "") for c in non_repeated]
+            items=[self._copyConferenceToForm(c) for c in conferences if c],
+            nextPageToken=nextPageToken
         )
 
+    @endpoints.method(SessionQueryForms, ConferenceForms,
+            path='queryConferencesBySessions',
+            http_method='POST', name='queryConferencesBySessions')
+    def queryConferencesBySessions(self, request):
+        """ Query for conferences having sessions that match the filters """
+        filters = self._formatFilters(
+            request.filters, fields=SESSION_FIELDS,
+            types=SESSION_FILTER_TYPES, planner=SESSION_PLANNER)
+        if filters is None:
+            return ConferenceForms(items=[])
+        return self._conferencesWithSessions(filters, request.limit,
+                                             request.pageToken)
+
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='filterPlayground/londonAttendees',
             http_method='GET', name='londonAttendees')
@@ -792,8 +1529,26 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.city == 'London').\
             filter(Conference.maxAttendees > 1000)
         return ConferenceForms(
-            items=[self._copyConferenceToForm(c, "") for c in q]
+            items=[self._copyConferenceToForm(c) for c in q]
         )
 
 
+
+@migrations.mapper('organizer_names', Conference.query)
+def repairOrganizerNames(conferences):
+    """Find conferences whose organizerDisplayName is missing or differs
+    from their organizer's Profile, and queue the name update of those
+    organizers."""
+    organizers = list(set(conf.key.parent() for conf in conferences
+                          if conf.key.parent()))
+    names = dict((prof.key, prof.displayName)
+                 for prof in ndb.get_multi(organizers) if prof)
+    stale = set(conf.key.parent() for conf in conferences
+                if conf.key.parent() in names and
+                conf.organizerDisplayName != names[conf.key.parent()])
+    for p_key in stale:
+        logging.warning('Stale organizer name on conferences of %s', p_key.id())
+        ConferenceApi._enqueueOrganizerNameUpdate(p_key.id())
+
+
 api = endpoints.api_server([ConferenceApi]) # register API
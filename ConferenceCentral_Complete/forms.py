@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""forms.py
+
+Precompiled copy plans from ndb entities to ProtoRPC form messages
+
+"""
+
+from operator import attrgetter
+
+
+def _websafeKey(entity):
+    return entity.key.urlsafe()
+
+
+class CopyPlan(object):
+    """CopyPlan -- fixed list of (field, getter, converter) steps that copy
+    an ndb Model entity into a ProtoRPC Message.
+
+    The plan is worked out once from the Message fields the Model also has:
+    date and time fields are converted to strings, websafeKey comes from the
+    entity key, converters override the conversion of individual fields.
+    """
+    def __init__(self, model, message, converters=None):
+        converters = converters or {}
+        self.message = message
+        self._steps = []
+        for field in message.all_fields():
+            name = field.name
+            if hasattr(model, name):
+                # convert Date/Time to string; just copy others
+                if name in converters:
+                    convert = converters[name]
+                elif name.lower().endswith(('date', 'time')):
+                    convert = str
+                else:
+                    convert = None
+                self._steps.append((name, attrgetter(name), convert))
+            elif name == 'websafeKey':
+                self._steps.append((name, _websafeKey, None))
+        self._check = any(f.required for f in message.all_fields())
+
+    def copy(self, entity):
+        """Copy entity into a new message."""
+        form = self.message()
+        for name, get, convert in self._steps:
+            value = get(entity)
+            if convert is not None:
+                value = convert(value)
+            if value is not None:
+                setattr(form, name, value)
+        if self._check:
+            form.check_initialized()
+        return form
+
+    def copyAll(self, entities):
+        """Copy every entity of entities, returning a list of messages."""
+        copy = self.copy
+        return [copy(e) for e in entities]
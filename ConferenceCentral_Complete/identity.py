@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""identity.py
+
+Request-scoped identity map for ConferenceApi methods. The current user,
+user id and every entity looked up by key while a request is served are
+kept for the rest of the request, so helpers can ask for them as often as
+they need to without repeating token checks or datastore gets.
+
+Inside a transaction entities are always read from the datastore, and the
+map only takes them over once the transaction has committed.
+
+Writes go through save(), which skips the TrackedModel entities that have
+not changed and writes the others with one put_multi.
+
+"""
+
+import functools
+import threading
+
+from google.appengine.ext import ndb
+
+import instrumentation
+
+_local = threading.local()
+
+
+class IdentityMap(object):
+    """IdentityMap -- values and entities loaded by the current request"""
+    def __init__(self):
+        self.values = {}
+        self.entities = {}
+
+
+def current():
+    return getattr(_local, 'map', None)
+
+
+def scoped(func):
+    """Decorator giving every call of func a fresh identity map; nested
+    calls share the outer one."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if current() is not None:
+            return func(*args, **kwargs)
+        _local.map = IdentityMap()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.map = None
+    return wrapper
+
+
+def scopeService(cls):
+    """Class decorator giving every remote method of a remote.Service its
+    own identity map; functools.wraps keeps the endpoints method info."""
+    for attr, value in list(cls.__dict__.items()):
+        if hasattr(value, 'remote'):
+            setattr(cls, attr, scoped(value))
+    return cls
+
+
+def cached(name, load):
+    """Return the request's value for name, calling load() the first time
+    it is asked for. Exceptions raised by load() are not cached."""
+    imap = current()
+    if imap is None:
+        return load()
+    if name in imap.values:
+        instrumentation.count('identityMapHits')
+        return imap.values[name]
+    value = imap.values[name] = load()
+    return value
+
+
+def get(key):
+    """Return the entity of key, or None, reading it at most once per
+    request outside transactions."""
+    return getAsync(key).get_result()
+
+
+@ndb.tasklet
+def getAsync(key):
+    """Tasklet version of get(), so lookups can overlap."""
+    imap = current()
+    if imap is not None and not ndb.in_transaction() and key in imap.entities:
+        instrumentation.count('identityMapHits')
+        raise ndb.Return(imap.entities[key])
+    entity = yield key.get_async()
+    if imap is not None:
+        _remember(imap, key, entity)
+    raise ndb.Return(entity)
+
+
+def add(entity):
+    """Make an entity the request has just written the one get() returns."""
+    imap = current()
+    if imap is not None:
+        _remember(imap, entity.key, entity)
+
+
+def save(*entities):
+    """Write the entities that changed since they were read or last written
+    with a single put_multi; unchanged ones are skipped. Returns the
+    entities written."""
+    dirty = [entity for entity in entities if entity.isDirty()]
+    instrumentation.count('entitiesWritten', len(dirty))
+    instrumentation.count('unchangedWritesSkipped', len(entities) - len(dirty))
+    if dirty:
+        ndb.put_multi(dirty)
+        for entity in dirty:
+            add(entity)
+    return dirty
+
+
+def _remember(imap, key, entity):
+    # runs right away outside transactions, and only if it commits inside one
+    def remember():
+        imap.entities[key] = entity
+    ndb.get_context().call_on_commit(remember)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""idpool.py
+
+Per-parent pools of datastore ids. allocate_ids hands out a whole range for
+the price of one RPC, so ids are allocated in batches and served from
+memory; when a pool is empty the allocation is started asynchronously and
+can overlap with the rest of the request.
+
+"""
+
+import collections
+import threading
+
+from google.appengine.ext import ndb
+
+# ids allocated per RPC
+ID_BATCH_SIZE = 10
+# parents whose unused ids are kept, least recently used ones are dropped
+MAX_PARENTS = 1000
+
+
+class IdPool(object):
+    """IdPool -- thread-safe pool of allocated ids of one model, per parent
+    key. Unused ids are simply lost when an instance goes away, allocated
+    ids are never handed out twice."""
+    def __init__(self, model, batch=ID_BATCH_SIZE, max_parents=MAX_PARENTS):
+        self.model = model
+        self.batch = batch
+        self.max_parents = max_parents
+        self._pools = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _take(self, parent):
+        with self._lock:
+            ids = self._pools.pop(parent, None)
+            if not ids:
+                return None
+            value = ids.popleft()
+            if ids:
+                # re-insert so the parent becomes the most recently used one
+                self._pools[parent] = ids
+            return value
+
+    def _put(self, parent, ids):
+        with self._lock:
+            pool = self._pools.pop(parent, collections.deque())
+            pool.extend(ids)
+            self._pools[parent] = pool
+            while len(self._pools) > self.max_parents:
+                self._pools.popitem(last=False)
+
+    def reserve(self, parent=None):
+        """Return a Future for a new key under parent. It is already done
+        when the pool had an id left, otherwise call get_result() as late
+        as possible so the allocation overlaps with other work."""
+        value = self._take(parent)
+        if value is not None:
+            future = ndb.Future()
+            future.set_result(ndb.Key(self.model, value, parent=parent))
+            return future
+        return self._allocate(parent)
+
+    @ndb.tasklet
+    def _allocate(self, parent):
+        first, last = yield self.model.allocate_ids_async(
+            size=self.batch, parent=parent)
+        self._put(parent, range(first + 1, last + 1))
+        raise ndb.Return(ndb.Key(self.model, first, parent=parent))
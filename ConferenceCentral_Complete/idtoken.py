@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""idtoken.py
+
+Local verification of Google ID tokens (RS256 JWTs) against Google's
+signing keys. The keys are cached in-process and in memcache and refreshed
+by the /crons/refresh_signing_keys cron, so verifying a token normally
+makes no network call. When a request does have to fetch them and the
+fetch fails, the last keys seen are kept and the token is rejected with
+InvalidTokenError if none of them match.
+
+"""
+
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+from Crypto.Hash import SHA256
+from Crypto.PublicKey import RSA
+from Crypto.Signature import PKCS1_v1_5
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+
+CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+MEMCACHE_SIGNING_KEYS_KEY = 'ID_TOKEN_SIGNING_KEYS'
+MEMCACHE_TOKEN_PREFIX = 'ID_TOKEN_USER:'
+# used when the certs response carries no max-age
+DEFAULT_KEYS_TTL = 3600
+# seconds of clock difference tolerated on iat/exp
+CLOCK_SKEW = 300
+# an unknown kid triggers at most one refresh per this many seconds
+MIN_REFRESH_INTERVAL = 60
+# seconds a request waits for the certs endpoint
+CERTS_FETCH_DEADLINE = 5
+
+_lock = threading.Lock()
+_keys = {}          # kid -> RSA public key
+_keysExpire = 0
+_lastRefresh = 0
+
+
+class InvalidTokenError(Exception):
+    """InvalidTokenError -- the token is malformed, forged or expired"""
+    pass
+
+
+def _b64decode(segment):
+    segment = str(segment)
+    return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+
+
+def _toLong(segment):
+    return int(binascii.hexlify(_b64decode(segment)), 16)
+
+
+def setSigningKeys(jwks, expires):
+    """Install a JWK set ({'keys': [...]}) valid until expires (epoch)."""
+    global _keys, _keysExpire
+    keys = {}
+    for jwk in jwks.get('keys', []):
+        if jwk.get('kty') == 'RSA':
+            keys[jwk['kid']] = RSA.construct(
+                (_toLong(jwk['n']), _toLong(jwk['e'])))
+    with _lock:
+        _keys, _keysExpire = keys, expires
+
+
+def refreshSigningKeys():
+    """Fetch the current signing keys, share them through memcache and
+    install them locally. Return False, keeping the current keys, when the
+    fetch fails or the response is not a JWK set."""
+    global _lastRefresh
+    _lastRefresh = time.time()
+    try:
+        resp = urlfetch.fetch(CERTS_URL, deadline=CERTS_FETCH_DEADLINE)
+    except urlfetch.Error as e:
+        logging.error('Fetching ID token signing keys failed: %r', e)
+        return False
+    if resp.status_code != 200:
+        logging.error('Fetching ID token signing keys failed: %s',
+                      resp.status_code)
+        return False
+    match = re.search(r'max-age=(\d+)',
+                      resp.headers.get('Cache-Control', ''))
+    expires = int(time.time()) + (
+        int(match.group(1)) if match else DEFAULT_KEYS_TTL)
+    try:
+        jwks = json.loads(resp.content)
+        setSigningKeys(jwks, expires)
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        logging.error('Invalid ID token signing keys: %r', e)
+        return False
+    memcache.set(MEMCACHE_SIGNING_KEYS_KEY,
+                 {'jwks': jwks, 'expires': expires}, time=expires)
+    return True
+
+
+def _refreshDue():
+    """Claim the next refresh; at most one per MIN_REFRESH_INTERVAL, also
+    across the threads of an instance and after failed fetches."""
+    global _lastRefresh
+    with _lock:
+        if time.time() - _lastRefresh <= MIN_REFRESH_INTERVAL:
+            return False
+        _lastRefresh = time.time()
+        return True
+
+
+def _signingKey(kid):
+    """Return the key for kid, loading the key set when it is stale. Keys
+    past their expiry are still used while they cannot be refreshed."""
+    if _keysExpire < time.time() or kid not in _keys:
+        cached = memcache.get(MEMCACHE_SIGNING_KEYS_KEY)
+        if cached and kid in [k.get('kid') for k in cached['jwks']['keys']]:
+            setSigningKeys(cached['jwks'], cached['expires'])
+        elif _refreshDue():
+            # cold cache or rotated keys; normally the cron keeps memcache warm
+            refreshSigningKeys()
+    return _keys.get(kid)
+
+
+def verifyIdToken(token, audiences):
+    """Return the claims of a valid ID token issued to one of audiences,
+    raising InvalidTokenError otherwise."""
+    try:
+        header, payload, signature = [str(s) for s in token.split('.')]
+        headerData = json.loads(_b64decode(header))
+        claims = json.loads(_b64decode(payload))
+        signature = _b64decode(signature)
+    except (ValueError, TypeError):
+        raise InvalidTokenError('Malformed token')
+
+    if headerData.get('alg') != 'RS256':
+        raise InvalidTokenError('Unsupported algorithm')
+    key = _signingKey(headerData.get('kid'))
+    if key is None:
+        raise InvalidTokenError('Unknown signing key')
+    signed = SHA256.new('%s.%s' % (header, payload))
+    if not PKCS1_v1_5.new(key).verify(signed, signature):
+        raise InvalidTokenError('Invalid signature')
+
+    now = time.time()
+    if claims.get('iss') not in ISSUERS:
+        raise InvalidTokenError('Invalid issuer')
+    if claims.get('aud') not in audiences:
+        raise InvalidTokenError('Invalid audience')
+    if not claims.get('sub'):
+        raise InvalidTokenError('Missing subject')
+    if int(claims.get('exp', 0)) + CLOCK_SKEW < now or \
+            int(claims.get('iat', 0)) - CLOCK_SKEW > now:
+        raise InvalidTokenError('Token expired or not yet valid')
+    return claims
+
+
+def _tokenCacheKey(token):
+    # tokens can exceed memcache's 250 byte key limit
+    return MEMCACHE_TOKEN_PREFIX + hashlib.sha256(token).hexdigest()
+
+
+def getCachedUserId(token):
+    """Return the user_id previously resolved for token, if any."""
+    return memcache.get(_tokenCacheKey(token))
+
+
+def cacheUserId(token, user_id, expires):
+    """Remember user_id for token until expires (epoch seconds)."""
+    if expires > time.time():
+        # memcache reads times beyond 30 days as absolute epoch seconds
+        memcache.set(_tokenCacheKey(token), user_id, time=int(expires))
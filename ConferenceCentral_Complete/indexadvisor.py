@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""indexadvisor.py
+
+Offline index advisor for the datastore queries the API issues.
+
+ConferenceApi._getQuery, the query planner and the session queries log the
+shape of every query they run (kind, ancestor, equality properties,
+inequality property and sort orders) through recordQuery(). This tool reads
+those lines back from captured logs, proposes the smallest set of composite
+indexes that serves every recorded shape, relying on zigzag merge joins of
+one index per equality property, and compares it with index.yaml:
+
+    python indexadvisor.py --index index.yaml --yaml proposed.yaml app.log
+
+"""
+
+import argparse
+import json
+import logging
+import re
+import sys
+from collections import defaultdict
+
+SHAPE_MARKER = 'query shape '
+SHAPE_RE = re.compile(re.escape(SHAPE_MARKER) + r'(\{.*\})')
+# values per entity of the repeated properties, the default lists have two
+DEFAULT_VALUES = {
+    'Conference.topics': 2,
+    'Session.highlights': 2,
+}
+
+
+def recordQuery(kind, filters, orders=(), ancestor=False):
+    """Log the shape of a query about to run. filters are filter dicts as
+    built by ConferenceApi._formatFilters(), orders property names, with a
+    leading '-' for descending ones."""
+    inequalities = sorted(set(f['field'] for f in filters
+                              if f['operator'] != '='))
+    logging.info(SHAPE_MARKER + json.dumps({
+        'kind': kind,
+        'ancestor': bool(ancestor),
+        'equalities': sorted(set(f['field'] for f in filters
+                                 if f['operator'] == '=')),
+        'inequality': inequalities[0] if inequalities else None,
+        'orders': list(orders),
+    }, sort_keys=True))
+
+
+# - - - shapes and indexes - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def readShapes(lines):
+    """Return {shape: number of queries} for the recorded lines."""
+    shapes = defaultdict(int)
+    for line in lines:
+        match = SHAPE_RE.search(line)
+        if match:
+            try:
+                shape = json.loads(match.group(1))
+            except ValueError:
+                continue
+            shapes[_shapeKey(shape)] += 1
+    return shapes
+
+
+def _shapeKey(shape):
+    orders = list(shape.get('orders') or [])
+    inequality = shape.get('inequality')
+    # an inequality property always comes first in the sort orders
+    if inequality and (not orders or orders[0].lstrip('-') != inequality):
+        orders.insert(0, inequality)
+    return (shape['kind'], bool(shape.get('ancestor')),
+            tuple(shape.get('equalities') or ()), inequality, tuple(orders))
+
+
+def builtIn(shape):
+    """True when Datastore serves the shape with built-in indexes only."""
+    kind, ancestor, equalities, inequality, orders = shape
+    if not orders:
+        # ancestor and/or equality filters: merge join of built-in indexes
+        return True
+    return not ancestor and not equalities and len(orders) == 1
+
+
+def exactIndex(shape):
+    """The composite index serving shape on its own, as (kind, ancestor,
+    properties)."""
+    kind, ancestor, equalities, inequality, orders = shape
+    return (kind, ancestor, tuple(equalities) + tuple(orders))
+
+
+def zigzagIndexes(shape):
+    """Composite indexes serving shape through a zigzag merge join: one per
+    equality property, all sharing the sort orders."""
+    kind, ancestor, equalities, inequality, orders = shape
+    if not equalities:
+        return [(kind, ancestor, tuple(orders))]
+    return [(kind, ancestor, (prop,) + tuple(orders)) for prop in equalities]
+
+
+def propose(shapes, zigzag=True):
+    """Return {index: number of recorded queries it serves}."""
+    indexes = defaultdict(int)
+    for shape, n in shapes.items():
+        if builtIn(shape):
+            continue
+        for index in (zigzagIndexes(shape) if zigzag else [exactIndex(shape)]):
+            indexes[index] += n
+    return indexes
+
+
+def usedBy(index, shape):
+    """True when a query of shape can use index, alone or in a zigzag
+    merge join."""
+    kind, ancestor, properties = index
+    if (kind, ancestor) != shape[:2] or builtIn(shape):
+        return False
+    if index == exactIndex(shape):
+        return True
+    equalities, orders = shape[2], shape[4]
+    if len(properties) < len(orders):
+        return False
+    prefix = properties[:len(properties) - len(orders)]
+    # every index of a merge join covers at least one equality
+    return properties[len(prefix):] == tuple(orders) and \
+        set(prefix) <= set(equalities) and bool(prefix) == bool(equalities)
+
+
+def loadIndexes(path):
+    """Return the composite indexes of an index.yaml file."""
+    import yaml
+    with open(path) as f:
+        entries = (yaml.safe_load(f) or {}).get('indexes') or []
+    indexes = []
+    for entry in entries:
+        properties = tuple(
+            ('-' if p.get('direction') == 'desc' else '') + p['name']
+            for p in entry.get('properties') or [])
+        indexes.append((entry['kind'], bool(entry.get('ancestor')), properties))
+    return indexes
+
+
+def dumpIndexes(indexes):
+    """Return indexes as index.yaml text."""
+    lines = ['indexes:']
+    for kind, ancestor, properties in sorted(indexes):
+        lines.extend(['', '- kind: %s' % kind])
+        if ancestor:
+            lines.append('  ancestor: yes')
+        lines.append('  properties:')
+        for prop in properties:
+            lines.append('  - name: %s' % prop.lstrip('-'))
+            if prop.startswith('-'):
+                lines.append('    direction: desc')
+    return '\n'.join(lines) + '\n'
+
+
+def rowsPerEntity(index, values):
+    """Index rows one entity writes into index: the product of the number
+    of values of its properties, so repeated properties multiply."""
+    kind, _, properties = index
+    rows = 1
+    for prop in set(p.lstrip('-') for p in properties):
+        rows *= values.get('%s.%s' % (kind, prop), 1)
+    return rows
+
+
+# - - - report - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _describe(index):
+    kind, ancestor, properties = index
+    return '%s(%s%s)' % (kind, 'ancestor, ' if ancestor else '',
+                         ', '.join(properties))
+
+
+def report(shapes, proposed, existing, values, out=sys.stdout):
+    write = out.write
+    write('%d queries of %d shapes\n' % (sum(shapes.values()), len(shapes)))
+    for shape, n in sorted(shapes.items(), key=lambda item: -item[1]):
+        kind, ancestor, equalities, inequality, orders = shape
+        write('  %6d  %s%s eq=[%s] ineq=%s order=[%s]%s\n' % (
+            n, kind, ' ancestor' if ancestor else '', ', '.join(equalities),
+            inequality or '-', ', '.join(orders),
+            '  (built-in)' if builtIn(shape) else ''))
+
+    write('\nproposed indexes (rows written per entity, queries served):\n')
+    for index, n in sorted(proposed.items()):
+        write('  %-60s %4d rows %6d queries%s\n' % (
+            _describe(index), rowsPerEntity(index, values), n,
+            '' if index in existing else '  NEW'))
+
+    write('\nindex.yaml entries:\n')
+    unused = []
+    for index in existing:
+        served = sum(n for shape, n in shapes.items() if usedBy(index, shape))
+        if not served:
+            unused.append(index)
+        write('  %-60s %4d rows %6d queries%s\n' % (
+            _describe(index), rowsPerEntity(index, values), served,
+            '  UNUSED' if not served else ''))
+
+    write('\ncomposite index rows written per new entity:\n')
+    for kind in sorted(set(i[0] for i in list(existing) + list(proposed))):
+        write('  %-12s index.yaml %5d   proposed %5d\n' % (
+            kind,
+            sum(rowsPerEntity(i, values) for i in existing if i[0] == kind),
+            sum(rowsPerEntity(i, values) for i in proposed if i[0] == kind)))
+    write('%d of %d index.yaml entries are never used\n'
+          % (len(unused), len(existing)))
+    return unused
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('logs', nargs='*',
+                        help='captured log files (default: stdin)')
+    parser.add_argument('--index', default='index.yaml',
+                        help='index.yaml to compare with')
+    parser.add_argument('--yaml', help='write the proposed index.yaml here')
+    parser.add_argument('--exact', action='store_true',
+                        help='one index per shape, no zigzag merge joins')
+    parser.add_argument('--values', action='append', default=[],
+                        metavar='KIND.PROP=N',
+                        help='values per entity of a repeated property')
+    args = parser.parse_args(argv)
+
+    values = dict(DEFAULT_VALUES)
+    for value in args.values:
+        prop, _, n = value.partition('=')
+        values[prop] = int(n)
+
+    shapes = defaultdict(int)
+    for path in args.logs or ['-']:
+        f = sys.stdin if path == '-' else open(path)
+        try:
+            for shape, n in readShapes(f).items():
+                shapes[shape] += n
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    if not shapes:
+        print('no "%s" lines found' % SHAPE_MARKER.strip())
+        return 1
+
+    proposed = propose(shapes, zigzag=not args.exact)
+    report(shapes, proposed, loadIndexes(args.index), values)
+    if args.yaml:
+        with open(args.yaml, 'w') as f:
+            f.write(dumpIndexes(proposed))
+        print('wrote %s' % args.yaml)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
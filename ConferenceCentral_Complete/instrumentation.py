@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+"""instrumentation.py
+
+Per-request RPC accounting for ConferenceApi methods and webapp2 handlers.
+
+An apiproxy hook counts and times every RPC (datastore, memcache,
+taskqueue, urlfetch, ...) made while a request is being served. When the
+request ends a structured summary is logged, runs of single-key reads from
+one call site that could have been one batch get are flagged as N+1
+patterns, and the totals are added to rolling per-method histograms (see
+getMethodStats).
+
+"""
+
+import collections
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import timeit
+
+import webapp2
+from google.appengine.api import apiproxy_stub_map
+
+# upper bounds (ms) of the latency histogram buckets; the last one is open
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+# requests per method kept for the rolling histograms
+ROLLING_WINDOW = 500
+# this many single-key reads from one call site in a request is an N+1
+# pattern
+N_PLUS_ONE_THRESHOLD = 3
+# reads that have a batch form, with the request field holding the keys;
+# writes are left out, sequential transactional writes are legitimate
+BATCHABLE_GETS = {
+    'datastore_v3.Get': 'key',
+    'memcache.Get': 'key',
+}
+# call sites are the innermost frame of a file in the app directory
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_module = os.path.splitext(os.path.abspath(__file__))[0]
+_local = threading.local()
+_lock = threading.Lock()
+_history = collections.defaultdict(
+    lambda: collections.deque(maxlen=ROLLING_WINDOW))
+
+
+class _RequestStats(object):
+    """_RequestStats -- RPCs and counters of the request being served"""
+    def __init__(self, name):
+        self.name = name
+        self.start = timeit.default_timer()
+        self.rpcs = collections.defaultdict(lambda: [0, 0.0])
+        self.singles = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+        self.inflight = {}
+
+    def nPlusOne(self):
+        """Return the (rpc, call site) pairs of repeated single gets."""
+        return sorted(site for site, n in self.singles.items()
+                      if n >= N_PLUS_ONE_THRESHOLD)
+
+
+def _callSite():
+    """Return 'file.py:line' of the innermost app frame issuing an RPC."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if (filename.startswith(APP_DIR + os.sep)
+                and os.path.splitext(filename)[0] != _module):
+            return '%s:%d' % (os.path.relpath(filename, APP_DIR),
+                              frame.f_lineno)
+        frame = frame.f_back
+    return None
+
+
+def _current():
+    return getattr(_local, 'stats', None)
+
+
+def _preCall(service, call, request, response):
+    stats = _current()
+    if stats is None:
+        return
+    stats.inflight[id(request)] = timeit.default_timer()
+    rpc = '%s.%s' % (service, call)
+    size = getattr(request, '%s_size' % BATCHABLE_GETS.get(rpc), None)
+    if size is None or size() != 1:
+        return
+    # a get inside a transaction reads what the transaction is about to
+    # write; it cannot be batched with gets outside of it
+    if getattr(request, 'has_transaction', lambda: False)():
+        return
+    site = _callSite()
+    if site is not None:
+        stats.singles[(rpc, site)] += 1
+
+
+def _postCall(service, call, request, response):
+    stats = _current()
+    if stats is None:
+        return
+    started = stats.inflight.pop(id(request), None)
+    rpc = '%s.%s' % (service, call)
+    entry = stats.rpcs[rpc]
+    entry[0] += 1
+    if started is not None:
+        entry[1] += (timeit.default_timer() - started) * 1000
+
+
+def installHooks():
+    """Register the RPC hooks with the apiproxy; safe to call repeatedly."""
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append('instrumentation', _preCall)
+    apiproxy.GetPostCallHooks().Append('instrumentation', _postCall)
+
+
+def count(counter, n=1):
+    """Add n to a named counter of the current request, if any."""
+    stats = _current()
+    if stats is not None:
+        stats.counters[counter] += n
+
+
+def _begin(name):
+    if _current() is not None:
+        # nested call, accounted to the outer request
+        return False
+    _local.stats = _RequestStats(name)
+    return True
+
+
+def _end():
+    stats = _local.stats
+    _local.stats = None
+    totalMs = (timeit.default_timer() - stats.start) * 1000
+    nPlusOne = stats.nPlusOne()
+    summary = {
+        'method': stats.name,
+        'totalMs': round(totalMs, 2),
+        'rpcs': dict((rpc, {'count': n, 'ms': round(ms, 2)})
+                     for rpc, (n, ms) in stats.rpcs.items()),
+        'counters': dict(stats.counters),
+    }
+    if nPlusOne:
+        summary['nPlusOne'] = ['%s at %s' % site for site in nPlusOne]
+        logging.warning('N+1 RPC pattern in %s: %s', stats.name,
+                        ', '.join('%d x %s of 1 key at %s' % (
+                            (stats.singles[site],) + site)
+                            for site in nPlusOne))
+    logging.info('request stats %s', json.dumps(summary, sort_keys=True))
+    with _lock:
+        _history[stats.name].append(
+            (totalMs, dict(stats.rpcs), dict(stats.counters), bool(nPlusOne)))
+
+
+def instrumented(name):
+    """Decorator accounting every call of the function to name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            began = _begin(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if began:
+                    _end()
+        return wrapper
+    return decorator
+
+
+def instrumentService(cls):
+    """Class decorator instrumenting every remote method of a
+    remote.Service; functools.wraps keeps the endpoints method info."""
+    for attr, value in list(cls.__dict__.items()):
+        if hasattr(value, 'remote'):
+            setattr(cls, attr, instrumented(
+                '%s.%s' % (cls.__name__, attr))(value))
+    return cls
+
+
+class InstrumentedHandler(webapp2.RequestHandler):
+    """InstrumentedHandler -- webapp2 handler accounting its RPCs to
+    'METHOD /path'"""
+    def dispatch(self):
+        name = '%s %s' % (self.request.method, self.request.path)
+        return instrumented(name)(super(InstrumentedHandler, self).dispatch)()
+
+
+def getMethodStats():
+    """Return the rolling stats of every method seen by this instance as
+    dicts with requests, meanMs, p95Ms, buckets [(upperMs, count)], rpcs
+    {rpc: (count, ms)}, counters {name: total} and nPlusOne."""
+    with _lock:
+        history = dict((name, list(entries))
+                       for name, entries in _history.items())
+    result = []
+    for name, entries in sorted(history.items()):
+        latencies = sorted(e[0] for e in entries)
+        buckets = collections.OrderedDict(
+            (upper, 0) for upper in LATENCY_BUCKETS_MS + (None,))
+        rpcs = collections.defaultdict(lambda: [0, 0.0])
+        counters = collections.defaultdict(int)
+        for totalMs, requestRpcs, requestCounters, _ in entries:
+            for upper in buckets:
+                if upper is None or totalMs <= upper:
+                    buckets[upper] += 1
+                    break
+            for rpc, (n, ms) in requestRpcs.items():
+                rpcs[rpc][0] += n
+                rpcs[rpc][1] += ms
+            for counter, n in requestCounters.items():
+                counters[counter] += n
+        result.append({
+            'method': name,
+            'requests': len(entries),
+            'meanMs': sum(latencies) / len(latencies),
+            'p95Ms': latencies[min(int(len(latencies) * 0.95),
+                                   len(latencies) - 1)],
+            'buckets': list(buckets.items()),
+            'rpcs': dict(rpcs),
+            'counters': dict(counters),
+            'nPlusOne': sum(1 for e in entries if e[3]),
+        })
+    return result
+
+
+installHooks()
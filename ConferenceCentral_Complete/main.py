@@ -15,16 +15,30 @@ __author__ = 'wesc+api@google.com (Wesley Chun)'
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.ext import ndb
 from conference import ConferenceApi
+from seats import reconcileSeats
+from search import indexDocument
+from typeahead import updateTypeahead
+from idtoken import refreshSigningKeys
+from instrumentation import InstrumentedHandler
+from migrations import runBatch
 
-class SetAnnouncementHandler(webapp2.RequestHandler):
+class SetAnnouncementHandler(InstrumentedHandler):
     def get(self):
         """Set Announcement in Memcache."""
         ConferenceApi._cacheAnnouncement()
         self.response.set_status(204)
 
 
-class SendConfirmationEmailHandler(webapp2.RequestHandler):
+class RefreshSigningKeysHandler(InstrumentedHandler):
+    def get(self):
+        """Refresh the ID token signing keys cached in memcache."""
+        refreshSigningKeys()
+        self.response.set_status(204)
+
+
+class SendConfirmationEmailHandler(InstrumentedHandler):
     def post(self):
         """Send email confirming Conference creation."""
         mail.send_mail(
@@ -38,7 +52,7 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
-class UpdateFeaturedSpeakerHandler(webapp2.RequestHandler):
+class UpdateFeaturedSpeakerHandler(InstrumentedHandler):
     def post(self):
         if ConferenceApi._isNewFeaturedSpeaker(
                 self.request.get('speaker_email'),
@@ -48,8 +62,55 @@ class UpdateFeaturedSpeakerHandler(webapp2.RequestHandler):
                 self.request.get('speaker_email')
             )
 
+
+class ReconcileSeatsHandler(InstrumentedHandler):
+    def post(self):
+        """Fold a Conference's seat shards into seatsAvailable."""
+        reconcileSeats(self.request.get('websafeConferenceKey'))
+
+
+class RebuildAgendaHandler(InstrumentedHandler):
+    def post(self):
+        """Rebuild a Conference's agenda snapshot."""
+        ConferenceApi._buildAgenda(
+            ndb.Key(urlsafe=self.request.get('websafeConferenceKey')))
+
+
+class IndexDocumentHandler(InstrumentedHandler):
+    def post(self):
+        """Reindex a created, updated or deleted Conference or Session."""
+        indexDocument(self.request.get('websafeKey'))
+
+
+class UpdateTypeaheadHandler(InstrumentedHandler):
+    def post(self):
+        """Recount a created or updated Conference's typeahead values."""
+        updateTypeahead(
+            [ndb.Key(urlsafe=self.request.get('websafeConferenceKey'))])
+
+
+class UpdateOrganizerNameHandler(InstrumentedHandler):
+    def post(self):
+        """Copy an organizer's displayName onto their conferences."""
+        ConferenceApi._updateOrganizerName(self.request.get('userId'),
+                                           self.request.get('cursor') or None)
+
+
+class MigrationHandler(InstrumentedHandler):
+    def post(self):
+        """Run one batch of a datastore migration."""
+        runBatch(self.request.get('name'), self.request.get('run'),
+                 self.request.get('cursor'))
+
 app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/crons/refresh_signing_keys', RefreshSigningKeysHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/update_featured_speaker', UpdateFeaturedSpeakerHandler),
+    ('/tasks/reconcile_seats', ReconcileSeatsHandler),
+    ('/tasks/update_organizer_name', UpdateOrganizerNameHandler),
+    ('/tasks/rebuild_agenda', RebuildAgendaHandler),
+    ('/tasks/index_document', IndexDocumentHandler),
+    ('/tasks/update_typeahead', UpdateTypeaheadHandler),
+    ('/tasks/migrate', MigrationHandler),
 ], debug=True)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""migrations.py
+
+Resumable, cursor-chained datastore mappers. Each task of a migration
+processes one page of its query and enqueues the next page's task, so a
+migration survives task retries and instance restarts and can be resumed
+from the last logged cursor.
+
+"""
+
+import hashlib
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from agenda import agendaChanged
+from models import Conference
+from models import Profile
+from models import Registration
+from models import Session
+from models import WishlistEntry
+from search import indexEntities
+from typeahead import updateTypeahead
+
+MIGRATION_BATCH_SIZE = 100
+
+_MAPPERS = {}
+
+
+def mapper(name, query):
+    """Decorator registering func(entities) as the batch function of the
+    migration name, run over the pages of query()."""
+    def decorator(func):
+        _MAPPERS[name] = (query, func)
+        return func
+    return decorator
+
+
+def migrationNames():
+    return sorted(_MAPPERS)
+
+
+def startMigration(name, cursor=None):
+    """Enqueue the first task of migration name, optionally resuming from
+    a websafe cursor."""
+    if name not in _MAPPERS:
+        raise KeyError(name)
+    _enqueue(name, str(int(time.time())), cursor)
+
+
+def _enqueue(name, run, cursor):
+    # named after the page, so a retried task cannot fork the chain
+    page = hashlib.md5(cursor or '').hexdigest()
+    try:
+        taskqueue.add(name='migrate-%s-%s-%s' % (name, run, page),
+                      url='/tasks/migrate',
+                      params={'name': name, 'run': run, 'cursor': cursor or ''})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def runBatch(name, run, cursor=None):
+    """Process one page of migration name and chain the next one."""
+    query, func = _MAPPERS[name]
+    start = Cursor(urlsafe=cursor) if cursor else None
+    entities, nextCursor, more = query().fetch_page(
+        MIGRATION_BATCH_SIZE, start_cursor=start)
+    func(entities)
+    if more and nextCursor:
+        logging.info('migration %s: %d done, resume from cursor %s',
+                     name, len(entities), nextCursor.urlsafe())
+        _enqueue(name, run, nextCursor.urlsafe())
+    else:
+        logging.info('migration %s: finished', name)
+
+
+# - - - Session parentage - - - - - - - - - - - - - - - - - - - - - - - -
+
+@mapper('session_parents', Session.query)
+def backfillSessionParents(sessions):
+    """Make every Session a child of the Conference in its conferenceId, and
+    rewrite it so the now unindexed conferenceId leaves the index."""
+    puts, deletes, moved = [], [], {}
+    for session in sessions:
+        parent = session.key.parent()
+        if not session.conferenceId:
+            if parent is None or parent.kind() != 'Conference':
+                logging.warning('Session %s has no conference', session.key)
+                continue
+            session.conferenceId = parent.urlsafe()
+        conf_key = ndb.Key(urlsafe=session.conferenceId)
+        if parent != conf_key:
+            # deterministic string id: a retried batch moves to the same key
+            # and never collides with allocated (integer) ids
+            new_key = ndb.Key(Session, 'moved-%s' % session.key.id(),
+                              parent=conf_key)
+            moved[session.key.urlsafe()] = new_key.urlsafe()
+            deletes.append(session.key)
+            session.key = new_key
+        puts.append(session)
+    ndb.put_multi(puts)
+    ndb.delete_multi(deletes)
+    # agendas of conferences that gained sessions are rebuilt
+    for conf_key in set(ndb.Key(urlsafe=new).parent() for new in moved.values()):
+        agendaChanged(conf_key)
+
+    # point wishlists at the moved sessions
+    for old, new in moved.items():
+        profiles = Profile.query(Profile.sessionWishlist == old).fetch()
+        for prof in profiles:
+            prof.sessionWishlist = [new if s == old else s
+                                    for s in prof.sessionWishlist]
+        ndb.put_multi(profiles)
+        # entry ids are the session keys, so moved entries get new keys
+        new_key = ndb.Key(urlsafe=new)
+        entries = WishlistEntry.query(
+            WishlistEntry.session == ndb.Key(urlsafe=old)).fetch()
+        ndb.put_multi([WishlistEntry(
+            key=ndb.Key(WishlistEntry, new, parent=entry.key.parent()),
+            session=new_key, conference=new_key.parent())
+            for entry in entries])
+        ndb.delete_multi([entry.key for entry in entries])
+
+
+# - - - Registrations - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@mapper('registrations', Profile.query)
+def convertRegistrations(profiles):
+    """Turn the conferenceKeysToAttend list of every Profile into
+    Registration children and empty it. Registration keys are derived from
+    the list, so a retried batch writes the same entities again."""
+    registrations, converted = [], []
+    for prof in profiles:
+        if not prof.conferenceKeysToAttend:
+            continue
+        for wsck in prof.conferenceKeysToAttend:
+            registrations.append(Registration(
+                key=ndb.Key(Registration, wsck, parent=prof.key),
+                conference=ndb.Key(urlsafe=wsck)))
+        prof.conferenceKeysToAttend = []
+        converted.append(prof)
+    # registrations first, an interrupted batch keeps the lists to retry
+    ndb.put_multi(registrations)
+    ndb.put_multi(converted)
+
+
+# - - - Wishlists - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@mapper('wishlists', Profile.query)
+def convertWishlists(profiles):
+    """Turn the sessionWishlist list of every Profile into WishlistEntry
+    children and empty it. Entry keys are derived from the list, so a
+    retried batch writes the same entities again."""
+    entries, converted = [], []
+    for prof in profiles:
+        if not prof.sessionWishlist:
+            continue
+        for wssk in set(prof.sessionWishlist):
+            session_key = ndb.Key(urlsafe=wssk)
+            entries.append(WishlistEntry(
+                key=ndb.Key(WishlistEntry, wssk, parent=prof.key),
+                session=session_key, conference=session_key.parent()))
+        prof.sessionWishlist = []
+        converted.append(prof)
+    # entries first, an interrupted batch keeps the lists to retry
+    ndb.put_multi(entries)
+    ndb.put_multi(converted)
+
+
+# - - - Search index - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@mapper('search_conferences', Conference.query)
+def indexConferences(conferences):
+    """Add conferences created before search to the index."""
+    indexEntities(conferences)
+
+
+@mapper('search_sessions', Session.query)
+def indexSessions(sessions):
+    """Add sessions created before search to the index."""
+    indexEntities(sessions)
+
+
+# - - - Typeahead - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+@mapper('typeahead', Conference.query)
+def countTypeaheadValues(conferences):
+    """Count the values of conferences created before the typeahead."""
+    updateTypeahead([conf.key for conf in conferences])
@@ -12,6 +12,7 @@ created/forked from conferences.py by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import copy
 import httplib
 import endpoints
 from protorpc import messages
@@ -22,15 +23,70 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
-class Profile(ndb.Model):
+class TrackedModel(ndb.Model):
+    """TrackedModel -- remembers the property values it was read or last
+    written with, so that unchanged entities are not written again (see
+    identity.save)"""
+    _snapshot = None
+
+    def isDirty(self):
+        """True unless the entity was read or written and has not changed
+        since; entities that came from a query are always dirty."""
+        return self._snapshot is None or self._snapshot != self._to_dict()
+
+    def _markClean(self):
+        # deep copy, so in-place changes to lists and dicts are noticed
+        self._snapshot = copy.deepcopy(self._to_dict())
+
+    @classmethod
+    def _post_get_hook(cls, key, future):
+        entity = future.get_result()
+        # the context cache hands out the same object on every get, keep
+        # the changes made since the first one
+        if entity is not None and entity._snapshot is None:
+            entity._markClean()
+
+    def _post_put_hook(self, future):
+        if future.get_exception() is None:
+            self._markClean()
+
+
+class Profile(TrackedModel):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # superseded by Registration, read by the registrations migration only
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
+    # superseded by WishlistEntry, read by the wishlists migration only
     sessionWishlist = ndb.StringProperty(repeated=True)
 
 
+class Registration(TrackedModel):
+    """Registration -- a Profile's registration for a Conference; child of
+    the Profile, its id is the websafe conference key"""
+    conference = ndb.KeyProperty(kind='Conference')
+
+
+class WishlistEntry(TrackedModel):
+    """WishlistEntry -- a Session on a Profile's wishlist; child of the
+    Profile, its id is the websafe session key"""
+    session = ndb.KeyProperty(kind='Session')
+    conference = ndb.KeyProperty(kind='Conference')
+
+
+class WishlistForm(messages.Message):
+    """WishlistForm -- websafe session keys to add to or remove from the
+    wishlist, or that were added or removed"""
+    websafeSessionKeys = messages.StringField(1, repeated=True)
+
+
+class AttendeeForms(messages.Message):
+    """AttendeeForms -- one page of a conference's attendee user ids"""
+    attendees = messages.StringField(1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -56,11 +112,13 @@ class BooleanMessage(messages.Message):
     data = messages.BooleanField(1)
 
 
-class Conference(ndb.Model):
+class Conference(TrackedModel):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
+    # copy of the organizer's Profile.displayName, see saveProfile()
+    organizerDisplayName = ndb.StringProperty(indexed=False)
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
@@ -70,6 +128,18 @@ class Conference(ndb.Model):
     seatsAvailable  = ndb.IntegerProperty()
 
 
+class SeatShard(TrackedModel):
+    """SeatShard -- one slice of a Conference's available seats; a root
+    entity so registrations on different shards never contend"""
+    seatsAvailable  = ndb.IntegerProperty(indexed=False)
+
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- singleton holding the nearly sold out conferences
+    (websafe key -> name) shown in the announcement"""
+    conferences     = ndb.JsonProperty()
+
+
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
     name            = messages.StringField(1)
@@ -89,6 +159,7 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 
 class TeeShirtSize(messages.Enum):
@@ -120,6 +191,8 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    limit = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
 
 
 ########################################################################
@@ -135,7 +208,22 @@ class TypeOfSession(messages.Enum):
     MEETING = 5
 
 
-class Session(ndb.Model):
+# values of the fields a create request leaves out
+CONFERENCE_DEFAULTS = {
+    "city": "Default City",
+    "maxAttendees": 0,
+    "seatsAvailable": 0,
+    "topics": [ "Default", "Topic" ],
+}
+
+SESSION_DEFAULTS = {
+    "highlights": [ "Free", "Beer"],
+    "duration": 0,
+    "typeOfSession": TypeOfSession.NOT_SPECIFIED,
+}
+
+
+class Session(TrackedModel):
     name        = ndb.StringProperty(required=True)
     highlights  = ndb.StringProperty(repeated=True)
     speakerUserId   = ndb.StringProperty()
@@ -144,7 +232,66 @@ class Session(ndb.Model):
     date        = ndb.DateProperty()
     # we are only interested in the time, date is not important in this field
     startTime   = ndb.TimeProperty()
-    conferenceId    = ndb.StringProperty()
+    # sessions are children of their conference, queries use the ancestor
+    conferenceId    = ndb.StringProperty(indexed=False)
+
+
+class SearchTerm(ndb.Model):
+    """SearchTerm -- one bucket of a search term's posting list, keyed by
+    term:bucket: websafe document key -> term weight in the document. A
+    full bucket continues in child SearchTerms with ids 1..overflows"""
+    postings = ndb.JsonProperty(compressed=True)
+    overflows = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class SearchDocument(ndb.Model):
+    """SearchDocument -- term weights a Conference or Session was last
+    indexed with, keyed by the document's websafe key"""
+    weights = ndb.JsonProperty(compressed=True)
+
+
+class SearchResultForm(messages.Message):
+    """SearchResultForm -- one search hit"""
+    websafeKey = messages.StringField(1)
+    kind = messages.StringField(2)
+    name = messages.StringField(3)
+    score = messages.FloatField(4)
+
+
+class SearchResultForms(messages.Message):
+    """SearchResultForms -- one page of search hits, best first"""
+    items = messages.MessageField(SearchResultForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class TypeaheadIndex(ndb.Model):
+    """TypeaheadIndex -- one shard of the typeahead counts: conferences per
+    distinct value of the typeahead fields, {field: {value: count}}"""
+    counts = ndb.JsonProperty(compressed=True)
+    version = ndb.IntegerProperty(indexed=False, default=0)
+
+
+class TypeaheadSource(ndb.Model):
+    """TypeaheadSource -- the values a Conference is counted with; child of
+    its TypeaheadIndex shard, its id is the websafe conference key"""
+    values = ndb.JsonProperty()
+
+
+class SuggestionForm(messages.Message):
+    """SuggestionForm -- one typeahead suggestion"""
+    field = messages.StringField(1)
+    value = messages.StringField(2)
+
+
+class SuggestionForms(messages.Message):
+    """SuggestionForms -- typeahead suggestions in alphabetical order"""
+    items = messages.MessageField(SuggestionForm, 1, repeated=True)
+
+
+class SpeakerCounts(TrackedModel):
+    """SpeakerCounts -- speaker email -> number of sessions in the parent
+    Conference, kept up to date by session create and delete"""
+    counts = ndb.JsonProperty()
 
 
 class SessionForm(messages.Message):
@@ -161,3 +308,104 @@ class SessionForm(messages.Message):
 
 class SessionForms(messages.Message):
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class AgendaDayForm(messages.Message):
+    """AgendaDayForm -- one day of a conference agenda, sessions ordered by
+    startTime"""
+    date = messages.StringField(1)
+    items = messages.MessageField(SessionForm, 2, repeated=True)
+
+
+class AgendaForm(messages.Message):
+    """AgendaForm -- a conference's sessions grouped by date"""
+    days = messages.MessageField(AgendaDayForm, 1, repeated=True)
+
+
+class Agenda(ndb.Model):
+    """Agenda -- precomputed AgendaForm of the parent Conference, zlib
+    compressed protobuf encoding"""
+    data = ndb.BlobProperty()
+
+
+class SessionQueryForm(messages.Message):
+    field = messages.StringField(1)
+    operator = messages.StringField(2)
+    value = messages.StringField(3)
+
+
+class SessionQueryForms(messages.Message):
+    filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+    websafeConferenceKey = messages.StringField(2)
+    limit = messages.IntegerField(3)
+    pageToken = messages.StringField(4)
+
+
+class SpeakerForm(messages.Message):
+    speakerUserId = messages.StringField(1)
+    sessions = messages.IntegerField(2)
+
+
+class SpeakerForms(messages.Message):
+    items = messages.MessageField(SpeakerForm, 1, repeated=True)
+
+
+class CacheStatsForm(messages.Message):
+    """CacheStatsForm -- per-instance cache hit/miss counters"""
+    name = messages.StringField(1)
+    capacity = messages.IntegerField(2)
+    size = messages.IntegerField(3)
+    localHits = messages.IntegerField(4)
+    memcacheHits = messages.IntegerField(5)
+    misses = messages.IntegerField(6)
+    invalidations = messages.IntegerField(7)
+    staleHits = messages.IntegerField(8)
+
+
+class CacheStatsForms(messages.Message):
+    """CacheStatsForms -- multiple CacheStatsForm outbound form message"""
+    items = messages.MessageField(CacheStatsForm, 1, repeated=True)
+
+
+class LatencyBucketForm(messages.Message):
+    """LatencyBucketForm -- requests that took at most upperMs (open ended
+    when upperMs is unset)"""
+    upperMs = messages.IntegerField(1)
+    count = messages.IntegerField(2)
+
+
+class RpcStatsForm(messages.Message):
+    """RpcStatsForm -- calls and time spent in one kind of RPC"""
+    name = messages.StringField(1)
+    count = messages.IntegerField(2)
+    totalMs = messages.FloatField(3)
+
+
+class CounterForm(messages.Message):
+    """CounterForm -- named counter value"""
+    name = messages.StringField(1)
+    value = messages.IntegerField(2)
+
+
+class MethodStatsForm(messages.Message):
+    """MethodStatsForm -- rolling per-method request statistics"""
+    method = messages.StringField(1)
+    requests = messages.IntegerField(2)
+    meanMs = messages.FloatField(3)
+    p95Ms = messages.FloatField(4)
+    buckets = messages.MessageField(LatencyBucketForm, 5, repeated=True)
+    rpcs = messages.MessageField(RpcStatsForm, 6, repeated=True)
+    counters = messages.MessageField(CounterForm, 7, repeated=True)
+    nPlusOne = messages.IntegerField(8)
+
+
+class MethodStatsForms(messages.Message):
+    """MethodStatsForms -- multiple MethodStatsForm outbound form message"""
+    items = messages.MessageField(MethodStatsForm, 1, repeated=True)
+
+
+class MigrationForm(messages.Message):
+    """MigrationForm -- started datastore migration"""
+    name = messages.StringField(1)
+    cursor = messages.StringField(2)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+"""planner.py
+
+Small query planner working around Datastore's single inequality property
+limit. Equality filters and the inequality filters on the most selective
+property are pushed down to a keys-only Datastore query, as far as the
+indexes of index.yaml serve it; the remaining predicates are applied to the
+fetched entities in a streaming post-filter.
+
+Filters are dicts {'field': property name, 'operator': one of OPERATORS'
+values, 'value': value of the property's type}, as built by
+ConferenceApi._formatFilters(), which also brings them to canonical form
+with QueryPlanner.normalize().
+
+"""
+
+import operator
+
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.net.proto import ProtocolBuffer
+
+from indexadvisor import builtIn
+from indexadvisor import exactIndex
+from indexadvisor import recordQuery
+from indexadvisor import usedBy
+
+COMPARATORS = {
+    '=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
+# canonical order of the filters on one property
+OPERATOR_ORDER = ('=', '>', '>=', '<', '<=', '!=')
+# entities fetched per get_multi while post-filtering
+FETCH_BATCH_SIZE = 100
+# keys examined per page at most, a page may come back short
+MAX_SCAN = 1000
+# assumed fraction of entities matching a bound on a property of unknown range
+DEFAULT_SELECTIVITY = 0.5
+
+
+class QueryPlanner(object):
+    """QueryPlanner -- plans filter lists over one ndb Model.
+
+    domains maps property names to their (min, max) value range, expressed
+    as numbers by an optional third tuple item, and lets the planner
+    estimate which inequality property is the most selective one. They are
+    estimates only; bounds maps property names to the (min, max) range
+    every stored value is guaranteed to be in, either end None when
+    unbounded, and only those let normalize() rule filters out.
+
+    indexes are the composite indexes Datastore has, as returned by
+    indexadvisor.loadIndexes(); filters no index serves together with the
+    sort orders are applied in memory instead. None assumes every query is
+    served.
+    """
+    def __init__(self, model, domains=None, order=None, bounds=None,
+                 indexes=None):
+        self.model = model
+        self.domains = domains or {}
+        self.order = order
+        self.bounds = bounds or {}
+        self.kind = model._get_kind()
+        if indexes is not None:
+            indexes = [i for i in indexes if i[0] == self.kind]
+        self.indexes = indexes
+
+    def _selectivity(self, field, filters):
+        """Estimated fraction of entities matching filters on field."""
+        if field not in self.domains:
+            return DEFAULT_SELECTIVITY ** len(filters)
+        low, high, toNumber = (self.domains[field] + (float,))[:3]
+        low, high = toNumber(low), toNumber(high)
+        lower, upper = low, high
+        for f in filters:
+            value = toNumber(f['value'])
+            if f['operator'] in ('>', '>='):
+                lower = max(lower, value)
+            else:
+                upper = min(upper, value)
+        return max(upper - lower, 0) / float(high - low or 1)
+
+    def inBounds(self, field, value):
+        """True when value is within the bounds of field, if it has any."""
+        low, high = self.bounds.get(field, (None, None))
+        return (low is None or value >= low) and \
+            (high is None or value <= high)
+
+    def normalize(self, filters):
+        """Return filters in canonical form, or None when they contradict
+        each other or the property bounds so that nothing can match.
+
+        Duplicates go away, the range filters on a property are merged into
+        one lower and one upper bound (an equality when they meet) and
+        predicates implied by an equality are dropped. Equalities come first,
+        by property name like the index.yaml entries, then inequalities.
+        """
+        byField = {}
+        for f in filters:
+            byField.setdefault(f['field'], []).append(f)
+        normalized = []
+        for field, fieldFilters in byField.items():
+            fieldFilters = self._normalizeField(field, fieldFilters)
+            if fieldFilters is None:
+                return None
+            normalized.extend(fieldFilters)
+        normalized.sort(key=lambda f: (f['operator'] != '=', f['field'],
+                                       OPERATOR_ORDER.index(f['operator']),
+                                       f['value']))
+        return normalized
+
+    def _normalizeField(self, field, filters):
+        prop = self.model._properties.get(field)
+        # every equality on a repeated property may match a different value
+        repeated = prop is not None and prop._repeated
+        equals, notEquals, lower, upper = set(), set(), None, None
+        for f in filters:
+            op, value = f['operator'], f['value']
+            if op == '=':
+                equals.add(value)
+            elif op == '!=':
+                notEquals.add(value)
+            elif op in ('>', '>='):
+                # the larger bound wins, exclusive beats inclusive
+                if lower is None or (value, op == '>') > lower:
+                    lower = (value, op == '>')
+            # the smaller bound wins, exclusive beats inclusive
+            elif upper is None or (value, op != '<') < (upper[0], not upper[1]):
+                upper = (value, op == '<')
+
+        def inRange(value):
+            if lower is not None and (value < lower[0] or
+                                      (value == lower[0] and lower[1])):
+                return False
+            if upper is not None and (value > upper[0] or
+                                      (value == upper[0] and upper[1])):
+                return False
+            return True
+
+        if field in self.bounds:
+            low, high = self.bounds[field]
+            if not all(self.inBounds(field, value) for value in equals):
+                return None
+            if lower is not None and high is not None and \
+                    (lower[0] > high or (lower[0] == high and lower[1])):
+                return None
+            if upper is not None and low is not None and \
+                    (upper[0] < low or (upper[0] == low and upper[1])):
+                return None
+        if lower is not None and upper is not None:
+            if lower[0] > upper[0] or \
+                    (lower[0] == upper[0] and (lower[1] or upper[1])):
+                return None
+            if lower[0] == upper[0]:
+                # x >= v AND x <= v
+                equals.add(lower[0])
+                lower = upper = None
+
+        if not repeated:
+            if len(equals) > 1:
+                return None
+            if equals:
+                value = equals.pop()
+                if value in notEquals or not inRange(value):
+                    return None
+                return [{'field': field, 'operator': '=', 'value': value}]
+            # a != outside the range can't exclude anything
+            notEquals = set(v for v in notEquals if inRange(v))
+
+        normalized = [{'field': field, 'operator': '=', 'value': v}
+                      for v in equals]
+        normalized.extend({'field': field, 'operator': '!=', 'value': v}
+                          for v in notEquals)
+        if lower is not None:
+            normalized.append({'field': field, 'value': lower[0],
+                               'operator': '>' if lower[1] else '>='})
+        if upper is not None:
+            normalized.append({'field': field, 'value': upper[0],
+                               'operator': '<' if upper[1] else '<='})
+        return normalized
+
+    def _orders(self, pushed):
+        """Sort orders of a query with pushed as its inequality property."""
+        orders = [pushed] if pushed else []
+        if self.order is not None and self.order._name != pushed:
+            orders.append(self.order._name)
+        return orders
+
+    def _served(self, ancestor, fields, orders):
+        """Return the equality properties among fields a query sorted by
+        orders can filter on with the built-in and composite indexes, or
+        None when no index serves the orders at all."""
+        shape = (self.kind, ancestor, tuple(sorted(set(fields))), None,
+                 tuple(orders))
+        if self.indexes is None or builtIn(shape):
+            return set(fields)
+        served = set()
+        for index in self.indexes:
+            if usedBy(index, shape):
+                # a merge join of indexes covering some of the equalities
+                served.update(index[2][:len(index[2]) - len(orders)])
+        if served:
+            return served
+        unfiltered = (self.kind, ancestor, (), None, tuple(orders))
+        if builtIn(unfiltered) or exactIndex(unfiltered) in self.indexes:
+            return served
+        return None
+
+    def pushesDown(self, filters, ancestor=None):
+        """True when Datastore applies every one of filters, with at most
+        one inequality property, sorted like plan() sorts."""
+        if any(f['operator'] == '!=' for f in filters):
+            return False
+        fields = set(f['field'] for f in filters if f['operator'] != '=')
+        if len(fields) > 1:
+            return False
+        equalities = set(f['field'] for f in filters if f['operator'] == '=')
+        return self._served(ancestor is not None, equalities,
+                            self._orders(next(iter(fields), None))) \
+            == equalities
+
+    def plan(self, filters, ancestor=None, keyOrder=False):
+        """Return a QueryPlan for filters.
+
+        The inequality pushed down is the most selective one for which
+        indexes serve every equality, falling back to fewer sort orders
+        and, failing that, to the built-in indexes, which serve all
+        equalities when the query is in key order. keyOrder skips straight
+        to the latter, all inequalities are applied in memory.
+        """
+        equalities = [f for f in filters if f['operator'] == '=']
+        ranges = {}
+        for f in filters:
+            # != is never pushed down, ndb would split it in two queries
+            if f['operator'] not in ('=', '!='):
+                ranges.setdefault(f['field'], []).append(f)
+        candidates = [(field, self._orders(field)) for field in sorted(
+            ranges, key=lambda field: (
+                self._selectivity(field, ranges[field]), field))]
+        candidates.extend([(None, self._orders(None)), (None, [])])
+        if keyOrder:
+            candidates = candidates[-1:]
+        fields = set(f['field'] for f in equalities)
+        for pushed, orders in candidates:
+            if self._served(ancestor is not None, fields, orders) == fields:
+                break
+        residual = [f for f in filters
+                    if f['operator'] == '!=' or
+                    (f['operator'] != '=' and f['field'] != pushed)]
+
+        q = self.model.query(ancestor=ancestor)
+        for f in equalities + ranges.get(pushed, []):
+            prop = self.model._properties[f['field']]
+            q = q.filter(COMPARATORS[f['operator']](prop, f['value']))
+        for field in orders:
+            q = q.order(self.model._properties[field])
+        # the advisor sees the query the planner would rather have run, so
+        # it proposes the indexes that were missing
+        best, bestOrders = candidates[0]
+        recordQuery(self.kind, equalities + ranges.get(best, []),
+                    bestOrders, ancestor is not None)
+        return QueryPlan(q, residual, pushed)
+
+
+class QueryPlan(object):
+    """QueryPlan -- keys-only Datastore query plus in-memory predicates"""
+    def __init__(self, query, residual, pushed):
+        self.query = query
+        self.residual = residual
+        self.pushed = pushed
+
+    def matches(self, entity):
+        for f in self.residual:
+            value = getattr(entity, f['field'])
+            values = value if isinstance(value, list) else [value]
+            compare = COMPARATORS[f['operator']]
+            # like Datastore: missing values never match, repeated
+            # properties match when one of their values does
+            if not any(v is not None and compare(v, f['value'])
+                       for v in values):
+                return False
+        return True
+
+    def _scan(self, pageToken, fetch):
+        """Yield (key, entity, cursor after key) for each key the query
+        returns, MAX_SCAN keys at most. key is None for duplicates and for
+        entities failing the post-filter; entity is None unless fetch is set
+        or the post-filter needed it, otherwise only keys are read."""
+        try:
+            start = Cursor(urlsafe=pageToken) if pageToken else None
+        except datastore_errors.BadValueError:
+            raise ValueError('Invalid pageToken')
+        fetch = fetch or bool(self.residual)
+        keys = self.query.iter(keys_only=True, start_cursor=start,
+                               produce_cursors=True,
+                               batch_size=FETCH_BATCH_SIZE)
+        seen, batch, scanned = set(), [], 0
+        for key in keys:
+            scanned += 1
+            # dedupe by key before fetching
+            batch.append((key if key not in seen else None,
+                          keys.cursor_after()))
+            seen.add(key)
+            if len(batch) >= FETCH_BATCH_SIZE or scanned >= MAX_SCAN:
+                for item in self._check(batch, fetch):
+                    yield item
+                batch = []
+                if scanned >= MAX_SCAN:
+                    return
+        for item in self._check(batch, fetch):
+            yield item
+
+    def _check(self, batch, fetch):
+        if not fetch:
+            for key, after in batch:
+                yield key, None, after
+            return
+        entities = ndb.get_multi([key for key, _ in batch if key is not None])
+        entities.reverse()
+        for key, after in batch:
+            entity = entities.pop() if key is not None else None
+            if entity is None or not self.matches(entity):
+                key = None
+            yield key, entity, after
+
+    def fetchPage(self, limit, pageToken=None):
+        """Return (entities, nextPageToken) for up to limit matches; the page
+        token is the cursor right after the last key examined."""
+        results, cursor, scanned, stopped = [], None, 0, False
+        for key, entity, after in self._scan(pageToken, True):
+            scanned += 1
+            cursor = after
+            if key is not None:
+                results.append(entity)
+                if len(results) >= limit:
+                    stopped = True
+                    break
+        more = stopped or scanned >= MAX_SCAN
+        return results, (cursor.urlsafe() if more and cursor else None)
+
+    def fetchParentKeysPage(self, limit, pageToken=None):
+        """Return (parent keys, nextPageToken) for up to limit distinct
+        parents of the matching entities, reading keys only when no
+        post-filter is needed.
+
+        The query must be in key order, see plan(keyOrder=True), so the
+        children of a parent come one after the other. A page ends right
+        before the first key of the next parent, and the page token also
+        carries the last parent returned, so a page cut short by MAX_SCAN
+        in the middle of a parent's children doesn't return it again.
+        """
+        last = None
+        if pageToken and '.' in pageToken:
+            pageToken, last = pageToken.split('.', 1)
+            try:
+                last = ndb.Key(urlsafe=last)
+            except (TypeError, ProtocolBuffer.ProtocolBufferDecodeError):
+                raise ValueError('Invalid pageToken')
+        parents = []
+        cursor, scanned, stopped = None, 0, False
+        for key, _, after in self._scan(pageToken, False):
+            if key is not None:
+                parent = key.parent()
+                if parent != last:
+                    if len(parents) >= limit:
+                        stopped = True
+                        break
+                    parents.append(parent)
+                    last = parent
+            scanned += 1
+            cursor = after
+        if not (stopped or scanned >= MAX_SCAN) or not cursor:
+            return parents, None
+        if last is None:
+            return parents, cursor.urlsafe()
+        return parents, '%s.%s' % (cursor.urlsafe(), last.urlsafe())
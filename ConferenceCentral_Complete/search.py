@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""search.py
+
+Local full-text search over Conferences and Sessions. Conference names,
+descriptions and topics and Session names and highlights are tokenized into
+an inverted index. The posting list of a term is split by document over
+NUM_TERM_BUCKETS SearchTerm entities, so a query is one batch get of its
+terms' buckets, ranked in memory. A full bucket continues in overflow
+entities in its entity group, read by a second batch get. Writes queue a /tasks/index_document task
+that brings the postings of the changed document up to date, one
+transaction per bucket; SearchDocument remembers what each document was
+indexed with.
+
+"""
+
+import heapq
+import logging
+import math
+import re
+import zlib
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import CONFERENCE_DEFAULTS
+from models import SESSION_DEFAULTS
+from models import SearchDocument
+from models import SearchTerm
+
+# weight of one occurrence of a term, per indexed field
+FIELD_WEIGHTS = {
+    'Conference': {'name': 3, 'topics': 2, 'description': 1},
+    'Session': {'name': 3, 'highlights': 2},
+}
+# values filled in for fields a create request left out, not indexed
+PLACEHOLDERS = {
+    'Conference': CONFERENCE_DEFAULTS,
+    'Session': SESSION_DEFAULTS,
+}
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'the', 'to', 'with',
+))
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# longer tokens are not indexed, key names are limited to 500 bytes
+MAX_TERM_LENGTH = 100
+# terms of a query considered at most
+MAX_QUERY_TERMS = 10
+# buckets per term: the documents of a term are spread over as many entity
+# groups, so indexing a common term doesn't serialize on one of them
+NUM_TERM_BUCKETS = 16
+# postings per SearchTerm entity at most, far below the 1MB entity limit;
+# more documents go to the bucket's overflow entities
+MAX_BUCKET_POSTINGS = 2000
+
+
+def tokenize(text):
+    """Return the lowercased words of text, stopwords left out."""
+    return [t for t in TOKEN_RE.findall((text or '').lower())
+            if t not in STOPWORDS and len(t) <= MAX_TERM_LENGTH]
+
+
+def documentTerms(entity):
+    """Return {term: weight} for a Conference or Session."""
+    kind = entity.key.kind()
+    weights = {}
+    for field, weight in FIELD_WEIGHTS[kind].items():
+        value = getattr(entity, field)
+        if value == PLACEHOLDERS[kind].get(field):
+            continue
+        for text in (value if isinstance(value, list) else [value]):
+            for term in tokenize(text):
+                weights[term] = weights.get(term, 0) + weight
+    return weights
+
+
+def documentChanged(key):
+    """Queue the reindexing of a created, updated or deleted document.
+    Inside a transaction the task is only added if it commits."""
+    taskqueue.add(params={'websafeKey': key.urlsafe()},
+                  url='/tasks/index_document',
+                  transactional=ndb.in_transaction())
+
+
+def indexDocument(wsk):
+    """Bring the postings of one document up to date; a deleted document
+    is removed from the index."""
+    key = ndb.Key(urlsafe=wsk)
+    entity, doc = ndb.get_multi([key, ndb.Key(SearchDocument, wsk)])
+    _index(wsk, entity, doc)
+
+
+def indexEntities(entities):
+    """Index a batch of existing documents, see the search migrations."""
+    docs = ndb.get_multi([ndb.Key(SearchDocument, e.key.urlsafe())
+                          for e in entities])
+    for entity, doc in zip(entities, docs):
+        _index(entity.key.urlsafe(), entity, doc)
+
+
+def _index(wsk, entity, doc):
+    new = documentTerms(entity) if entity else {}
+    old = doc.weights if doc else {}
+    changed = [t for t in set(old) | set(new) if old.get(t) != new.get(t)]
+    # one transaction per term bucket, all of them side by side; a failed
+    # one fails the task, whose retry redoes the same changes
+    for future in [_setPosting(t, wsk, new.get(t)) for t in changed]:
+        future.get_result()
+    if new:
+        SearchDocument(id=wsk, weights=new).put()
+    elif doc:
+        doc.key.delete()
+
+
+def _bucket(wsk):
+    return (zlib.crc32(wsk.encode('utf-8')) & 0xffffffff) % NUM_TERM_BUCKETS
+
+
+def _termKey(term, bucket):
+    return ndb.Key(SearchTerm, '%s:%d' % (term, bucket))
+
+
+def _overflowKeys(entry):
+    return [ndb.Key(SearchTerm, n, parent=entry.key)
+            for n in range(1, entry.overflows + 1)]
+
+
+@ndb.transactional_tasklet
+def _setPosting(term, wsk, weight):
+    key = _termKey(term, _bucket(wsk))
+    entry = yield key.get_async()
+    bucket = entry or SearchTerm(key=key, postings={})
+    slots = [bucket]
+    if bucket.overflows:
+        keys = _overflowKeys(bucket)
+        overflows = yield ndb.get_multi_async(keys)
+        slots += [o or SearchTerm(key=k, postings={})
+                  for k, o in zip(keys, overflows)]
+    changed = [s for s in slots if wsk in s.postings]
+    if weight:
+        if not changed:
+            changed = [s for s in slots
+                       if len(s.postings) < MAX_BUCKET_POSTINGS][:1]
+        if not changed:
+            # every entity of the bucket is full, chain another one
+            bucket.overflows += 1
+            logging.info('search term %s: bucket %s overflows into %d',
+                         term, key.id(), bucket.overflows)
+            changed = [bucket, SearchTerm(key=_overflowKeys(bucket)[-1],
+                                          postings={})]
+        changed[-1].postings[wsk] = weight
+    elif changed:
+        del changed[0].postings[wsk]
+    else:
+        return
+    if bucket.postings or bucket.overflows:
+        yield ndb.put_multi_async(changed)
+    elif entry:
+        yield key.delete_async()
+
+
+def search(query, kind=None, limit=20, offset=0):
+    """Return ([(websafe key, score)] best first, total hits) for the page
+    of documents, of kind if given, containing every term of query.
+
+    A document scores the sum of its term weights times the terms' inverse
+    document frequency relative to the most common term of the query, so
+    rare terms and matches in names count most.
+    """
+    terms = sorted(set(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return [], 0
+    entries = [e for e in ndb.get_multi([_termKey(t, b) for t in terms
+                                         for b in range(NUM_TERM_BUCKETS)])
+               if e]
+    overflowKeys = [k for e in entries for k in _overflowKeys(e)]
+    if overflowKeys:
+        entries += [e for e in ndb.get_multi(overflowKeys) if e]
+    merged = dict((t, {}) for t in terms)
+    for entry in entries:
+        merged[entry.key.root().id().rsplit(':', 1)[0]].update(
+            entry.postings)
+    postings = list(merged.values())
+    if not all(postings):
+        return [], 0
+    # walk the shortest posting list, look documents up in the others
+    postings.sort(key=len)
+    maxDf = float(len(postings[-1]))
+    idfs = [math.log(1 + maxDf / len(p)) for p in postings]
+    scores = []
+    for wsk in postings[0]:
+        if not all(wsk in p for p in postings[1:]):
+            continue
+        if kind and ndb.Key(urlsafe=wsk).kind() != kind:
+            continue
+        scores.append((sum(p[wsk] * idf for p, idf in zip(postings, idfs)),
+                       wsk))
+    # ties in a stable order, so pages don't overlap
+    page = heapq.nlargest(offset + limit, scores)[offset:]
+    return [(wsk, score) for score, wsk in page], len(scores)
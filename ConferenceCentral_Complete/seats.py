@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counter for Conferences. Registrations decrement one of
+NUM_SEAT_SHARDS SeatShard entities instead of rewriting the Conference, and
+Conference.seatsAvailable is periodically reconciled from the shards.
+
+"""
+
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+# changing this requires migrating the shards of existing conferences
+NUM_SEAT_SHARDS = 20
+MEMCACHE_SEATS_PREFIX = 'SEATS:'
+SEATS_CACHE_TTL = 60
+# seconds a dropped count can't be put back in memcache, so a reader that
+# summed the shards before the write does not restore it
+SEATS_LOCK_SECONDS = 2
+# stands in for a dropped count while it is locked; unlike a delete lock
+# it also keeps out counts of conferences that weren't cached
+LOCKED = 'LOCKED'
+# a conference is reconciled at most once per this many seconds
+RECONCILE_DELAY = 60
+
+
+def _shardKeys(wsck):
+    return [ndb.Key(SeatShard, '%s:%d' % (wsck, i))
+            for i in range(NUM_SEAT_SHARDS)]
+
+
+def _split(seats):
+    """Spread seats as evenly as possible over NUM_SEAT_SHARDS."""
+    base, extra = divmod(max(seats or 0, 0), NUM_SEAT_SHARDS)
+    return [base + (1 if i < extra else 0) for i in range(NUM_SEAT_SHARDS)]
+
+
+def newSeatShards(conf_key, seats):
+    """Return the shards of a newly created conference, for the caller to
+    write along with it."""
+    return [SeatShard(key=k, seatsAvailable=n) for k, n in
+            zip(_shardKeys(conf_key.urlsafe()), _split(seats))]
+
+
+def createSeatShards(conf_key, seats):
+    """Write the shards of a newly created conference."""
+    ndb.put_multi(newSeatShards(conf_key, seats))
+
+
+def resetSeats(conf, seats):
+    """Make seats the seats available of conf, spread over its shards
+    anew; Conference.seatsAvailable follows. Returns the shards, for the
+    caller to write along with conf in a cross-group transaction: they are
+    read first, so a registration taking a seat at the same time retries
+    against the new ones. Call seatsChanged() once it committed."""
+    keys = _shardKeys(conf.key.urlsafe())
+    shards = [s or SeatShard(key=k) for s, k in zip(ndb.get_multi(keys), keys)]
+    for shard, n in zip(shards, _split(seats)):
+        shard.seatsAvailable = n
+    conf.seatsAvailable = seats
+    return shards
+
+
+def getSeatShards(conf):
+    """Return all shards of conf, creating the missing ones for conferences
+    that were created before seats were sharded."""
+    keys = _shardKeys(conf.key.urlsafe())
+    shards = ndb.get_multi(keys)
+    if None in shards:
+        split = _split(conf.seatsAvailable)
+        shards = [s or SeatShard.get_or_insert(k.id(), seatsAvailable=n)
+                  for s, k, n in zip(shards, keys, split)]
+    return shards
+
+
+def candidateShardKeys(conf, reg=True):
+    """Return shard keys to try, in order, for a registration (shards with
+    seats left) or an unregistration (any shard)."""
+    shards = getSeatShards(conf)
+    if reg:
+        shards = [s for s in shards if s.seatsAvailable > 0]
+    random.shuffle(shards)
+    return [s.key for s in shards]
+
+
+def getSeatsAvailable(stored):
+    """Return seats available per conference, aggregated over the shards.
+
+    stored maps websafe conference keys to their Conference.seatsAvailable,
+    which stands in for the shards of conferences that have none yet.
+    Results are cached in memcache for SEATS_CACHE_TTL seconds.
+    """
+    return getSeatsAvailableAsync(stored).get_result()
+
+
+@ndb.tasklet
+def getSeatsAvailableAsync(stored):
+    """Tasklet version of getSeatsAvailable(). The stored values may be
+    Futures of them, they are only waited for on a memcache miss."""
+    ctx = ndb.get_context()
+    wscks = list(stored)
+    # the context batches these into one memcache get
+    cached = yield [ctx.memcache_get(MEMCACHE_SEATS_PREFIX + wsck)
+                    for wsck in wscks]
+    seats = dict((wsck, n) for wsck, n in zip(wscks, cached)
+                 if n not in (None, LOCKED))
+    missing = [wsck for wsck in wscks if wsck not in seats]
+    if missing:
+        # one batch get for the shards of every uncached conference
+        shards = yield ndb.get_multi_async(
+            [k for wsck in missing for k in _shardKeys(wsck)])
+        fresh = {}
+        for i, wsck in enumerate(missing):
+            value = stored[wsck]
+            if isinstance(value, ndb.Future):
+                value = yield value
+            split = _split(value)
+            fresh[wsck] = sum(
+                s.seatsAvailable if s else n for s, n in
+                zip(shards[i * NUM_SEAT_SHARDS:(i + 1) * NUM_SEAT_SHARDS], split))
+        # add() so a locked (just dropped) count stays out, see seatsChanged()
+        yield [ctx.memcache_add(MEMCACHE_SEATS_PREFIX + wsck, n,
+                                time=SEATS_CACHE_TTL)
+               for wsck, n in fresh.items()]
+        seats.update(fresh)
+    raise ndb.Return(seats)
+
+
+def seatsChanged(conf_key):
+    """Drop the cached seat count and schedule a reconciliation."""
+    wsck = conf_key.urlsafe()
+    memcache.set(MEMCACHE_SEATS_PREFIX + wsck, LOCKED, time=SEATS_LOCK_SECONDS)
+    # named per time bucket, so a burst of registrations folds into one task
+    bucket = int(time.time()) // RECONCILE_DELAY
+    try:
+        taskqueue.add(name='reconcile-seats-%s-%d' % (wsck, bucket),
+                      params={'websafeConferenceKey': wsck},
+                      url='/tasks/reconcile_seats',
+                      countdown=RECONCILE_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def reconcileSeats(wsck):
+    """Fold the shards back into Conference.seatsAvailable."""
+    return _reconcile(ndb.Key(urlsafe=wsck))
+
+
+# the shards are read in the transaction too, so a registration or reset
+# committing in between makes it retry instead of being overwritten with
+# the old total; they and the conference are 21 entity groups
+@ndb.transactional(xg=True)
+def _reconcile(conf_key):
+    conf = conf_key.get()
+    if not conf:
+        return None
+    seats = sum(s.seatsAvailable for s in getSeatShards(conf))
+    if conf.seatsAvailable != seats:
+        conf.seatsAvailable = seats
+        conf.put()
+    return seats
@@ -16,3 +16,14 @@ WEB_CLIENT_ID = '431778410975-3npkvitet5cp2el72pno1k6ifsdohb9s.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Verify ID tokens locally against cached signing keys instead of calling
+# the tokeninfo endpoint (utils.getUserId, id_type="oauth")
+OFFLINE_TOKEN_VERIFICATION = True
+
+# Accounts allowed to call the admin-only API methods
+ADMIN_EMAILS = []
+
+# Let anonymous queryConferences calls get a result cached before the last
+# conference write while one request recomputes it
+STALE_WHILE_REVALIDATE = True
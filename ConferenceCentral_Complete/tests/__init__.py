@@ -0,0 +1,19 @@
+"""Unit tests, run on the App Engine testbed stubs from this directory's
+parent:
+
+    APPENGINE_SDK=~/google-cloud-sdk/platform/google_appengine \\
+        python -m unittest discover -s tests -t .
+
+"""
+
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if os.environ.get('APPENGINE_SDK'):
+    sys.path.insert(0, os.environ['APPENGINE_SDK'])
+import dev_appserver
+dev_appserver.fix_sys_path()
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
@@ -0,0 +1,87 @@
+"""Conference agenda tests."""
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class AgendaTest(TestbedTestCase):
+
+    def setUp(self):
+        super(AgendaTest, self).setUp()
+        from conference import ConferenceApi
+        from models import Conference, ConferenceForm
+        self.api = ConferenceApi()
+        self.api.createConference(ConferenceForm(name='Mole Summit'))
+        self.conf_key = Conference.query().get().key
+        for name, day, start in [('Late', '2026-06-01', '20:00'),
+                                 ('Second day', '2026-06-02', '09:00'),
+                                 ('Early', '2026-06-01', '09:30'),
+                                 ('Undated', None, None)]:
+            self.createSession(name, day, start)
+        self.runTasks('/tasks/rebuild_agenda')
+        self.rpcs = []
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'rpcs', self.record)
+
+    def record(self, service, call, request, response):
+        self.rpcs.append('%s.%s' % (service, call))
+
+    def createSession(self, name, day=None, start=None):
+        from models import SessionForm
+        self.api.createSession(SessionForm(
+            name=name, conferenceId=self.conf_key.urlsafe(), date=day,
+            startTime=start, duration=30))
+
+    def agenda(self):
+        """Return [(date, [session names])] as a new request sees it."""
+        from conference import CONF_GET_REQUEST
+        ndb.get_context().clear_cache()
+        self.rpcs = []
+        form = self.api.getConferenceAgenda(
+            CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=self.conf_key.urlsafe()))
+        return [(day.date, [s.name for s in day.items]) for day in form.days]
+
+    def testGroupedByDateInStartTimeOrder(self):
+        self.assertEqual(self.agenda(), [
+            ('2026-06-01', ['Early', 'Late']),
+            ('2026-06-02', ['Second day']),
+            (None, ['Undated']),
+        ])
+
+    def testServedFromOneCacheRead(self):
+        self.agenda()
+        self.agenda()
+        self.assertEqual(self.rpcs, ['memcache.Get'])
+        # evicted: the stored snapshot, not the sessions, is read
+        memcache.flush_all()
+        self.agenda()
+        self.assertNotIn('datastore_v3.RunQuery', self.rpcs)
+        self.assertIn('datastore_v3.Get', self.rpcs)
+
+    def testRebuiltAfterSessionEdits(self):
+        from conference import SESSION_GET_REQUEST
+        from models import Session
+        self.agenda()
+        self.createSession('Keynote', '2026-06-01', '08:00')
+        # the snapshot is dropped with the write, the task rebuilds it
+        self.assertEqual(self.runTasks('/tasks/rebuild_agenda'), 1)
+        self.assertEqual(self.agenda()[0],
+                         ('2026-06-01', ['Keynote', 'Early', 'Late']))
+        self.assertNotIn('datastore_v3.RunQuery', self.rpcs)
+        late = Session.query(Session.name == 'Late').get(keys_only=True)
+        self.api.deleteSession(SESSION_GET_REQUEST.combined_message_class(
+            websafeKey=late.urlsafe()))
+        self.runTasks('/tasks/rebuild_agenda')
+        self.assertEqual(self.agenda()[0],
+                         ('2026-06-01', ['Keynote', 'Early']))
+
+    def testBuiltOnDemandWhileRebuildPending(self):
+        self.createSession('Keynote', '2026-06-01', '08:00')
+        # no snapshot until the task runs: the request builds it
+        self.assertEqual(self.agenda()[0],
+                         ('2026-06-01', ['Keynote', 'Early', 'Late']))
+        self.assertIn('datastore_v3.RunQuery', self.rpcs)
@@ -0,0 +1,76 @@
+"""Nearly sold out announcement tests."""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class NearlySoldOutTest(TestbedTestCase):
+
+    def setUp(self):
+        super(NearlySoldOutTest, self).setUp()
+        from conference import ConferenceApi
+        from models import Conference, ConferenceForm
+        self.api = ConferenceApi()
+        self.api.createConference(ConferenceForm(name='Mole Summit',
+                                                 maxAttendees=7))
+        self.wsck = Conference.query().get().key.urlsafe()
+
+    def register(self, email, reg=True):
+        from conference import CONF_GET_REQUEST
+        self.login(email)
+        request = CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=self.wsck)
+        if reg:
+            return self.api.registerForConference(request)
+        return self.api.unregisterFromConference(request)
+
+    def announcement(self):
+        from protorpc import message_types
+        return self.api.getAnnouncement(message_types.VoidMessage()).data
+
+    def nearlySoldOut(self):
+        from models import NearlySoldOut
+        record = ndb.Key(NearlySoldOut, 1).get()
+        return sorted(record.conferences) if record else []
+
+    def testRegistrationsCrossTheThreshold(self):
+        self.register('a@example.com')
+        self.assertEqual(self.announcement(), '')
+        self.register('b@example.com')
+        # 5 seats left
+        self.assertEqual(self.nearlySoldOut(), [self.wsck])
+        self.assertIn('Mole Summit', self.announcement())
+        self.register('b@example.com', reg=False)
+        self.assertEqual(self.nearlySoldOut(), [])
+        self.assertEqual(self.announcement(), '')
+        for i in range(6):
+            self.register('user%d@example.com' % i)
+        # sold out is not nearly sold out
+        self.assertEqual(self.nearlySoldOut(), [])
+        self.assertEqual(self.announcement(), '')
+
+    def testEvictedAnnouncementRebuiltFromRecord(self):
+        self.register('a@example.com')
+        self.register('b@example.com')
+        memcache.flush_all()
+        self.assertIn('Mole Summit', self.announcement())
+
+    def testRepairCron(self):
+        import webapp2
+        import main
+        from conference import MEMCACHE_ANNOUNCEMENTS_KEY
+        from models import NearlySoldOut
+        self.register('a@example.com')
+        self.register('b@example.com')
+        # fold the seat shards into Conference.seatsAvailable
+        self.runTasks('/tasks/reconcile_seats')
+        ndb.Key(NearlySoldOut, 1).delete()
+        memcache.flush_all()
+        self.assertEqual(self.nearlySoldOut(), [])
+        response = webapp2.Request.blank(
+            '/crons/set_announcement').get_response(main.app)
+        self.assertEqual(response.status_int, 204)
+        self.assertEqual(self.nearlySoldOut(), [self.wsck])
+        self.assertIn('Mole Summit', memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY))
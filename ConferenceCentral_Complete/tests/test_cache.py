@@ -0,0 +1,67 @@
+"""GenerationalCache tests."""
+
+from google.appengine.api import memcache
+
+from cache import GenerationalCache
+from models import StringMessage
+from tests.base import TestbedTestCase
+
+
+class GenerationalCacheTest(TestbedTestCase):
+
+    def setUp(self):
+        super(GenerationalCacheTest, self).setUp()
+        self.cache = GenerationalCache('TEST', StringMessage)
+
+    def testEvictedGenerationRestartsAboveCachedOnes(self):
+        generation = self.cache.generation()
+        for _ in range(1000):
+            self.cache.bump()
+        generation = self.cache.generation()
+        self.cache.set('key', generation, StringMessage(data='old'))
+        memcache.delete(self.cache._generationKey)
+        self.assertGreater(self.cache.generation(), generation)
+        self.assertIsNone(self.cache.get('key', self.cache.generation()))
+        # a bump after an eviction restarts above them too
+        memcache.delete(self.cache._generationKey)
+        self.cache.bump()
+        self.assertGreater(self.cache.generation(), generation)
+
+    def testStaleLocalEntryChecksMemcache(self):
+        generation = self.cache.generation()
+        self.cache.set('key', generation, StringMessage(data='old'))
+        # another instance bumps and caches the current generation
+        other = GenerationalCache('TEST', StringMessage)
+        other.bump()
+        generation = other.generation()
+        other.set('key', generation, StringMessage(data='new'))
+        self.assertEqual(self.cache.get('key', generation).data, 'new')
+        self.assertEqual(self.cache.stats()['memcacheHits'], 1)
+        self.assertEqual(self.cache.get('key', generation).data, 'new')
+        self.assertEqual(self.cache.stats()['localHits'], 1)
+
+    def testOlderGenerationMisses(self):
+        generation = self.cache.generation()
+        self.cache.set('key', generation, StringMessage(data='old'))
+        self.cache.bump()
+        generation = self.cache.generation()
+        self.assertIsNone(self.cache.get('key', generation))
+        # the first stale reader recomputes, the others get the old entry
+        self.assertIsNone(self.cache.get('key', generation, stale=True))
+        self.assertEqual(self.cache.get('key', generation, stale=True).data,
+                         'old')
+
+
+class CacheStatsTest(TestbedTestCase):
+
+    def testAdminOnly(self):
+        import endpoints
+        from protorpc import message_types
+        import conference
+        api = conference.ConferenceApi()
+        with self.assertRaises(endpoints.ForbiddenException):
+            api.getCacheStats(message_types.VoidMessage())
+        conference.ADMIN_EMAILS.append('user@example.com')
+        self.addCleanup(conference.ADMIN_EMAILS.remove, 'user@example.com')
+        stats = api.getCacheStats(message_types.VoidMessage())
+        self.assertEqual(len(stats.items), 2)
@@ -0,0 +1,170 @@
+"""ConferenceApi tests."""
+
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class QueryConferencesTest(TestbedTestCase):
+
+    def setUp(self):
+        super(QueryConferencesTest, self).setUp()
+        from models import Conference, Profile
+        owner = ndb.Key(Profile, 'user@example.com')
+        cities = ['London', 'Paris', 'Tokyo']
+        self.conferences = ndb.put_multi([
+            Conference(parent=owner, name='Conference %02d' % i,
+                       city=cities[i % 3], month=i % 12 + 1,
+                       maxAttendees=10 * i, seatsAvailable=10 * i)
+            for i in range(20)])
+
+    def queryAll(self, filters, limit):
+        """Return the websafe keys of every page of a queryConferences."""
+        from conference import ConferenceApi
+        from models import ConferenceQueryForm, ConferenceQueryForms
+        keys, pageToken = [], None
+        while True:
+            forms = ConferenceApi().queryConferences(ConferenceQueryForms(
+                filters=[ConferenceQueryForm(field=f, operator=o, value=v)
+                         for f, o, v in filters],
+                limit=limit, pageToken=pageToken))
+            keys.extend(cf.websafeKey for cf in forms.items)
+            pageToken = forms.nextPageToken
+            if not pageToken:
+                return keys
+
+    def testNotEqualPages(self):
+        keys = self.queryAll([('CITY', 'NE', 'London')], 3)
+        self.assertEqual(len(keys), len(set(keys)))
+        self.assertEqual(
+            sorted(keys),
+            sorted(k.urlsafe() for k, i in zip(self.conferences, range(20))
+                   if i % 3 != 0))
+
+    def testNotEqualWithRangePages(self):
+        keys = self.queryAll([('CITY', 'NE', 'London'),
+                              ('MAX_ATTENDEES', 'GT', '50')], 4)
+        self.assertEqual(
+            sorted(keys),
+            sorted(k.urlsafe() for k, i in zip(self.conferences, range(20))
+                   if i % 3 != 0 and 10 * i > 50))
+
+
+class MoleConferencesTest(TestbedTestCase):
+
+    def setUp(self):
+        super(MoleConferencesTest, self).setUp()
+        from models import Conference, Profile, Session
+        owner = ndb.Key(Profile, 'user@example.com')
+        self.conferences = ndb.put_multi([
+            Conference(parent=owner, name='Conference %02d' % i)
+            for i in range(30)])
+        ndb.put_multi([
+            Session(parent=conf, name='Session %02d' % i,
+                    highlights=['moles'] if i % 5 else ['voles'],
+                    duration=30)
+            for i, conf in enumerate(self.conferences)])
+
+    def testPagesPastTheDefaultPageSize(self):
+        from conference import ConferenceApi, PAGE_REQUEST
+        keys, pageToken, pages = [], None, 0
+        while True:
+            forms = ConferenceApi().moleConferences(
+                PAGE_REQUEST.combined_message_class(pageToken=pageToken))
+            keys.extend(cf.websafeKey for cf in forms.items)
+            pages += 1
+            pageToken = forms.nextPageToken
+            if not pageToken:
+                break
+        self.assertEqual(pages, 2)
+        self.assertEqual(
+            sorted(set(keys)),
+            sorted(k.urlsafe() for i, k in enumerate(self.conferences)
+                   if i % 5))
+
+
+class RepeatingParentTest(TestbedTestCase):
+
+    def setUp(self):
+        super(RepeatingParentTest, self).setUp()
+        from models import Conference, Profile, Session
+        owner = ndb.Key(Profile, 'user@example.com')
+        self.a, self.b = ndb.put_multi([
+            Conference(parent=owner, name=name) for name in ('A', 'B')])
+        # in duration order the sessions alternate between A and B
+        ndb.put_multi([
+            Session(parent=conf, name='Session %d' % duration,
+                    highlights=['moles'], duration=duration)
+            for conf, duration in [(self.a, 10), (self.b, 20), (self.a, 50),
+                                   (self.b, 55), (self.a, 58)]])
+
+    def pages(self, limit):
+        from conference import ConferenceApi, PAGE_REQUEST
+        pages, pageToken = [], None
+        while True:
+            forms = ConferenceApi().moleConferences(
+                PAGE_REQUEST.combined_message_class(limit=limit,
+                                                    pageToken=pageToken))
+            pages.append([cf.name for cf in forms.items])
+            pageToken = forms.nextPageToken
+            if not pageToken:
+                return pages
+
+    def testParentsOnOnePageOnly(self):
+        self.assertEqual(self.pages(1), [['A'], ['B']])
+
+    def testScanCutInsideParent(self):
+        import planner
+        scan = planner.MAX_SCAN
+        planner.MAX_SCAN = 2
+        try:
+            names = [n for page in self.pages(10) for n in page]
+        finally:
+            planner.MAX_SCAN = scan
+        self.assertEqual(names, ['A', 'B'])
+
+
+class UpdateSeatsTest(TestbedTestCase):
+
+    def setUp(self):
+        super(UpdateSeatsTest, self).setUp()
+        from conference import ConferenceApi
+        from models import Conference, ConferenceForm
+        self.api = ConferenceApi()
+        self.api.createConference(ConferenceForm(name='Conference',
+                                                 maxAttendees=10))
+        self.wsck = Conference.query().get().key.urlsafe()
+
+    def update(self, **fields):
+        from conference import CONF_POST_REQUEST
+        return self.api.updateConference(
+            CONF_POST_REQUEST.combined_message_class(
+                websafeConferenceKey=self.wsck, **fields))
+
+    def available(self):
+        from conference import CONF_GET_REQUEST
+        return self.api.getConference(CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=self.wsck)).seatsAvailable
+
+    def testSeatsSpreadOverShards(self):
+        from conference import CONF_GET_REQUEST
+        import seats
+        self.assertEqual(self.update(seatsAvailable=47).seatsAvailable, 47)
+        self.assertEqual(self.available(), 47)
+        shards = ndb.get_multi(seats._shardKeys(self.wsck))
+        self.assertEqual([s.seatsAvailable for s in shards], seats._split(47))
+        self.api.registerForConference(CONF_GET_REQUEST.combined_message_class(
+            websafeConferenceKey=self.wsck))
+        self.assertEqual(self.available(), 46)
+        self.assertEqual(seats.reconcileSeats(self.wsck), 46)
+
+    def testOtherFieldsKeepSeats(self):
+        self.update(seatsAvailable=3)
+        self.assertEqual(self.update(city='Paris').seatsAvailable, 3)
+        self.assertEqual(self.available(), 3)
+
+    def testNegativeSeatsRejected(self):
+        import endpoints
+        with self.assertRaises(endpoints.BadRequestException):
+            self.update(seatsAvailable=-1)
+        self.assertEqual(self.available(), 10)
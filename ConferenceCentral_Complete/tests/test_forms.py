@@ -0,0 +1,70 @@
+"""CopyPlan tests."""
+
+from datetime import date, time
+
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class CopyPlanTest(TestbedTestCase):
+
+    def testConference(self):
+        from conference import CONFERENCE_PLAN
+        from models import Conference, Profile
+        conf = Conference(parent=ndb.Key(Profile, 'user@example.com'),
+                          name='Mole Summit', topics=['moles'],
+                          startDate=date(2026, 6, 1), month=6,
+                          organizerDisplayName='Organizer')
+        conf.put()
+        form = CONFERENCE_PLAN.copy(conf)
+        self.assertEqual(form.name, 'Mole Summit')
+        self.assertEqual(form.topics, ['moles'])
+        self.assertEqual(form.startDate, '2026-06-01')
+        self.assertEqual(form.month, 6)
+        self.assertEqual(form.organizerDisplayName, 'Organizer')
+        self.assertEqual(form.websafeKey, conf.key.urlsafe())
+        # unset properties stay unset on the form
+        self.assertIsNone(form.city)
+        self.assertIsNone(form.maxAttendees)
+
+    def testSessionsAndCopyAll(self):
+        from conference import SESSION_PLAN
+        from models import Conference, Session, TypeOfSession
+        conf_key = ndb.Key(Conference, 1)
+        sessions = [Session(parent=conf_key, id=i, name='Session %d' % i,
+                            typeOfSession=TypeOfSession.WORKSHOP,
+                            date=date(2026, 6, 1), startTime=time(19, i),
+                            conferenceId=conf_key.urlsafe())
+                    for i in range(1, 4)]
+        forms = SESSION_PLAN.copyAll(sessions)
+        self.assertEqual([f.startTime for f in forms],
+                         ['19:01:00', '19:02:00', '19:03:00'])
+        self.assertEqual(forms[0].date, '2026-06-01')
+        self.assertEqual(forms[0].typeOfSession, TypeOfSession.WORKSHOP)
+        self.assertEqual(forms[2].websafeKey, sessions[2].key.urlsafe())
+        self.assertEqual(forms, [SESSION_PLAN.copy(s) for s in sessions])
+
+    def testProfileConverter(self):
+        from conference import PROFILE_PLAN
+        from models import Profile, TeeShirtSize
+        prof = Profile(id='user@example.com', displayName='User',
+                       mainEmail='user@example.com', teeShirtSize='XL_W')
+        form = PROFILE_PLAN.copy(prof)
+        self.assertEqual(form.teeShirtSize, TeeShirtSize.XL_W)
+        self.assertEqual(form.displayName, 'User')
+        self.assertEqual(PROFILE_PLAN.copy(Profile()).teeShirtSize,
+                         TeeShirtSize.NOT_SPECIFIED)
+
+    def testRequiredFieldsChecked(self):
+        from protorpc import messages
+        from forms import CopyPlan
+        from models import StringMessage
+
+        class Note(ndb.Model):
+            data = ndb.StringProperty()
+
+        plan = CopyPlan(Note, StringMessage)
+        self.assertEqual(plan.copy(Note(data='hello')).data, 'hello')
+        with self.assertRaises(messages.ValidationError):
+            plan.copy(Note())
@@ -0,0 +1,109 @@
+"""Identity map and dirty tracking tests."""
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class IdentityMapTest(TestbedTestCase):
+
+    def setUp(self):
+        super(IdentityMapTest, self).setUp()
+        from models import Profile
+        # no ndb caches, every get the map doesn't serve is an RPC
+        ctx = ndb.get_context()
+        ctx.set_cache_policy(False)
+        ctx.set_memcache_policy(False)
+        self.addCleanup(ctx.set_cache_policy, None)
+        self.addCleanup(ctx.set_memcache_policy, None)
+        self.key = Profile(id='user@example.com', displayName='Old').put()
+        self.gets = 0
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'gets', self.record)
+
+    def record(self, service, call, request, response):
+        if (service, call) == ('datastore_v3', 'Get'):
+            self.gets += 1
+
+    def rename(self, displayName):
+        """Change the profile as another request would."""
+        from models import Profile
+        Profile(key=self.key, displayName=displayName).put()
+
+    def testGetReadsOncePerRequest(self):
+        import identity
+
+        @identity.scoped
+        def request():
+            return [identity.get(self.key) for _ in range(3)]
+        first = request()
+        self.assertEqual(self.gets, 1)
+        self.assertTrue(first[0] is first[1] is first[2])
+        # the next request reads again
+        self.rename('New')
+        self.assertEqual(request()[0].displayName, 'New')
+        self.assertEqual(self.gets, 2)
+
+    def testTransactionsReadTheDatastore(self):
+        import identity
+
+        @identity.scoped
+        def request(fail):
+            identity.get(self.key)
+            self.rename('New')
+
+            @ndb.transactional
+            def txn():
+                prof = identity.get(self.key)
+                if fail:
+                    raise ndb.Rollback()
+                return prof
+            inside = txn()
+            return inside, identity.get(self.key)
+        inside, after = request(fail=True)
+        self.assertIsNone(inside)
+        # a rolled back read doesn't replace the map's entity
+        self.assertEqual(after.displayName, 'Old')
+        inside, after = request(fail=False)
+        self.assertEqual(inside.displayName, 'New')
+        self.assertTrue(after is inside)
+
+    def testCachedValues(self):
+        import identity
+        calls = []
+
+        def load():
+            calls.append(1)
+            if len(calls) == 1:
+                raise ValueError('token check failed')
+            return 'user'
+
+        @identity.scoped
+        def request():
+            self.assertRaises(ValueError, identity.cached, 'user', load)
+            return [identity.cached('user', load) for _ in range(3)]
+        self.assertEqual(request(), ['user'] * 3)
+        self.assertEqual(len(calls), 2)
+
+
+class DirtyTrackingTest(TestbedTestCase):
+
+    def testSaveWritesChangedEntitiesOnly(self):
+        import identity
+        from models import Conference, Profile
+        prof = Profile(id='user@example.com', displayName='User')
+        conf = Conference(parent=prof.key, name='Conference', topics=['a'])
+        self.assertEqual(identity.save(prof, conf), [prof, conf])
+        self.assertEqual(identity.save(prof, conf), [])
+        ndb.get_context().clear_cache()
+        prof, conf = ndb.get_multi([prof.key, conf.key])
+        self.assertFalse(prof.isDirty() or conf.isDirty())
+        # in place changes count too
+        conf.topics.append('b')
+        self.assertEqual(identity.save(prof, conf), [conf])
+        prof.displayName = 'User'
+        self.assertEqual(identity.save(prof), [])
+        # query results are always written
+        ndb.get_context().clear_cache()
+        self.assertTrue(Conference.query().get().isDirty())
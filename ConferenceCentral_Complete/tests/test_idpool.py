@@ -0,0 +1,89 @@
+"""IdPool tests, with a stubbed id allocation."""
+
+import threading
+import time
+
+from google.appengine.ext import ndb
+
+from idpool import IdPool
+from tests.base import TestbedTestCase
+
+
+class Pooled(ndb.Model):
+    """Pooled -- model whose allocate_ids_async hands out consecutive
+    ranges, like Datastore, and records every allocation"""
+    lock = threading.Lock()
+    next = 1
+    allocations = []
+
+    @classmethod
+    def allocate_ids_async(cls, size=None, parent=None):
+        with cls.lock:
+            first = cls.next
+            cls.next += size
+            cls.allocations.append(parent)
+        # let other threads run between the allocation and its result
+        time.sleep(0.001)
+        future = ndb.Future()
+        future.set_result((first, first + size - 1))
+        return future
+
+
+class IdPoolTest(TestbedTestCase):
+
+    def setUp(self):
+        super(IdPoolTest, self).setUp()
+        Pooled.next = 1
+        Pooled.allocations = []
+
+    def testConcurrentReservesNeverShareIds(self):
+        pool = IdPool(Pooled, batch=7)
+        parents = [None, ndb.Key('Conference', 1), ndb.Key('Conference', 2)]
+        keys, errors = [], []
+
+        def reserve():
+            try:
+                for i in range(50):
+                    key = pool.reserve(parents[i % 3]).get_result()
+                    keys.append(key)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reserve) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(keys), 8 * 50)
+        self.assertEqual(len(set(keys)), len(keys))
+        # ids are unique across parents too, and every allocated id was
+        # either handed out or is still pooled
+        ids = set(k.id() for k in keys)
+        self.assertEqual(len(ids), len(keys))
+        pooled = [i for ids_ in pool._pools.values() for i in ids_]
+        self.assertFalse(ids & set(pooled))
+        self.assertEqual(Pooled.next - 1, len(keys) + len(pooled))
+
+    def testLeastRecentlyUsedParentsEvicted(self):
+        pool = IdPool(Pooled, batch=5, max_parents=2)
+        a, b, c = [ndb.Key('Conference', i) for i in (1, 2, 3)]
+        for parent in (a, b):
+            pool.reserve(parent).get_result()
+        # a becomes the most recently used parent, b is evicted for c
+        pool.reserve(a).get_result()
+        pool.reserve(c).get_result()
+        self.assertEqual(list(pool._pools), [a, c])
+        self.assertEqual(Pooled.allocations, [a, b, c])
+        pool.reserve(a).get_result()
+        pool.reserve(b).get_result()
+        self.assertEqual(Pooled.allocations, [a, b, c, b])
+        self.assertEqual(len(pool._pools), 2)
+
+    def testKeysKeepTheirParent(self):
+        pool = IdPool(Pooled, batch=3)
+        parent = ndb.Key('Conference', 1)
+        keys = [pool.reserve(parent).get_result() for _ in range(7)]
+        self.assertTrue(all(k.parent() == parent for k in keys))
+        self.assertEqual([k.id() for k in keys], list(range(1, 8)))
+        self.assertEqual(len(Pooled.allocations), 3)
@@ -0,0 +1,134 @@
+"""idtoken tests, with tokens signed by a generated key."""
+
+import base64
+import json
+import time
+
+from tests.base import TestbedTestCase
+
+AUDIENCE = 'client.apps.googleusercontent.com'
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _longToB64(n):
+    hexed = '%x' % n
+    return _b64encode(bytearray.fromhex('0' * (len(hexed) % 2) + hexed))
+
+
+class IdTokenTestCase(TestbedTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        from Crypto.PublicKey import RSA
+        cls.key = RSA.generate(1024)
+        cls.otherKey = RSA.generate(1024)
+
+    def setUp(self):
+        super(IdTokenTestCase, self).setUp()
+        import idtoken
+        self.idtoken = idtoken
+        idtoken.setSigningKeys({'keys': [{
+            'kty': 'RSA', 'kid': 'key1', 'alg': 'RS256',
+            'n': _longToB64(self.key.n), 'e': _longToB64(self.key.e),
+        }]}, time.time() + 3600)
+        # no refresh from the network for unknown kids
+        idtoken._lastRefresh = time.time()
+
+    def sign(self, key=None, kid='key1', **claims):
+        from Crypto.Hash import SHA256
+        from Crypto.Signature import PKCS1_v1_5
+        now = int(time.time())
+        payload = {'iss': 'accounts.google.com', 'aud': AUDIENCE,
+                   'sub': '1234', 'email': 'user@example.com',
+                   'iat': now, 'exp': now + 3600}
+        payload.update(claims)
+        signed = '%s.%s' % (
+            _b64encode(json.dumps({'alg': 'RS256', 'kid': kid}).encode()),
+            _b64encode(json.dumps(payload).encode()))
+        signature = PKCS1_v1_5.new(key or self.key).sign(
+            SHA256.new(signed.encode()))
+        return '%s.%s' % (signed, _b64encode(signature))
+
+    def assertInvalid(self, token, message):
+        with self.assertRaises(self.idtoken.InvalidTokenError) as raised:
+            self.idtoken.verifyIdToken(token, [AUDIENCE])
+        self.assertEqual(str(raised.exception), message)
+
+
+class VerifyIdTokenTest(IdTokenTestCase):
+
+    def testValid(self):
+        claims = self.idtoken.verifyIdToken(self.sign(), [AUDIENCE])
+        self.assertEqual(claims['sub'], '1234')
+        self.assertEqual(claims['email'], 'user@example.com')
+
+    def testExpired(self):
+        now = int(time.time())
+        self.assertInvalid(self.sign(iat=now - 7200, exp=now - 3600),
+                           'Token expired or not yet valid')
+
+    def testWrongAudience(self):
+        self.assertInvalid(self.sign(aud='other.apps.googleusercontent.com'),
+                           'Invalid audience')
+
+    def testUnknownKid(self):
+        self.assertInvalid(self.sign(kid='key2'), 'Unknown signing key')
+
+    def testBadSignature(self):
+        self.assertInvalid(self.sign(key=self.otherKey), 'Invalid signature')
+        header, payload, signature = self.sign().split('.')
+        forged = _b64encode(json.dumps({
+            'iss': 'accounts.google.com', 'aud': AUDIENCE,
+            'sub': '5678', 'iat': int(time.time()),
+            'exp': int(time.time()) + 3600}).encode())
+        self.assertInvalid('.'.join([header, forged, signature]),
+                           'Invalid signature')
+
+
+class _Response(object):
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {}
+
+
+class RefreshSigningKeysTest(IdTokenTestCase):
+
+    def setUp(self):
+        super(RefreshSigningKeysTest, self).setUp()
+        from google.appengine.api import urlfetch
+        self.fetches = []
+        # raised or returned by the certs fetch
+        self.reply = urlfetch.DeadlineExceededError('Deadline exceeded')
+        fetch = urlfetch.fetch
+        self.addCleanup(setattr, urlfetch, 'fetch', fetch)
+        urlfetch.fetch = self.fetch
+        # a refresh is due
+        self.idtoken._lastRefresh = 0
+
+    def fetch(self, url, **kwargs):
+        self.fetches.append(url)
+        if isinstance(self.reply, Exception):
+            raise self.reply
+        return self.reply
+
+    def testFailedFetchRejectsToken(self):
+        self.assertInvalid(self.sign(kid='key2'), 'Unknown signing key')
+        self.assertEqual(len(self.fetches), 1)
+        # the failed fetch counts against the refresh interval
+        self.assertInvalid(self.sign(kid='key2'), 'Unknown signing key')
+        self.assertEqual(len(self.fetches), 1)
+
+    def testMalformedKeysRejectToken(self):
+        self.reply = _Response('<html>not json</html>')
+        self.assertInvalid(self.sign(kid='key2'), 'Unknown signing key')
+        self.assertEqual(len(self.fetches), 1)
+
+    def testExpiredKeysUsedWhileFetchFails(self):
+        self.idtoken._keysExpire = time.time() - 1
+        claims = self.idtoken.verifyIdToken(self.sign(), [AUDIENCE])
+        self.assertEqual(claims['sub'], '1234')
+        self.assertEqual(len(self.fetches), 1)
@@ -0,0 +1,116 @@
+"""Index advisor tests."""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import indexadvisor
+from tests.base import TestbedTestCase
+
+
+class _Lines(logging.Handler):
+    """_Lines -- keeps the messages of the records it handles"""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(record.getMessage())
+
+
+def _capture(test):
+    handler = _Lines()
+    logger = logging.getLogger()
+    level = logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    test.addCleanup(logger.setLevel, level)
+    test.addCleanup(logger.removeHandler, handler)
+    return handler.lines
+
+
+def _eq(field):
+    return {'field': field, 'operator': '='}
+
+
+class AdvisorTest(unittest.TestCase):
+
+    def shapes(self, *queries):
+        """Record queries as (kind, filters, orders) and read them back."""
+        lines = _capture(self)
+        for kind, filters, orders in queries:
+            indexadvisor.recordQuery(kind, filters, orders)
+        return indexadvisor.readShapes(lines + ['unrelated line'])
+
+    def testShapes(self):
+        shapes = self.shapes(
+            ('Conference', [_eq('city'), {'field': 'month', 'operator': '>'}],
+             ['name']),
+            ('Conference', [_eq('city'), {'field': 'month', 'operator': '>'}],
+             ['month', 'name']))
+        # the inequality property leads the sort orders
+        self.assertEqual(dict(shapes), {
+            ('Conference', False, ('city',), 'month', ('month', 'name')): 2})
+
+    def testZigzagProposesOneIndexPerEquality(self):
+        shapes = self.shapes(
+            ('Conference', [_eq('city'), _eq('topics')], ['name']),
+            ('Conference', [_eq('city'), _eq('month')], ['name']),
+            ('Conference', [_eq('city')], []),
+            ('Conference', [], ['name']))
+        self.assertEqual(dict(indexadvisor.propose(shapes)), {
+            ('Conference', False, ('city', 'name')): 2,
+            ('Conference', False, ('topics', 'name')): 1,
+            ('Conference', False, ('month', 'name')): 1,
+        })
+        self.assertEqual(sorted(indexadvisor.propose(shapes, zigzag=False)), [
+            ('Conference', False, ('city', 'month', 'name')),
+            ('Conference', False, ('city', 'topics', 'name')),
+        ])
+
+    def testReportFindsUnusedIndexes(self):
+        shapes = self.shapes(
+            ('Conference', [_eq('city'), _eq('topics')], ['name']))
+        used = ('Conference', False, ('topics', 'name'))
+        unused = ('Conference', False, ('city', 'month', 'name'))
+        out = tempfile.TemporaryFile(mode='w+')
+        self.addCleanup(out.close)
+        self.assertEqual(indexadvisor.report(
+            shapes, indexadvisor.propose(shapes), [used, unused],
+            indexadvisor.DEFAULT_VALUES, out=out), [unused])
+        # topics has two values per conference
+        self.assertEqual(indexadvisor.rowsPerEntity(
+            used, indexadvisor.DEFAULT_VALUES), 2)
+        out.seek(0)
+        self.assertIn('1 of 2 index.yaml entries are never used', out.read())
+
+    def testIndexYamlRoundTrip(self):
+        indexes = [('Conference', False, ('city', '-name')),
+                   ('Session', True, ('startTime',))]
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'index.yaml')
+        with open(path, 'w') as f:
+            f.write(indexadvisor.dumpIndexes(indexes))
+        self.assertEqual(indexadvisor.loadIndexes(path), indexes)
+
+
+class RecordedShapesTest(TestbedTestCase):
+
+    def testQueriesRecordTheirShapes(self):
+        from conference import ConferenceApi
+        from models import ConferenceQueryForm, ConferenceQueryForms
+        lines = _capture(self)
+        ConferenceApi().queryConferences(ConferenceQueryForms(filters=[
+            ConferenceQueryForm(field='CITY', operator='EQ', value='London'),
+            ConferenceQueryForm(field='TOPIC', operator='EQ', value='moles')]))
+        shapes = indexadvisor.readShapes(lines)
+        self.assertEqual(list(shapes), [
+            ('Conference', False, ('city', 'topics'), None, ('name',))])
+        # index.yaml serves it
+        indexes = indexadvisor.loadIndexes(
+            os.path.join(os.path.dirname(indexadvisor.__file__), 'index.yaml'))
+        self.assertTrue(any(indexadvisor.usedBy(index, list(shapes)[0])
+                            for index in indexes))
@@ -0,0 +1,58 @@
+"""N+1 detection tests."""
+
+from google.appengine.ext import ndb
+
+import instrumentation
+from tests.base import TestbedTestCase
+
+
+class Counter(ndb.Model):
+    n = ndb.IntegerProperty(default=0)
+
+
+@ndb.transactional
+def _bump(key):
+    counter = key.get()
+    counter.n += 1
+    counter.put()
+
+
+class NPlusOneTest(TestbedTestCase):
+
+    def setUp(self):
+        super(NPlusOneTest, self).setUp()
+        # the testbed replaces the apiproxy the module hooked on import
+        instrumentation.installHooks()
+        self.keys = ndb.put_multi([Counter() for _ in range(5)])
+        ndb.get_context().clear_cache()
+
+    def nPlusOne(self, name):
+        for stats in instrumentation.getMethodStats():
+            if stats['method'] == name:
+                return stats['nPlusOne']
+
+    def testLoopOfGetsIsFlagged(self):
+        @instrumentation.instrumented('test.loopOfGets')
+        def loopOfGets():
+            return [key.get() for key in self.keys]
+        loopOfGets()
+        self.assertEqual(self.nPlusOne('test.loopOfGets'), 1)
+
+    def testSequentialTransactionalWritesAreNot(self):
+        @instrumentation.instrumented('test.transactionalWrites')
+        def transactionalWrites():
+            for key in self.keys:
+                _bump(key)
+        transactionalWrites()
+        self.assertEqual(self.nPlusOne('test.transactionalWrites'), 0)
+        self.assertEqual([c.n for c in ndb.get_multi(self.keys)], [1] * 5)
+
+    def testGetsFromDifferentCallSitesAreNot(self):
+        @instrumentation.instrumented('test.differentSites')
+        def differentSites():
+            first = self.keys[0].get()
+            second = self.keys[1].get()
+            third = self.keys[2].get()
+            return first, second, third
+        differentSites()
+        self.assertEqual(self.nPlusOne('test.differentSites'), 0)
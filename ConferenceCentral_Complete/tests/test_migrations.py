@@ -0,0 +1,112 @@
+"""migrations.py tests; every migration runs as a chain of tasks over
+pages of two entities."""
+
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class MigrationTestCase(TestbedTestCase):
+
+    def setUp(self):
+        super(MigrationTestCase, self).setUp()
+        import migrations
+        size = migrations.MIGRATION_BATCH_SIZE
+        self.addCleanup(setattr, migrations, 'MIGRATION_BATCH_SIZE', size)
+        migrations.MIGRATION_BATCH_SIZE = 2
+
+    def migrate(self, name):
+        """Run migration name to completion, returning its task count."""
+        import migrations
+        migrations.startMigration(name)
+        return self.runTasks('/tasks/migrate')
+
+
+class SessionParentsTest(MigrationTestCase):
+
+    def testSessionsMovedUnderTheirConference(self):
+        from models import Conference, Profile, Session, WishlistEntry
+        owner = ndb.Key(Profile, 'user@example.com')
+        conf = Conference(parent=owner, name='Mole Summit')
+        conf.put()
+        wsck = conf.key.urlsafe()
+        # sessions stored before they were children of their conference
+        orphans = [Session(name='Orphan %d' % i, conferenceId=wsck)
+                   for i in range(5)]
+        old = ndb.put_multi(orphans)
+        child = Session(parent=conf.key, name='Child')
+        child.put()
+        wishlisted = WishlistEntry(
+            key=ndb.Key(WishlistEntry, old[0].urlsafe(), parent=owner),
+            session=old[0], conference=conf.key)
+        wishlisted.put()
+
+        self.assertTrue(self.migrate('session_parents') >= 3)
+        sessions = Session.query(ancestor=conf.key).fetch()
+        self.assertEqual(sorted(s.name for s in sessions),
+                         ['Child'] + ['Orphan %d' % i for i in range(5)])
+        self.assertTrue(all(s.conferenceId == wsck for s in sessions))
+        self.assertEqual(ndb.get_multi(old), [None] * 5)
+        # the wishlist follows the moved session
+        entries = WishlistEntry.query(ancestor=owner).fetch()
+        self.assertEqual(len(entries), 1)
+        moved = entries[0].session.get()
+        self.assertEqual(moved.name, 'Orphan 0')
+        self.assertEqual(entries[0].key.id(), moved.key.urlsafe())
+        # a second run finds nothing to move
+        self.migrate('session_parents')
+        self.assertEqual(len(Session.query(ancestor=conf.key).fetch()), 6)
+
+
+class RegistrationsTest(MigrationTestCase):
+
+    def testProfileListsConverted(self):
+        from conference import ConferenceApi, PAGE_REQUEST
+        from models import Conference, Profile, Registration
+        owner = ndb.Key(Profile, 'organizer@example.com')
+        wscks = [k.urlsafe() for k in ndb.put_multi([
+            Conference(parent=owner, name='Conference %d' % i)
+            for i in range(3)])]
+        # registrations stored before they were Registration entities
+        ndb.put_multi([
+            Profile(id='user%d@example.com' % i, displayName='User %d' % i,
+                    mainEmail='user%d@example.com' % i,
+                    conferenceKeysToAttend=wscks[:i % 3 + 1])
+            for i in range(7)])
+
+        self.assertTrue(self.migrate('registrations') >= 4)
+        registrations = sum(i % 3 + 1 for i in range(7))
+        self.assertEqual(len(Registration.query().fetch()), registrations)
+        self.assertEqual(Profile.query(
+            Profile.conferenceKeysToAttend != None).fetch(), [])
+        self.login('user5@example.com')
+        forms = ConferenceApi().getConferencesToAttend(
+            PAGE_REQUEST.combined_message_class())
+        self.assertEqual(sorted(cf.websafeKey for cf in forms.items),
+                         sorted(wscks))
+        # a rerun converts nothing twice
+        self.migrate('registrations')
+        self.assertEqual(len(Registration.query().fetch()), registrations)
+
+
+class WishlistsTest(MigrationTestCase):
+
+    def testProfileListsConverted(self):
+        from models import Conference, Profile, Session, WishlistEntry
+        conf_key = Conference(parent=ndb.Key(Profile, 'user@example.com'),
+                              name='Conference').put()
+        wssks = [k.urlsafe() for k in ndb.put_multi([
+            Session(parent=conf_key, name='Session %d' % i)
+            for i in range(3)])]
+        # duplicates were possible in the old lists
+        ndb.put_multi([
+            Profile(id='user%d@example.com' % i,
+                    sessionWishlist=wssks[:i % 3 + 1] + wssks[:1])
+            for i in range(5)])
+
+        self.assertTrue(self.migrate('wishlists') >= 3)
+        entries = WishlistEntry.query().fetch()
+        self.assertEqual(len(entries), sum(i % 3 + 1 for i in range(5)))
+        self.assertTrue(all(e.conference == conf_key for e in entries))
+        self.assertEqual(Profile.query(
+            Profile.sessionWishlist != None).fetch(), [])
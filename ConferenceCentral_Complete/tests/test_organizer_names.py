@@ -0,0 +1,58 @@
+"""Organizer display name fan-out tests."""
+
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class OrganizerNameTest(TestbedTestCase):
+
+    def setUp(self):
+        super(OrganizerNameTest, self).setUp()
+        import conference
+        from models import ConferenceForm
+        size = conference.ORGANIZER_NAME_BATCH_SIZE
+        self.addCleanup(setattr, conference, 'ORGANIZER_NAME_BATCH_SIZE', size)
+        conference.ORGANIZER_NAME_BATCH_SIZE = 2
+        self.api = conference.ConferenceApi()
+        for i in range(5):
+            self.api.createConference(ConferenceForm(name='Conference %d' % i))
+
+    def rename(self, displayName):
+        from models import ProfileMiniForm
+        self.api.saveProfile(ProfileMiniForm(displayName=displayName))
+
+    def names(self):
+        from protorpc import message_types
+        return [cf.organizerDisplayName for cf in
+                self.api.getConferencesCreated(
+                    message_types.VoidMessage()).items]
+
+    def testRenameFansOutInBatches(self):
+        self.assertEqual(len(set(self.names())), 1)
+        self.rename('Mole Keeper')
+        # 5 conferences, 2 per task
+        self.assertEqual(self.runTasks('/tasks/update_organizer_name'), 3)
+        self.assertEqual(self.names(), ['Mole Keeper'] * 5)
+
+    def testUnchangedNameQueuesNothing(self):
+        self.rename('Mole Keeper')
+        self.runTasks('/tasks/update_organizer_name')
+        self.rename('Mole Keeper')
+        self.assertEqual(self.runTasks('/tasks/update_organizer_name'), 0)
+
+    def testRepairFixesStaleNames(self):
+        import migrations
+        from models import Conference
+        self.rename('Mole Keeper')
+        self.runTasks('/tasks/update_organizer_name')
+        stale = Conference.query().fetch()[:2]
+        for conf in stale:
+            conf.organizerDisplayName = None if conf is stale[0] else 'Old'
+        ndb.put_multi(stale)
+        migrations.startMigration('organizer_names')
+        self.runTasks('/tasks/migrate')
+        self.runTasks('/tasks/update_organizer_name')
+        self.assertEqual(
+            [c.organizerDisplayName for c in Conference.query()],
+            ['Mole Keeper'] * 5)
@@ -0,0 +1,150 @@
+"""QueryPlanner tests."""
+
+from datetime import time
+
+from tests.base import TestbedTestCase
+
+
+def _filter(field, operator, value):
+    return {'field': field, 'operator': operator, 'value': value}
+
+
+class NormalizeTest(TestbedTestCase):
+
+    def testEstimatedRangesDontPrune(self):
+        from conference import CONFERENCE_PLANNER, SESSION_PLANNER
+        # session durations aren't capped and undated conferences have
+        # month 0
+        for planner, filters in [
+                (SESSION_PLANNER, [_filter('duration', '=', 2000)]),
+                (SESSION_PLANNER, [_filter('duration', '>', 24 * 60)]),
+                (CONFERENCE_PLANNER, [_filter('month', '=', 0)])]:
+            self.assertEqual(planner.normalize(filters), filters)
+
+    def testBoundsPrune(self):
+        from conference import SESSION_PLANNER
+        self.assertIsNone(SESSION_PLANNER.normalize(
+            [_filter('startTime', '<', time.min)]))
+
+    def testOutOfBoundsQueriesNothing(self):
+        from google.appengine.api import apiproxy_stub_map
+        from conference import ConferenceApi
+        from models import ConferenceQueryForm, ConferenceQueryForms
+        rpcs = []
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'rpcs', lambda service, call, request, response:
+            rpcs.append((service, call)))
+        for field, operator, value in [('MONTH', 'GT', '12'),
+                                       ('MONTH', 'EQ', '13'),
+                                       ('MONTH', 'LT', '0'),
+                                       ('MAX_ATTENDEES', 'LT', '0')]:
+            forms = ConferenceApi().queryConferences(ConferenceQueryForms(
+                filters=[ConferenceQueryForm(field=field, operator=operator,
+                                             value=value)]))
+            self.assertEqual(forms.items, [])
+        self.assertEqual(rpcs, [])
+
+    def testBoundsKeptOnWrites(self):
+        import endpoints
+        from conference import ConferenceApi, CONF_POST_REQUEST
+        from models import Conference, ConferenceForm
+        api = ConferenceApi()
+        with self.assertRaises(endpoints.BadRequestException):
+            api.createConference(ConferenceForm(name='C', maxAttendees=-1))
+        api.createConference(ConferenceForm(name='C', maxAttendees=5))
+        wsck = Conference.query().get().key.urlsafe()
+        for fields in ({'month': 13}, {'maxAttendees': -5}):
+            with self.assertRaises(endpoints.BadRequestException):
+                api.updateConference(CONF_POST_REQUEST.combined_message_class(
+                    websafeConferenceKey=wsck, **fields))
+        conf = Conference.query().get()
+        self.assertEqual((conf.month, conf.maxAttendees), (0, 5))
+
+    def testContradictionsPrune(self):
+        from conference import CONFERENCE_PLANNER
+        self.assertIsNone(CONFERENCE_PLANNER.normalize(
+            [_filter('month', '>', 10), _filter('month', '<', 3)]))
+        self.assertEqual(CONFERENCE_PLANNER.normalize(
+            [_filter('month', '>=', 3), _filter('month', '<=', 3)]),
+            [_filter('month', '=', 3)])
+
+
+class PlanIndexesTest(TestbedTestCase):
+    # queries without a composite index in index.yaml fail, as deployed
+    requireIndexes = True
+
+    def setUp(self):
+        super(PlanIndexesTest, self).setUp()
+        from google.appengine.ext import ndb
+        from models import Conference, Profile, Session, TypeOfSession
+        owner = ndb.Key(Profile, 'user@example.com')
+        cities = ['London', 'Paris', 'Tokyo']
+        self.conferences = ndb.put_multi([
+            Conference(parent=owner, name='Conference %02d' % i,
+                       city=cities[i % 3], month=i % 12 + 1,
+                       topics=['Web', 'Topic %d' % (i % 2)],
+                       maxAttendees=10 * i, seatsAvailable=10 * i)
+            for i in range(12)])
+        types = [TypeOfSession.LECTURE, TypeOfSession.WORKSHOP]
+        self.sessions = ndb.put_multi([
+            Session(parent=self.conferences[i % 2], name='Session %02d' % i,
+                    typeOfSession=types[i % 2], speakerUserId='speaker',
+                    duration=15 * i, startTime=time(8 + i, 0))
+            for i in range(12)])
+
+    def queryConferences(self, filters):
+        from conference import ConferenceApi
+        from models import ConferenceQueryForm, ConferenceQueryForms
+        forms = ConferenceApi().queryConferences(ConferenceQueryForms(
+            filters=[ConferenceQueryForm(field=f, operator=o, value=v)
+                     for f, o, v in filters], limit=100))
+        return [cf.name for cf in forms.items]
+
+    def querySessions(self, filters, ancestor=None):
+        from conference import ConferenceApi
+        from models import SessionQueryForm, SessionQueryForms
+        forms = ConferenceApi().querySessions(SessionQueryForms(
+            filters=[SessionQueryForm(field=f, operator=o, value=v)
+                     for f, o, v in filters], limit=100,
+            websafeConferenceKey=ancestor and ancestor.urlsafe()))
+        return sorted(sf.name for sf in forms.items)
+
+    def testConferenceShapes(self):
+        self.assertEqual(
+            self.queryConferences([('TOPIC', 'EQ', 'Topic 1'),
+                                   ('MONTH', 'GT', '6')]),
+            ['Conference 07', 'Conference 09', 'Conference 11'])
+        self.assertEqual(
+            self.queryConferences([('CITY', 'EQ', 'Paris'),
+                                   ('TOPIC', 'EQ', 'Web'),
+                                   ('MONTH', 'GT', '3')]),
+            ['Conference 04', 'Conference 07', 'Conference 10'])
+        self.assertEqual(
+            self.queryConferences([('CITY', 'EQ', 'London'),
+                                   ('TOPIC', 'EQ', 'Topic 1'),
+                                   ('MONTH', 'LT', '12'),
+                                   ('MAX_ATTENDEES', 'GT', '20')]),
+            ['Conference 03', 'Conference 09'])
+
+    def testSessionShapes(self):
+        conf = self.conferences[1]
+        self.assertEqual(
+            self.querySessions([('TYPE', 'EQ', 'WORKSHOP'),
+                                ('START_TIME', 'GT', '12:00')], conf),
+            ['Session 05', 'Session 07', 'Session 09', 'Session 11'])
+        self.assertEqual(
+            self.querySessions([('SPEAKER', 'EQ', 'speaker'),
+                                ('DURATION', 'GT', '100'),
+                                ('START_TIME', 'LT', '18:00')], conf),
+            ['Session 07', 'Session 09'])
+        self.assertEqual(
+            self.querySessions([('NAME', 'EQ', 'Session 03'),
+                                ('DURATION', 'GTEQ', '0')]),
+            ['Session 03'])
+
+    def testPushesDownServedFilters(self):
+        from conference import CONFERENCE_PLANNER
+        plan = CONFERENCE_PLANNER.plan([_filter('city', '=', 'Paris'),
+                                        _filter('month', '>', 3)])
+        self.assertEqual(plan.pushed, 'month')
+        self.assertEqual(plan.residual, [])
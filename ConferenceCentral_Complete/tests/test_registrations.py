@@ -0,0 +1,76 @@
+"""Registration tests."""
+
+from tests.base import TestbedTestCase
+
+
+class RegistrationTest(TestbedTestCase):
+
+    def setUp(self):
+        super(RegistrationTest, self).setUp()
+        from conference import ConferenceApi
+        from models import Conference, ConferenceForm
+        self.api = ConferenceApi()
+        for i in range(3):
+            self.api.createConference(ConferenceForm(name='Conference %d' % i,
+                                                     maxAttendees=20))
+        self.wscks = sorted(c.key.urlsafe() for c in Conference.query())
+
+    def register(self, wsck):
+        from conference import CONF_GET_REQUEST
+        return self.api.registerForConference(
+            CONF_GET_REQUEST.combined_message_class(websafeConferenceKey=wsck))
+
+    def attendees(self, wsck, limit):
+        from conference import CONF_PAGE_REQUEST
+        attendees, pageToken, pages = [], None, 0
+        while True:
+            forms = self.api.getConferenceAttendees(
+                CONF_PAGE_REQUEST.combined_message_class(
+                    websafeConferenceKey=wsck, limit=limit,
+                    pageToken=pageToken))
+            attendees.extend(forms.attendees)
+            pages += 1
+            pageToken = forms.nextPageToken
+            if not pageToken:
+                return sorted(attendees), pages
+
+    def testOrganizerPagesAttendees(self):
+        import endpoints
+        emails = ['attendee%d@example.com' % i for i in range(5)]
+        for email in emails:
+            self.login(email)
+            self.register(self.wscks[0])
+        # only the organizer may list them
+        with self.assertRaises(endpoints.ForbiddenException):
+            self.attendees(self.wscks[0], 2)
+        self.login('user@example.com')
+        self.assertEqual(self.attendees(self.wscks[0], 2), (emails, 3))
+        self.assertEqual(self.attendees(self.wscks[1], 2), ([], 1))
+
+    def testRegistrationsAreASet(self):
+        from protorpc import message_types
+        from models import ConflictException
+        self.register(self.wscks[0])
+        with self.assertRaises(ConflictException):
+            self.register(self.wscks[0])
+        self.register(self.wscks[2])
+        profile = self.api.getProfile(message_types.VoidMessage())
+        self.assertEqual(sorted(profile.conferenceKeysToAttend),
+                         [self.wscks[0], self.wscks[2]])
+
+    def testConferencesToAttendPages(self):
+        from conference import CONF_GET_REQUEST, PAGE_REQUEST
+        for wsck in self.wscks:
+            self.register(wsck)
+        self.api.unregisterFromConference(
+            CONF_GET_REQUEST.combined_message_class(
+                websafeConferenceKey=self.wscks[1]))
+        first = self.api.getConferencesToAttend(
+            PAGE_REQUEST.combined_message_class(limit=1))
+        second = self.api.getConferencesToAttend(
+            PAGE_REQUEST.combined_message_class(
+                limit=1, pageToken=first.nextPageToken))
+        self.assertEqual(
+            sorted(cf.websafeKey for cf in first.items + second.items),
+            [self.wscks[0], self.wscks[2]])
+        self.assertFalse(second.nextPageToken)
@@ -0,0 +1,92 @@
+"""search.py tests."""
+
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class SearchTest(TestbedTestCase):
+
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        from models import Conference, Profile, Session
+        owner = ndb.Key(Profile, 'user@example.com')
+        self.confs = [
+            Conference(parent=owner, name='Python Days',
+                       description='All about snakes and moles',
+                       topics=['Programming Languages']),
+            Conference(parent=owner, name='Mole Summit',
+                       description='Moles, moles and more moles',
+                       topics=['Default', 'Topic']),
+        ]
+        ndb.put_multi(self.confs)
+        self.session = Session(parent=self.confs[0].key, name='Python moles',
+                               highlights=['Free', 'Beer'])
+        self.session.put()
+
+    def index(self):
+        import search
+        search.indexEntities(self.confs + [self.session])
+
+    def testRanksAndFilters(self):
+        import search
+        self.index()
+        hits, total = search.search('moles')
+        self.assertEqual(total, 3)
+        # a match in the name weighs the most
+        self.assertEqual(hits[0][0], self.session.key.urlsafe())
+        hits, total = search.search('python moles', kind='Conference')
+        self.assertEqual([wsk for wsk, _ in hits],
+                         [self.confs[0].key.urlsafe()])
+        self.assertEqual(search.search('python nothing'), ([], 0))
+
+    def testPages(self):
+        import search
+        self.index()
+        first, total = search.search('moles', limit=2)
+        second, _ = search.search('moles', limit=2, offset=2)
+        self.assertEqual(total, 3)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse(set(first) & set(second))
+
+    def testPlaceholdersNotIndexed(self):
+        import search
+        self.index()
+        for query in ('default topic', 'free beer'):
+            self.assertEqual(search.search(query), ([], 0))
+
+    def testReindexAndDelete(self):
+        import search
+        self.index()
+        self.confs[0].name = 'Ruby Days'
+        self.confs[0].put()
+        search.indexDocument(self.confs[0].key.urlsafe())
+        self.assertEqual(search.search('ruby')[1], 1)
+        self.assertEqual(search.search('python')[1], 1)
+        self.session.key.delete()
+        search.indexDocument(self.session.key.urlsafe())
+        self.assertEqual(search.search('python')[1], 0)
+
+    def testBuckets(self):
+        import search
+        from models import Conference, Profile, SearchTerm
+        owner = ndb.Key(Profile, 'user@example.com')
+        confs = [Conference(parent=owner, name='Common %d' % i)
+                 for i in range(60)]
+        ndb.put_multi(confs)
+        cap, search.MAX_BUCKET_POSTINGS = search.MAX_BUCKET_POSTINGS, 2
+        self.addCleanup(setattr, search, 'MAX_BUCKET_POSTINGS', cap)
+        search.indexEntities(confs)
+        buckets = SearchTerm.query().fetch()
+        self.assertTrue(any(b.overflows for b in buckets))
+        self.assertTrue(all(len(b.postings) <= 2 for b in buckets))
+        # full buckets continue in overflow entities, nothing is dropped
+        self.assertEqual(search.search('common')[1], 60)
+        self.assertEqual(search.search('common 59')[0][0][0],
+                         confs[59].key.urlsafe())
+        for conf in confs[30:]:
+            conf.key.delete()
+            search.indexDocument(conf.key.urlsafe())
+        self.assertEqual(search.search('common')[1], 30)
+        self.assertEqual(search.search('common 59'), ([], 0))
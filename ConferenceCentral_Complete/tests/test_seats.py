@@ -0,0 +1,101 @@
+"""Seat shard tests."""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import seats
+from tests.base import TestbedTestCase
+
+
+class SeatsTestCase(TestbedTestCase):
+    """SeatsTestCase -- a conference with 40 seats over its shards"""
+
+    def setUp(self):
+        super(SeatsTestCase, self).setUp()
+        from models import Conference, Profile
+        self.conf = Conference(parent=ndb.Key(Profile, 'user@example.com'),
+                               name='Conference', seatsAvailable=40)
+        self.conf.put()
+        seats.createSeatShards(self.conf.key, 40)
+        self.wsck = self.conf.key.urlsafe()
+
+    def takeSeat(self):
+        # another request's copy of the shard
+        shard = seats._shardKeys(self.wsck)[0].get(use_cache=False)
+        shard.seatsAvailable -= 1
+        shard.put(use_cache=False)
+
+    def newRequest(self):
+        ndb.get_context().clear_cache()
+
+
+class SeatsCacheTest(SeatsTestCase):
+
+    def testStaleCountNotRestored(self):
+        # a registration commits between a reader's shard read and its
+        # cache fill
+        read = ndb.get_multi_async
+
+        def readThenRegister(keys, **options):
+            futures = read(keys, **options)
+            for future in futures:
+                future.get_result()
+            self.takeSeat()
+            seats.seatsChanged(self.conf.key)
+            return futures
+
+        ndb.get_multi_async = readThenRegister
+        try:
+            stale = seats.getSeatsAvailable({self.wsck: 40})
+        finally:
+            ndb.get_multi_async = read
+        self.assertEqual(stale, {self.wsck: 40})
+        self.assertEqual(memcache.get(seats.MEMCACHE_SEATS_PREFIX + self.wsck),
+                         seats.LOCKED)
+        self.newRequest()
+        self.assertEqual(seats.getSeatsAvailable({self.wsck: 40}),
+                         {self.wsck: 39})
+
+    def testCachedCountDropped(self):
+        seats.getSeatsAvailable({self.wsck: 40})
+        self.takeSeat()
+        seats.seatsChanged(self.conf.key)
+        self.newRequest()
+        self.assertEqual(seats.getSeatsAvailable({self.wsck: 40}),
+                         {self.wsck: 39})
+
+    def testCountCached(self):
+        self.assertEqual(seats.getSeatsAvailable({self.wsck: 40}),
+                         {self.wsck: 40})
+        self.assertEqual(memcache.get(seats.MEMCACHE_SEATS_PREFIX + self.wsck),
+                         40)
+
+
+class ReconcileTest(SeatsTestCase):
+
+    def testRegistrationDuringReconcile(self):
+        # the stored count is out of date, so reconciling writes it
+        self.conf.seatsAvailable = 35
+        self.conf.put()
+        getSeatShards = seats.getSeatShards
+        calls = []
+
+        def readThenRegister(conf):
+            shards = getSeatShards(conf)
+            if not calls:
+                ndb.non_transactional(self.takeSeat)()
+            calls.append(conf)
+            return shards
+
+        seats.getSeatShards = readThenRegister
+        try:
+            self.assertEqual(seats.reconcileSeats(self.wsck), 39)
+        finally:
+            seats.getSeatShards = getSeatShards
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.conf.key.get(use_cache=False).seatsAvailable, 39)
+
+    def testMissingShardsCreated(self):
+        ndb.delete_multi(seats._shardKeys(self.wsck)[:5])
+        self.assertEqual(seats.reconcileSeats(self.wsck), 40)
+        self.assertNotIn(None, ndb.get_multi(seats._shardKeys(self.wsck)))
@@ -0,0 +1,52 @@
+"""Speaker count tests."""
+
+import endpoints
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class TopSpeakersTest(TestbedTestCase):
+
+    def setUp(self):
+        super(TopSpeakersTest, self).setUp()
+        from conference import ConferenceApi
+        from models import Conference, ConferenceForm
+        self.api = ConferenceApi()
+        self.api.createConference(ConferenceForm(name='Conference'))
+        self.wsck = Conference.query().get().key.urlsafe()
+
+    def topSpeakers(self, wsck):
+        from conference import CONF_TOP_SPEAKERS_REQUEST
+        forms = self.api.getTopSpeakers(
+            CONF_TOP_SPEAKERS_REQUEST.combined_message_class(
+                websafeConferenceKey=wsck))
+        return [(sf.speakerUserId, sf.sessions) for sf in forms.items]
+
+    def createSession(self, name, speaker):
+        from models import SessionForm
+        self.api.createSession(SessionForm(name=name, speakerUserId=speaker,
+                                           conferenceId=self.wsck))
+
+    def testMissingConference(self):
+        from models import Conference, Profile, SpeakerCounts
+        self.logout()
+        for key in (ndb.Key(Profile, 'nobody'), ndb.Key(Conference, 12345)):
+            with self.assertRaises(endpoints.NotFoundException):
+                self.topSpeakers(key.urlsafe())
+        self.assertEqual(SpeakerCounts.query().count(), 0)
+
+    def testCountsFollowSessionWrites(self):
+        from conference import SESSION_GET_REQUEST
+        from models import Session
+        self.assertEqual(self.topSpeakers(self.wsck), [])
+        self.createSession('One', 'ada@example.com')
+        self.createSession('Two', 'ada@example.com')
+        self.createSession('Three', 'bob@example.com')
+        self.assertEqual(self.topSpeakers(self.wsck),
+                         [('ada@example.com', 2), ('bob@example.com', 1)])
+        session = Session.query(Session.name == 'Two').get()
+        self.api.deleteSession(SESSION_GET_REQUEST.combined_message_class(
+            websafeKey=session.key.urlsafe()))
+        self.assertEqual(sorted(self.topSpeakers(self.wsck)),
+                         [('ada@example.com', 1), ('bob@example.com', 1)])
@@ -0,0 +1,100 @@
+"""typeahead.py tests."""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class TypeaheadTest(TestbedTestCase):
+
+    def setUp(self):
+        super(TypeaheadTest, self).setUp()
+        import typeahead
+        from models import Conference, Profile
+        typeahead._local.update(checked=0, versions=None, fields={})
+        owner = ndb.Key(Profile, 'user@example.com')
+        self.confs = [
+            Conference(parent=owner, name='Conference %02d' % i,
+                       city=['London', 'Lodz', 'Paris'][i % 3],
+                       topics=['Web Technologies', 'moles'])
+            for i in range(30)]
+        self.confs.append(Conference(parent=owner, name='Placeholders',
+                                     city='Default City',
+                                     topics=['Default', 'Topic']))
+        ndb.put_multi(self.confs)
+        typeahead.updateTypeahead([conf.key for conf in self.confs])
+
+    def suggest(self, *args):
+        import typeahead
+        typeahead._local['checked'] = 0
+        return typeahead.suggest(*args)
+
+    def testSuggest(self):
+        self.assertEqual(self.suggest('lo', 'city'),
+                         [('city', 'Lodz'), ('city', 'London')])
+        self.assertEqual(self.suggest('W'),
+                         [('topics', 'Web Technologies')])
+        self.assertEqual(len(self.suggest('conf', 'name', 5)), 5)
+        self.assertEqual(self.suggest('default'), [])
+
+    def testShardsAndRecount(self):
+        import typeahead
+        from models import TypeaheadIndex
+        shards = [s for s in ndb.get_multi(
+            [typeahead._shardKey(i)
+             for i in range(typeahead.NUM_TYPEAHEAD_SHARDS)]) if s]
+        self.assertTrue(len(shards) > 1)
+        for conf in self.confs:
+            if conf.city == 'Lodz':
+                conf.city = 'Berlin'
+        ndb.put_multi(self.confs)
+        typeahead.updateTypeahead([conf.key for conf in self.confs])
+        # retried tasks change nothing
+        typeahead.updateTypeahead([conf.key for conf in self.confs])
+        self.assertEqual(self.suggest('lo', 'city'), [('city', 'London')])
+        self.assertEqual(self.suggest('b', 'city'), [('city', 'Berlin')])
+
+    def testOlderVersionNotPublished(self):
+        import typeahead
+        index = typeahead._shardKey(0).get()
+        newer = index.version
+        index.version = newer - 1
+        typeahead._publish(index)
+        self.assertEqual(memcache.get(
+            typeahead.MEMCACHE_TYPEAHEAD_PREFIX + str(index.key.id()))[0],
+            newer)
+
+    def testTooLargeForMemcache(self):
+        import typeahead
+        from models import TypeaheadIndex
+        memcache.flush_all()
+        size = memcache.MAX_VALUE_SIZE
+        self.addCleanup(setattr, memcache, 'MAX_VALUE_SIZE', size)
+        memcache.MAX_VALUE_SIZE = typeahead.MEMCACHE_OVERHEAD + 100
+        self.assertEqual(self.suggest('lo', 'city'),
+                         [('city', 'Lodz'), ('city', 'London')])
+        # the shards went to memcache in pieces, the next refresh doesn't
+        # need the datastore
+        entry = memcache.get(typeahead.MEMCACHE_TYPEAHEAD_PREFIX + '1')
+        self.assertTrue(entry[1] > 1)
+        ndb.delete_multi(TypeaheadIndex.query().fetch(keys_only=True))
+        typeahead._local.update(versions=None, fields={})
+        self.assertEqual(self.suggest('lo', 'city'),
+                         [('city', 'Lodz'), ('city', 'London')])
+        self.assertEqual(len(self.suggest('conf', 'name', 50)), 30)
+
+    def testEvictedPieceReloadsShard(self):
+        import typeahead
+        memcache.flush_all()
+        size = memcache.MAX_VALUE_SIZE
+        self.addCleanup(setattr, memcache, 'MAX_VALUE_SIZE', size)
+        memcache.MAX_VALUE_SIZE = typeahead.MEMCACHE_OVERHEAD + 100
+        self.suggest('lo')
+        version, n = memcache.get(typeahead.MEMCACHE_TYPEAHEAD_PREFIX + '1')
+        memcache.delete(typeahead.MEMCACHE_TYPEAHEAD_PREFIX +
+                        typeahead._pieceKeys('1', version, n)[-1])
+        self.assertEqual(typeahead._cachedEntries(['1']), [None])
+        typeahead._local.update(versions=None, fields={})
+        self.assertEqual(len(self.suggest('conf', 'name', 50)), 30)
+        self.assertTrue(all(typeahead._cachedEntries(['1'])))
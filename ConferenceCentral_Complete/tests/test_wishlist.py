@@ -0,0 +1,92 @@
+"""Wishlist tests."""
+
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class WishlistTest(TestbedTestCase):
+
+    def setUp(self):
+        super(WishlistTest, self).setUp()
+        from conference import ConferenceApi
+        from models import Conference, Profile, Session
+        self.api = ConferenceApi()
+        owner = ndb.Key(Profile, 'user@example.com')
+        self.conf_keys = ndb.put_multi([
+            Conference(parent=owner, name='Conference %d' % i,
+                       organizerUserId='user@example.com')
+            for i in range(2)])
+        self.wssks = [[k.urlsafe() for k in ndb.put_multi([
+            Session(parent=conf_key, name='Session %d' % i,
+                    conferenceId=conf_key.urlsafe())
+            for i in range(3)])] for conf_key in self.conf_keys]
+
+    def add(self, *wssks):
+        from models import WishlistForm
+        return sorted(self.api.addSessionsToWishlist(WishlistForm(
+            websafeSessionKeys=list(wssks))).websafeSessionKeys)
+
+    def remove(self, *wssks):
+        from models import WishlistForm
+        return sorted(self.api.removeSessionsFromWishlist(WishlistForm(
+            websafeSessionKeys=list(wssks))).websafeSessionKeys)
+
+    def wishlist(self, conf):
+        from conference import CONF_GET_REQUEST
+        return sorted(form.websafeKey for form in
+                      self.api.getSessionsInWishlist(
+                          CONF_GET_REQUEST.combined_message_class(
+                              websafeConferenceKey=self.conf_keys[
+                                  conf].urlsafe())).items)
+
+    def testAddIsASet(self):
+        import endpoints
+        from conference import SESSION_GET_REQUEST
+        from models import Session, WishlistEntry
+        request = SESSION_GET_REQUEST.combined_message_class(
+            websafeKey=self.wssks[0][0])
+        self.api.addSessionToWishlist(request)
+        self.api.addSessionToWishlist(request)
+        self.assertEqual(len(WishlistEntry.query().fetch()), 1)
+        missing = ndb.Key(Session, 99, parent=self.conf_keys[0]).urlsafe()
+        with self.assertRaises(endpoints.NotFoundException):
+            self.api.addSessionToWishlist(
+                SESSION_GET_REQUEST.combined_message_class(websafeKey=missing))
+
+    def testBulkAddAndRemove(self):
+        import endpoints
+        from models import Session
+        missing = ndb.Key(Session, 99, parent=self.conf_keys[0]).urlsafe()
+        first, second = self.wssks
+        # duplicates and missing sessions are left out
+        self.assertEqual(self.add(first[0], first[0], first[1], second[2],
+                                  missing),
+                         sorted([first[0], first[1], second[2]]))
+        self.assertEqual(self.remove(first[0], first[2]), [first[0]])
+        self.assertEqual(self.remove(first[0]), [])
+        self.assertEqual(self.wishlist(0), [first[1]])
+        with self.assertRaises(endpoints.BadRequestException):
+            self.add(self.conf_keys[0].urlsafe())
+
+    def testReadPerConference(self):
+        first, second = self.wssks
+        self.add(first[0], first[2], second[1])
+        self.assertEqual(self.wishlist(0), sorted([first[0], first[2]]))
+        self.assertEqual(self.wishlist(1), [second[1]])
+        # another user's wishlist is their own
+        self.login('other@example.com')
+        self.assertEqual(self.wishlist(0), [])
+
+    def testDeletedSessionLeavesWishlists(self):
+        from conference import SESSION_GET_REQUEST
+        first = self.wssks[0]
+        self.add(*first)
+        self.login('other@example.com')
+        self.add(first[0])
+        self.login('user@example.com')
+        self.api.deleteSession(SESSION_GET_REQUEST.combined_message_class(
+            websafeKey=first[0]))
+        self.assertEqual(self.wishlist(0), sorted(first[1:]))
+        self.login('other@example.com')
+        self.assertEqual(self.wishlist(0), [])
@@ -0,0 +1,74 @@
+"""Datastore puts per request: one put_multi at most, of changed entities
+only."""
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_rpc
+from google.appengine.ext import ndb
+
+from tests.base import TestbedTestCase
+
+
+class PutsPerRequestTest(TestbedTestCase):
+
+    def setUp(self):
+        super(PutsPerRequestTest, self).setUp()
+        from conference import ConferenceApi
+        self.api = ConferenceApi()
+        # ndb splits a put_multi into RPCs of 10 entity groups: make every
+        # put_multi one RPC
+        ndb.set_context(ndb.make_context(config=datastore_rpc.Configuration(
+            max_entity_groups_per_rpc=25)))
+        self.rpcs = []
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'puts', self.record)
+
+    def tearDown(self):
+        ndb.set_context(None)
+        super(PutsPerRequestTest, self).tearDown()
+
+    def record(self, service, call, request, response):
+        if (service, call) == ('datastore_v3', 'Put'):
+            self.rpcs.append(request.entity_size())
+
+    def puts(self, method, request):
+        """Return [entities per put RPC] of one call of method."""
+        ndb.get_context().clear_cache()
+        self.rpcs = []
+        getattr(self.api, method)(request)
+        return self.rpcs
+
+    def createConference(self):
+        from models import Conference, ConferenceForm
+        self.assertEqual(self.puts('createConference', ConferenceForm(
+            name='Conference', maxAttendees=100)), [1 + 20])
+        return Conference.query().get().key.urlsafe()
+
+    def testConference(self):
+        from conference import CONF_POST_REQUEST
+        wsck = self.createConference()
+        update = CONF_POST_REQUEST.combined_message_class
+        self.assertEqual(self.puts('updateConference', update(
+            websafeConferenceKey=wsck, seatsAvailable=50)), [1 + 20])
+        # same seats: nothing changed, nothing written
+        self.assertEqual(self.puts('updateConference', update(
+            websafeConferenceKey=wsck, seatsAvailable=50)), [])
+        self.assertEqual(self.puts('updateConference', update(
+            websafeConferenceKey=wsck, city='Paris')), [1])
+
+    def testNewProfile(self):
+        from conference import CONF_GET_REQUEST
+        from models import ProfileMiniForm
+        from protorpc import message_types
+        self.assertEqual(self.puts('saveProfile', ProfileMiniForm(
+            displayName='Ada')), [1])
+        self.assertEqual(self.puts('getProfile',
+                                   message_types.VoidMessage()), [])
+        self.login('other@example.com')
+        self.assertEqual(self.puts('getProfile',
+                                   message_types.VoidMessage()), [1])
+        self.login('user@example.com')
+        wsck = self.createConference()
+        # a registration of a user without a profile creates it
+        self.login('third@example.com')
+        self.assertEqual(self.puts('registerForConference', CONF_GET_REQUEST
+            .combined_message_class(websafeConferenceKey=wsck)), [3])
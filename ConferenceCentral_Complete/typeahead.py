@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""typeahead.py
+
+Prefix index for autocompleting the distinct Conference names, cities and
+topics. Conferences are counted per value in one of NUM_TYPEAHEAD_SHARDS
+TypeaheadIndex entities, picked by conference, which /tasks/update_typeahead
+tasks update incrementally. memcache holds the latest version of every
+shard, split into pieces when it is too large for one value, and every
+instance keeps sorted arrays built from their union, so a
+lookup is a bisect in memory and touches memcache at most once every
+LOCAL_TTL seconds.
+
+"""
+
+import bisect
+import json
+import logging
+import threading
+import time
+import zlib
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import CONFERENCE_DEFAULTS
+from models import TypeaheadIndex
+from models import TypeaheadSource
+
+FIELDS = ('name', 'city', 'topics')
+# conference writes are spread over this many entity groups; changing it
+# requires recounting every conference
+NUM_TYPEAHEAD_SHARDS = 8
+MEMCACHE_TYPEAHEAD_PREFIX = 'TYPEAHEAD:'
+# seconds an instance serves its copy before checking memcache for a newer one
+LOCAL_TTL = 5
+# conferences per cross-group transaction, which spans 25 groups at most,
+# one of them the shard
+XG_BATCH_SIZE = 20
+# compare-and-set attempts when publishing a shard to memcache
+PUBLISH_ATTEMPTS = 3
+# bytes of a memcache value left for pickling the shard entry around a piece
+MEMCACHE_OVERHEAD = 100
+
+_lock = threading.Lock()
+# arrays of the shard versions last loaded: {field: (lowercased values, values)}
+_local = {'checked': 0, 'versions': None, 'fields': {}}
+
+
+def _shard(wsck):
+    return (zlib.crc32(wsck.encode('utf-8')) & 0xffffffff) % NUM_TYPEAHEAD_SHARDS
+
+
+def _shardKey(shard):
+    return ndb.Key(TypeaheadIndex, shard + 1)
+
+
+def conferenceValues(conf):
+    """Return {field: sorted distinct values} of conf, leaving out the
+    placeholders filled in for fields a create request left out."""
+    values = {}
+    for field in FIELDS:
+        value = getattr(conf, field)
+        if value == CONFERENCE_DEFAULTS.get(field):
+            continue
+        value = sorted(set(v for v in (value if isinstance(value, list)
+                                       else [value]) if v))
+        if value:
+            values[field] = value
+    return values
+
+
+def typeaheadChanged(conf_key):
+    """Queue the recount of a created or updated conference. Inside a
+    transaction the task is only added if it commits."""
+    taskqueue.add(params={'websafeConferenceKey': conf_key.urlsafe()},
+                  url='/tasks/update_typeahead',
+                  transactional=ndb.in_transaction())
+
+
+def updateTypeahead(conf_keys):
+    """Recount the values of conferences, per shard and XG_BATCH_SIZE per
+    transaction. Each conference remembers what it was counted with, so a
+    retried task changes nothing twice."""
+    byShard = {}
+    for key in conf_keys:
+        byShard.setdefault(_shard(key.urlsafe()), []).append(key)
+    for shard, keys in sorted(byShard.items()):
+        for i in range(0, len(keys), XG_BATCH_SIZE):
+            _update(shard, keys[i:i + XG_BATCH_SIZE])
+
+
+@ndb.transactional(xg=True)
+def _update(shard, conf_keys):
+    shard_key = _shardKey(shard)
+    source_keys = [ndb.Key(TypeaheadSource, k.urlsafe(), parent=shard_key)
+                   for k in conf_keys]
+    # the conferences are read in the transaction too, so two tasks of the
+    # same conference can't commit in the wrong order
+    entities = ndb.get_multi([shard_key] + conf_keys + source_keys)
+    index = entities[0] or TypeaheadIndex(key=shard_key, counts={})
+    n = len(conf_keys)
+    puts, deletes = [], []
+    for source_key, conf, source in zip(source_keys, entities[1:n + 1],
+                                        entities[n + 1:]):
+        old = source.values if source else {}
+        new = conferenceValues(conf) if conf else {}
+        if old == new:
+            continue
+        for field in FIELDS:
+            counts = index.counts.setdefault(field, {})
+            for value in old.get(field, []):
+                counts[value] -= 1
+                if counts[value] <= 0:
+                    del counts[value]
+            for value in new.get(field, []):
+                counts[value] = counts.get(value, 0) + 1
+        if new:
+            puts.append(TypeaheadSource(key=source_key, values=new))
+        else:
+            deletes.append(source_key)
+    if not (puts or deletes):
+        return
+    index.version += 1
+    ndb.put_multi([index] + puts)
+    ndb.delete_multi(deletes)
+    ndb.get_context().call_on_commit(lambda: _publish(index))
+
+
+def _pieces(counts):
+    """Return counts as compressed JSON pieces that each fit in a memcache
+    value, splitting its (field, value) pairs into more pieces until they
+    do; None if a single pair doesn't fit."""
+    pairs = sorted((field, value, n) for field, values in counts.items()
+                   for value, n in values.items())
+    limit = memcache.MAX_VALUE_SIZE - MEMCACHE_OVERHEAD
+    parts = 1
+    while True:
+        size = max(-(-len(pairs) // parts), 1)
+        pieces = []
+        for i in range(0, max(len(pairs), 1), size):
+            piece = {}
+            for field, value, n in pairs[i:i + size]:
+                piece.setdefault(field, {})[value] = n
+            pieces.append(zlib.compress(json.dumps(piece)))
+        if all(len(piece) <= limit for piece in pieces):
+            return pieces
+        if size == 1:
+            return None
+        parts *= 2
+
+
+def _pieceKeys(index_id, version, n):
+    return ['%s:%d:%d' % (index_id, version, i) for i in range(n)]
+
+
+def _publish(index):
+    """Put a shard version in memcache unless a newer one is there already;
+    commit callbacks of two updates may run in either order. A shard that
+    doesn't fit in one value is stored as pieces, keyed by version, and its
+    entry holds their number. Returns the (version, pieces) entry."""
+    pieces = _pieces(index.counts)
+    if pieces is None:
+        logging.warning('typeahead shard %s is too large for memcache',
+                        index.key.id())
+        return (index.version, [zlib.compress(json.dumps(index.counts))])
+    client = memcache.Client()
+    key = str(index.key.id())
+    if len(pieces) == 1:
+        entry = (index.version, pieces[0])
+    else:
+        entry = (index.version, len(pieces))
+        # the pieces go first, so a reader of the entry finds them
+        client.set_multi(dict(zip(_pieceKeys(key, index.version,
+                                             len(pieces)), pieces)),
+                         key_prefix=MEMCACHE_TYPEAHEAD_PREFIX)
+    key = MEMCACHE_TYPEAHEAD_PREFIX + key
+    for _ in range(PUBLISH_ATTEMPTS):
+        current = client.gets(key)
+        if current is None:
+            if client.add(key, entry):
+                break
+        elif current[0] >= index.version or client.cas(key, entry):
+            break
+    return (index.version, pieces)
+
+
+def _cachedEntries(ids):
+    """Return [(version, pieces) or None] of shard ids from memcache; a
+    shard with an evicted piece counts as missing."""
+    cached = memcache.get_multi(ids, key_prefix=MEMCACHE_TYPEAHEAD_PREFIX)
+    entries = [cached.get(i) for i in ids]
+    pieceKeys = [k for i, entry in zip(ids, entries)
+                 if entry and isinstance(entry[1], int)
+                 for k in _pieceKeys(i, entry[0], entry[1])]
+    pieces = memcache.get_multi(
+        pieceKeys, key_prefix=MEMCACHE_TYPEAHEAD_PREFIX) if pieceKeys else {}
+    result = []
+    for i, entry in zip(ids, entries):
+        if entry is None:
+            result.append(None)
+        elif isinstance(entry[1], int):
+            data = [pieces.get(k) for k in _pieceKeys(i, entry[0], entry[1])]
+            result.append((entry[0], data) if all(data) else None)
+        else:
+            result.append((entry[0], [entry[1]]))
+    return result
+
+
+def _fields():
+    """Return this instance's arrays, refreshed from memcache (or, for
+    evicted shards, the datastore) every LOCAL_TTL seconds."""
+    now = time.time()
+    with _lock:
+        if now - _local['checked'] < LOCAL_TTL:
+            return _local['fields']
+    keys = [_shardKey(shard) for shard in range(NUM_TYPEAHEAD_SHARDS)]
+    entries = _cachedEntries([str(key.id()) for key in keys])
+    missing = [key for key, entry in zip(keys, entries) if entry is None]
+    if missing:
+        loaded = dict((index.key, _publish(index))
+                      for index in ndb.get_multi(missing) if index)
+        entries = [entry or loaded.get(key, (0, []))
+                   for key, entry in zip(keys, entries)]
+    versions = [version for version, _ in entries]
+    with _lock:
+        if versions != _local['versions']:
+            values = dict((field, set()) for field in FIELDS)
+            for _, pieces in entries:
+                for piece in pieces:
+                    counts = json.loads(zlib.decompress(piece))
+                    for field in FIELDS:
+                        values[field].update(counts.get(field, {}))
+            fields = {}
+            for field in FIELDS:
+                pairs = sorted((v.lower(), v) for v in values[field])
+                fields[field] = ([k for k, _ in pairs], [v for _, v in pairs])
+            _local.update(versions=versions, fields=fields)
+        _local['checked'] = now
+        return _local['fields']
+
+
+def suggest(prefix, field=None, limit=10):
+    """Return [(field, value)] of up to limit values per field starting
+    with prefix, ignoring case, in alphabetical order."""
+    prefix = (prefix or '').lower()
+    fields = _fields()
+    suggestions = []
+    for name in ((field,) if field else FIELDS):
+        keys, values = fields.get(name, ((), ()))
+        i = bisect.bisect_left(keys, prefix)
+        end = min(i + limit, len(keys))
+        while i < end and keys[i].startswith(prefix):
+            suggestions.append((name, values[i]))
+            i += 1
+    return suggestions
@@ -1,11 +1,22 @@
 import json
+import logging
 import os
 import time
 import uuid
 
+import endpoints
 from google.appengine.api import urlfetch
 from models import Profile
 
+import idtoken
+from settings import WEB_CLIENT_ID
+from settings import ANDROID_CLIENT_ID
+from settings import IOS_CLIENT_ID
+from settings import OFFLINE_TOKEN_VERIFICATION
+
+ID_TOKEN_AUDIENCES = (WEB_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID,
+                      endpoints.API_EXPLORER_CLIENT_ID)
+
 def getUserId(user, id_type="email"):
     if id_type == "email":
         return user.email()
@@ -14,6 +25,18 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
+        user_id = idtoken.getCachedUserId(token)
+        if user_id:
+            return user_id
+        # ID tokens are JWTs (header.payload.signature), verify them locally
+        if OFFLINE_TOKEN_VERIFICATION and token.count('.') == 2:
+            try:
+                claims = idtoken.verifyIdToken(token, ID_TOKEN_AUDIENCES)
+            except idtoken.InvalidTokenError as e:
+                logging.warning('Rejected ID token: %s', e)
+                return ''
+            idtoken.cacheUserId(token, claims['sub'], int(claims['exp']))
+            return claims['sub']
         token_type = 'id_token'
         if 'OAUTH_USER_ID' in os.environ:
             token_type = 'access_token'
@@ -32,6 +55,9 @@ def getUserId(user, id_type="email"):
             else:
                 time.sleep(wait)
                 wait = wait + i
+        if user.get('user_id') and user.get('expires_in'):
+            idtoken.cacheUserId(token, user['user_id'],
+                                time.time() + int(user['expires_in']))
         return user.get('user_id', '')
 
     if id_type == "custom":